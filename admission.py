@@ -0,0 +1,253 @@
+# Admission control for the analysis routes: bounded concurrency per worker, per-client limits and deadlines
+#
+# A sync gunicorn worker takes the next connection only when it is done with the current one, so under a bulk
+# submission requests wait in the listen backlog, and with --threads in the worker, until the gunicorn timeout
+# kills them. AdmissionController decides before any work is done whether a request is admitted:
+#   - at most max_in_flight requests of a worker are analysed at a time; up to max_queue more wait for a slot,
+#     further ones are rejected straight away (reason 'queue_full')
+#   - a client may have at most per_client requests admitted or waiting, over all workers ('client')
+#   - every request has a deadline: the X-Request-Deadline header (unix seconds) of the caller, or the time the
+#     request entered the proxy (X-Request-Start) or the worker, plus timeout. A request whose expected
+#     duration no longer fits before its deadline is rejected ('deadline'), before it is analysed and again
+#     whenever it gives up waiting for a slot. The expected duration is a moving average of the seconds per
+#     report of earlier requests of the same route, times the reports of this one. Until the first request of a
+#     route has finished there is no average, so requests of that route are admitted one at a time.
+# Rejections carry a Retry-After estimate: how long the requests in front of it will take.
+#
+# The per-client counts live in a memory-mapped file per process under METRICS_DIR (admission_<pid>_<ns>.bin):
+# an int64 counter per hash slot of the client id, written only by its process and summed over the files of the
+# live processes. Checking and counting are not atomic across workers, so a client can briefly exceed its limit
+# by the number of workers. Without METRICS_DIR the counts cover the current process only.
+
+import glob
+import math
+import mmap
+import os
+import threading
+import time
+import zlib
+
+# Hash slots of the per-client counters; clients sharing a slot share a limit
+CLIENT_SLOTS = 4096
+
+# Seconds between scans of the directory for the counter files of other workers
+REFRESH_SECONDS = 1.0
+
+# Weight of the latest request in the moving average of seconds per report
+COST_WEIGHT = 0.2
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, route, client, units):
+        self.route = route
+        self.client = client
+        self.units = units
+        self.started = time.perf_counter()
+
+
+# Requests per client, admitted or waiting, over all processes writing to the directory
+class ClientCounts:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.pid = None
+        self.counts = None
+        self.path = None
+        self.others = {}
+        self.scanned = 0
+
+    # Counters of the current process; a forked worker starts its own file instead of writing to its parent's
+    def process_counts(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    if self.directory:
+                        os.makedirs(self.directory, exist_ok=True)
+                        path = os.path.join(self.directory, f'admission_{os.getpid()}_{time.time_ns()}.bin')
+                        with open(path, 'w+b') as f:
+                            f.truncate(CLIENT_SLOTS * 8)
+                            memory = mmap.mmap(f.fileno(), CLIENT_SLOTS * 8)
+                        self.path = path
+                    else:
+                        memory = mmap.mmap(-1, CLIENT_SLOTS * 8)
+                        self.path = None
+                    self.counts = memoryview(memory).cast('q')
+                    self.others = {}
+                    self.pid = os.getpid()
+        return self.counts
+
+    # Counters of the other live processes. A worker killed in the middle of a request (gunicorn timeout) leaves
+    # its counts behind, so the files of processes that no longer exist are removed.
+    def other_counts(self):
+        if not self.directory or time.monotonic() - self.scanned < REFRESH_SECONDS:
+            return list(self.others.values())
+        self.scanned = time.monotonic()
+        current = {}
+        for path in glob.glob(os.path.join(self.directory, 'admission_*.bin')):
+            if path == self.path:
+                continue
+            pid = int(os.path.basename(path).split('_')[1])
+            if not process_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if path in self.others:
+                current[path] = self.others[path]
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    memory = mmap.mmap(f.fileno(), CLIENT_SLOTS * 8, access=mmap.ACCESS_READ)
+                current[path] = memoryview(memory).cast('q')
+            except (OSError, ValueError):
+                continue
+        self.others = current
+        return list(current.values())
+
+    def count(self, client):
+        slot = client_slot(client)
+        own = self.process_counts()
+        return own[slot] + sum(counts[slot] for counts in self.other_counts())
+
+    def add(self, client, delta):
+        counts = self.process_counts()
+        with self.lock:
+            counts[client_slot(client)] += delta
+
+
+def client_slot(client):
+    return zlib.crc32(client.encode('utf-8', 'replace')) % CLIENT_SLOTS
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=4, max_queue=16, per_client=0, timeout=25.0, directory=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.timeout = timeout
+        self.clients = ClientCounts(directory)
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # Moving average of the seconds per report of each route
+        self.cost = {}
+        self.stats = {'admitted': 0, 'queued': 0, 'client': 0, 'queue_full': 0, 'deadline': 0}
+
+    # Unix time by which a request has to be answered, from its X-Request-Deadline and X-Request-Start headers
+    def deadline(self, deadline_header=None, start_header=None, now=None):
+        now = time.time() if now is None else now
+        deadline = (parse_request_start(start_header) or now) + self.timeout
+        try:
+            requested = float(deadline_header) if deadline_header else None
+        except ValueError:
+            requested = None
+        if requested is not None and math.isfinite(requested):
+            deadline = min(deadline, requested)
+        return deadline
+
+    # Expected seconds to analyse units reports on the route; 0 until a request of the route has finished
+    def expected_seconds(self, route, units=1):
+        return self.cost.get(route, 0.0) * units
+
+    # Seconds until the requests in front of a new one are expected to be done (cond is reentrant)
+    def retry_after(self, route):
+        with self.cond:
+            ahead = self.in_flight + self.waiting
+        return max(1, math.ceil(self.expected_seconds(route) * ahead / max(self.max_in_flight, 1)))
+
+    # Admit a request, waiting for a slot if needed; returns a Ticket for release(), raises Rejected
+    def admit(self, route, client, deadline, units=1):
+        expected = self.expected_seconds(route, units)
+        if time.time() + expected > deadline:
+            self.reject('deadline')
+            raise Rejected('deadline', self.retry_after(route))
+
+        if self.per_client and self.clients.count(client) >= self.per_client:
+            self.reject('client')
+            raise Rejected('client', max(1, math.ceil(expected)))
+        self.clients.add(client, 1)
+
+        try:
+            with self.cond:
+                limit = self.max_in_flight if route in self.cost else 1
+                if self.in_flight >= limit:
+                    if self.waiting >= self.max_queue:
+                        self.stats['queue_full'] += 1
+                        raise Rejected('queue_full', self.retry_after(route))
+                    self.stats['queued'] += 1
+                    self.waiting += 1
+                    try:
+                        while self.in_flight >= (self.max_in_flight if route in self.cost else 1):
+                            # Waiting longer would leave too little time to analyse the request
+                            remaining = deadline - expected - time.time()
+                            if remaining <= 0:
+                                self.stats['deadline'] += 1
+                                raise Rejected('deadline', self.retry_after(route))
+                            self.cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                self.in_flight += 1
+                self.stats['admitted'] += 1
+        except Rejected:
+            self.clients.add(client, -1)
+            raise
+        return Ticket(route, client, units)
+
+    def release(self, ticket):
+        seconds = (time.perf_counter() - ticket.started) / max(ticket.units, 1)
+        self.clients.add(ticket.client, -1)
+        with self.cond:
+            self.in_flight -= 1
+            previous = self.cost.get(ticket.route)
+            self.cost[ticket.route] = seconds if previous is None else previous + COST_WEIGHT * (seconds - previous)
+            # Waiters of different routes wait for different limits (1 until a route has a cost estimate), so the
+            # one a single notify() would wake might not be able to use the slot
+            self.cond.notify_all()
+
+    def reject(self, reason):
+        with self.cond:
+            self.stats[reason] += 1
+
+    def info(self):
+        with self.cond:
+            return {
+                'max_in_flight': self.max_in_flight, 'max_queue': self.max_queue, 'per_client': self.per_client,
+                'timeout': self.timeout, 'in_flight': self.in_flight, 'waiting': self.waiting,
+                'ms_per_report': {route: round(cost * 1000, 3) for route, cost in self.cost.items()},
+                'pid': os.getpid(), **self.stats
+            }
+
+
+# Unix seconds of an X-Request-Start header (t=<time> as set by nginx or Heroku, in seconds, ms or µs), or None
+def parse_request_start(value):
+    if not value:
+        return None
+    try:
+        start = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return None
+    if not math.isfinite(start) or start <= 0:
+        return None
+    # Scale by magnitude: 1.7e9 seconds, 1.7e12 milliseconds, 1.7e15 microseconds
+    while start > 1e11:
+        start /= 1000
+    return start
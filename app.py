@@ -1,11 +1,57 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, g, send_file
 import joblib # For loading the ML model
-import pandas as pd
 import numpy as np
+import json
+import logging
+import math
 import os
+import hmac
+import tempfile
+import time
+import warnings
+from collections import namedtuple
+
+from admission import AdmissionController, Rejected
+from assets import REVALIDATE, AssetStore, StaticBody
+from batching import MicroBatcher
+from drift import DriftMonitor
+from features import FeatureAssembler
+from forest import FlatForest, load_forest
+from metrics import CONTENT_TYPE, METRICS_DIR, REGISTRY, Counter, Histogram
+from model_bundle import DRIFT_REFERENCE_FILE, FOREST_FILE, SKLEARN_FILES
+from model_registry import ModelRegistry
+from neighbors import DEFAULT_INDEX as SIMILAR_INDEX_FILE, DEFAULT_K, MAX_K as MAX_SIMILAR, NeighborIndex
+from knowledge_base import ALIASES, KnowledgeBase
+from patient_store import STATUS_CODES, PatientStore, to_timestamp
+from population import DEFAULT_INDEX as POPULATION_INDEX_FILE, PercentileIndex
+from profiling import RequestProfiler
+from reference_ranges import ReferenceTable
+from result_cache import ResultCache, canonical_key, file_fingerprint
+
+# LOG_LEVEL=DEBUG also logs the submitted test results and model input of every request
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+logger = logging.getLogger('blood_report_analyser')
 
 app = Flask(__name__)
 
+# Metrics served on /metrics, summed over all gunicorn workers (see metrics.py)
+REQUESTS = Counter('blood_report_requests_total', 'HTTP requests handled', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('blood_report_request_seconds', 'Time spent handling a request', ['endpoint'])
+STAGE_SECONDS = Histogram('blood_report_stage_seconds',
+                          'Time spent in each analysis stage, per call (one report or one batch)', ['stage'])
+REPORTS_SCORED = Counter('blood_report_scored_reports_total', 'Reports scored by the ML model')
+ADMISSION_REJECTED = Counter('blood_report_admission_rejected_total',
+                             'Analysis requests rejected by admission control', ['endpoint', 'reason'])
+ADMISSION_DEGRADED_RESPONSES = Counter('blood_report_admission_degraded_total',
+                                       'Analysis requests answered without ML predictions by admission control',
+                                       ['endpoint', 'reason'])
+PREDICTION_FAILURES = Counter('blood_report_prediction_failures_total', 'Reports whose ML prediction failed')
+MODEL_NOT_LOADED = Counter('blood_report_model_not_loaded_total',
+                           "Reports answered with 'ML model not loaded' because no model is available")
+PREDICTED_CONDITIONS = Counter('blood_report_predicted_conditions_total',
+                               'Conditions predicted above the threshold, Normal when none was', ['condition'])
+
 
 # Blood test reference information
 BLOOD_TESTS = {
@@ -246,6 +292,14 @@ BLOOD_TESTS = {
             'male': {'min': 0, 'max': 15},
             'female': {'min': 0, 'max': 20}
         },
+        # ESR rises with age, so older patients get a wider normal range
+        'age_ranges': [
+            {
+                'min_age': 50,
+                'male': {'min': 0, 'max': 20},
+                'female': {'min': 0, 'max': 30}
+            }
+        ],
         'low': {
             'condition': 'Not clinically significant',
             'symptoms': 'None'
@@ -408,164 +462,938 @@ ABNORMALITIES = {
     }
 }
 
+# BLOOD_TESTS, ABNORMALITIES and the food suggestions CSV indexed by condition and by (test, direction)
+knowledge_base = KnowledgeBase(BLOOD_TESTS, ABNORMALITIES)
+
+# Reference ranges compiled once into dense arrays for the rule based analysis
+reference_table = ReferenceTable(BLOOD_TESTS, knowledge_base.suggestions)
+
+# Reports submitted with a patientId are kept per patient when PATIENT_STORE_PATH names a SQLite file,
+# see patient_store.py and /api/patients/<id>/trends
+PATIENT_STORE_PATH = os.environ.get('PATIENT_STORE_PATH')
+patient_store = PatientStore(PATIENT_STORE_PATH, reference_table) if PATIENT_STORE_PATH else None
+
+# Population percentiles of the analysed values, from the sketches of `python population.py build`, which the
+# server start builds into static/ml_model when missing (gunicorn.conf.py, asgi.py).
+# POPULATION_INDEX names another index file; an empty value, or a file that cannot be loaded, leaves them out
+POPULATION_INDEX = os.environ.get('POPULATION_INDEX', POPULATION_INDEX_FILE)
+
+
+def load_population_index(path):
+    if not path:
+        return None
+    try:
+        index = PercentileIndex.load(path)
+    except (OSError, ValueError, KeyError):
+        logger.warning('Population index %s could not be loaded, reports get no percentiles', path, exc_info=True)
+        return None
+    logger.info('Population index %s: %d tests', path, len(index.tests))
+    return index
+
+
+population_index = load_population_index(POPULATION_INDEX)
+
+# Most similar reference reports, from the index of `python neighbors.py build` (built into static/ml_model at server
+# start when missing), memory-mapped so the workers share its pages; SIMILAR_INDEX names another index file and an
+# empty value leaves /api/similar and ?similar= disabled
+SIMILAR_INDEX = os.environ.get('SIMILAR_INDEX', SIMILAR_INDEX_FILE)
+
+
+def load_similar_index(path):
+    if not path:
+        return None
+    try:
+        index = NeighborIndex.load(path)
+    except (OSError, ValueError, KeyError):
+        logger.warning('Similar report index %s could not be loaded, similar reports are disabled', path,
+                       exc_info=True)
+        return None
+    logger.info('Similar report index %s: %d reports', path, len(index))
+    return index
+
+
+similar_index = load_similar_index(SIMILAR_INDEX)
+
+GENERAL_RECOMMENDATIONS = [{
+    'title': 'General Health',
+    'items': [
+        'No specific recommendations needed as all values are normal',
+        'Maintain a balanced diet and regular exercise'
+    ]
+}]
+
+
+# Probability of each condition being present for every row of X, one column per entry in classes
+def condition_probabilities(model, X):
+    if isinstance(model, FlatForest):
+        return model.predict_proba(X)
+    return np.column_stack([label_probs[:, 1] for label_probs in model.predict_proba(X)])
+
 
 # Load ML model and related files
-try:
-    model = joblib.load('static/ml_model/blood_report_model.pkl') # Load the trained ML model
-    mlb = joblib.load('static/ml_model/label_binarizer.pkl') # Load the label binarizer for multi-label classification
-    imputer = joblib.load('static/ml_model/imputer.pkl') # Load the imputer for missing values
-    train_cols = joblib.load('static/ml_model/training_columns.pkl') # Load the training columns to match the input data
-    print(train_cols)
+# The files come from the bundle published by train_model.py (static/ml_model/current.json, see model_bundle.py),
+# or from static/ml_model itself when there is none. model_registry.py checks them against the bundle manifest,
+# validates the model on the bundle's golden reports and reloads it when another version is activated.
+# A flattened forest exported with `python forest.py export` is preferred: it carries the training columns,
+# imputer medians and label names, and is scored with NumPy only. Otherwise the sklearn pickles are used.
+# MODEL_ENGINE=sklearn or MODEL_ENGINE=flat forces one of the two.
+MODEL_ENGINE = os.environ.get('MODEL_ENGINE', 'auto')
+
+# Forest file of the bundle to serve; MODEL_FOREST=blood_report_forest.compact.bin serves the output of
+# `python forest.py compact`
+MODEL_FOREST = os.environ.get('MODEL_FOREST', FOREST_FILE)
+
+# The forest arrays are memory-mapped by default, so all gunicorn workers share one copy through the page cache
+MODEL_MMAP = os.environ.get('MODEL_MMAP', '1') != '0'
+
+# With MODEL_REQUIRED=1 a failed load stops the app from starting instead of serving without predictions
+MODEL_REQUIRED = os.environ.get('MODEL_REQUIRED', '0') == '1'
+
+# Seconds between checks of static/ml_model/current.json for a newly activated version; 0 disables reloads
+MODEL_RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', '5'))
+
+# Largest fraction of the golden label decisions a new model may get differently from training time
+MODEL_GOLDEN_TOLERANCE = float(os.environ.get('MODEL_GOLDEN_TOLERANCE', '0.01'))
+
+# Keep the replaced model loaded for an instant rollback (MODEL_KEEP_PREVIOUS=0 frees it instead)
+MODEL_KEEP_PREVIOUS = os.environ.get('MODEL_KEEP_PREVIOUS', '1') != '0'
+
+# POST /api/model/reload and /api/model/rollback, X-Profile and /api/profiles need this value in the
+# X-Admin-Token header; unset disables them
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Request profiles, see profiling.py: X-Profile: 1 (with the admin token) profiles that request, and
+# PROFILE_SAMPLE_RATE a random fraction of the analysis requests. PROFILE_DIR is shared by the workers and keeps
+# the newest PROFILE_CAPACITY captures; PROFILE_TRACEMALLOC_FRAMES=0 leaves out the allocation tracking.
+profiler = RequestProfiler(
+    directory=os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'blood_report_profiles')),
+    capacity=int(os.environ.get('PROFILE_CAPACITY', '50')),
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+    tracemalloc_frames=int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '25'))
+)
+PROFILED_ENDPOINTS = {'analyze', 'analyze_batch'}
 
-    print("ML model and dependencies loaded successfully")
+# Concurrent requests of a threaded worker (gunicorn --threads N) can be scored in one model call, see batching.py.
+# MODEL_BATCHING=auto enables it for the sklearn engine only; the flat forest gets no cheaper per row in batches.
+MODEL_BATCHING = os.environ.get('MODEL_BATCHING', 'auto')
+MODEL_BATCH_MAX_SIZE = int(os.environ.get('MODEL_BATCH_MAX_SIZE', '32'))
+MODEL_BATCH_WAIT_MS = float(os.environ.get('MODEL_BATCH_WAIT_MS', '2'))
+MODEL_BATCH_BYPASS = os.environ.get('MODEL_BATCH_BYPASS', '1') != '0'
 
+# Every analysed report is counted against the drift_reference.json of the serving bundle, see drift.py and
+# /api/drift; DRIFT_MONITORING=0 turns it off
+DRIFT_MONITORING = os.environ.get('DRIFT_MONITORING', '1') != '0'
+
+# Admission control of /api/analyze and /api/analyze/batch, see admission.py. Per worker ADMISSION_MAX_IN_FLIGHT
+# requests are analysed at a time and ADMISSION_MAX_QUEUE more wait (keep gunicorn --threads above their sum, or
+# set WEB_THREADS=admission, so pages and static files always find a thread). A client, named by the
+# ADMISSION_CLIENT_HEADER header or else the peer address, may have ADMISSION_PER_CLIENT requests admitted or
+# waiting over all workers (0: no limit). A request has ADMISSION_TIMEOUT seconds from its X-Request-Start, or
+# less with an earlier X-Request-Deadline, and is turned away with a 503 (429 over the client limit) and
+# Retry-After once it cannot be answered in time.
+# ADMISSION_DEGRADED=1 answers the shed requests with the rule based analysis and no ML predictions instead.
+# ADMISSION_CONTROL=0 turns it off.
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') != '0'
+ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER', 'X-Client-Id')
+ADMISSION_DEGRADED = os.environ.get('ADMISSION_DEGRADED', '0') == '1'
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '4')),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', '8')),
+    per_client=int(os.environ.get('ADMISSION_PER_CLIENT', '0')),
+    timeout=float(os.environ.get('ADMISSION_TIMEOUT', '25')),
+    directory=METRICS_DIR
+) if ADMISSION_CONTROL else None
+
+# Cache of analysis results, see result_cache.py
+# RESULT_CACHE_SIZE=0 disables it; RESULT_CACHE_PATH (e.g. /dev/shm/blood_report_cache.sqlite) shares it between workers
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('RESULT_CACHE_TTL', '600')),
+    shared_path=os.environ.get('RESULT_CACHE_PATH')
+)
+
+# Everything a request needs from one loaded bundle. A reload replaces it as a whole; requests take the current
+# one once (current_model()) and pass it along, so a report is never scored and described by two models.
+#   predict                  X -> condition probabilities, through the MicroBatcher (batcher) when batching applies
+#   recommendation_fragments response entry of every model label that resolves to a condition
+#   cache_key_tests          test names that can change the result of a report
+#   status                   engine, load and warm-up timings etc., reported by /ready and /api/model
+#   drift                    DriftMonitor of the bundle, None when it has no drift_reference.json
+ServingModel = namedtuple('ServingModel', [
+    'version', 'model_dir', 'model', 'classes', 'train_cols', 'feature_assembler', 'predict', 'batcher',
+    'recommendation_fragments', 'cache_key_tests', 'fingerprint', 'status', 'drift'
+])
+
+# Stand-in while no model could be loaded
+NO_MODEL = ServingModel(version=None, model_dir=None, model=None, classes=[], train_cols=[], feature_assembler=None,
+                        predict=None, batcher=None, recommendation_fragments={},
+                        cache_key_tests=frozenset(BLOOD_TESTS), fingerprint=None, status={}, drift=None)
+
+
+def use_flat_forest(model_dir):
+    return MODEL_ENGINE == 'flat' or (MODEL_ENGINE == 'auto' and os.path.exists(os.path.join(model_dir, MODEL_FOREST)))
+
+
+# Bundle files read by load_serving_model()
+def bundle_files(model_dir):
+    return [MODEL_FOREST] if use_flat_forest(model_dir) else SKLEARN_FILES
+
+
+def load_serving_model(model_dir, version):
+    load_started = time.perf_counter()
+    if use_flat_forest(model_dir):
+        model = load_forest(os.path.join(model_dir, MODEL_FOREST), mmap_arrays=MODEL_MMAP) # Load the flattened forest
+        classes = model.classes
+        train_cols = model.columns
+        feature_assembler = FeatureAssembler(train_cols, model.medians)
+        status = {'engine': 'flat', 'mmap': MODEL_MMAP}
+    else:
+        model = joblib.load(f'{model_dir}/blood_report_model.pkl') # Load the trained ML model
+        mlb = joblib.load(f'{model_dir}/label_binarizer.pkl') # Load the label binarizer for multi-label classification
+        imputer = joblib.load(f'{model_dir}/imputer.pkl') # Load the imputer for missing values
+        train_cols = joblib.load(f'{model_dir}/training_columns.pkl') # Load the training columns to match the input data
+        classes = list(mlb.classes_)
+        feature_assembler = FeatureAssembler.from_imputer(train_cols, imputer)
+        status = {'engine': 'sklearn', 'mmap': False}
+    logger.debug('Training columns: %s', train_cols)
+
+    # Identifies the loaded artifacts together with the rule tables, for the result cache namespace
+    paths = [os.path.join(model_dir, name) for name in bundle_files(model_dir)]
+    rules = json.dumps([BLOOD_TESTS, ABNORMALITIES, ALIASES], sort_keys=True)
+    if os.path.exists(knowledge_base.suggestions_path):
+        paths.append(knowledge_base.suggestions_path)
+    # Cached reports carry percentiles, so an index rebuilt by population.py add or merge must not serve old ones
+    if population_index is not None:
+        paths.append(POPULATION_INDEX)
+    fingerprint = file_fingerprint(paths, extra=rules)
+    recommendation_fragments = knowledge_base.recommendations_for(classes)
+    status['load_seconds'] = round(time.perf_counter() - load_started, 3)
+
+    def predict(X):
+        return condition_probabilities(model, X)
+
+    # Score one all-median row so the model pages are touched before the first request
+    warmup_started = time.perf_counter()
+    predict(feature_assembler.assemble_batch([{'Sex': 'male'}]))
+    status['warmup_seconds'] = round(time.perf_counter() - warmup_started, 3)
+
+    batcher = None
+    if MODEL_BATCHING == '1' or (MODEL_BATCHING == 'auto' and status['engine'] == 'sklearn'):
+        batcher = MicroBatcher(predict, max_batch=MODEL_BATCH_MAX_SIZE,
+                               max_wait=MODEL_BATCH_WAIT_MS / 1000, bypass_when_idle=MODEL_BATCH_BYPASS)
+    status.update(batching=batcher is not None, fingerprint=fingerprint, loaded_by_pid=os.getpid())
+
+    drift = None
+    drift_reference = os.path.join(model_dir, DRIFT_REFERENCE_FILE)
+    if DRIFT_MONITORING and os.path.exists(drift_reference):
+        drift = DriftMonitor.load(drift_reference, METRICS_DIR)
+    status['drift_monitoring'] = drift is not None
+
+    logger.info('ML model and dependencies loaded successfully (%s engine, load %ss, warm-up %ss)',
+                status['engine'], status['load_seconds'], status['warmup_seconds'])
+    return ServingModel(version, model_dir, model, classes, train_cols, feature_assembler,
+                        batcher.predict if batcher else predict, batcher, recommendation_fragments,
+                        frozenset(BLOOD_TESTS) | frozenset(train_cols), fingerprint, status, drift)
+
+
+# Results of the previous model are not served once a new one is active
+def activate_result_cache(serving):
+    result_cache.set_namespace(serving.fingerprint)
+
+
+model_registry = ModelRegistry(load_serving_model, bundle_files, golden_tolerance=MODEL_GOLDEN_TOLERANCE,
+                               keep_previous=MODEL_KEEP_PREVIOUS, on_activate=activate_result_cache)
+
+# The sklearn model was fitted on a DataFrame but is given the assembled NumPy matrix, see features.py
+warnings.filterwarnings('ignore', message='X does not have valid feature names', category=UserWarning)
+
+# Error of the first load, reported by /ready until a model is loaded
+model_load_error = None
+try:
+    model_registry.load_current()
 except Exception as e:
-    print(f"Error loading ML model files: {e}")
-    model = None
+    model_load_error = repr(e)
+    if MODEL_REQUIRED:
+        raise
+
+
+# Model serving the current request
+def current_model():
+    return model_registry.active or NO_MODEL
+
+
+# Start checking for newly activated model versions in this process
+def watch_model():
+    model_registry.ensure_watching(MODEL_RELOAD_INTERVAL)
+
+
+# Fingerprinted and compressed static files built by assets.py, referenced by the templates through asset_url()
+ASSETS = AssetStore()
+app.jinja_env.globals.update(asset_url=ASSETS.url, image_sources=ASSETS.sources)
+
+# The pages depend only on their templates and BLOOD_TESTS, so each one is rendered once per process and served
+# from memory, compressed, with an ETag (re-rendered on every request in debug mode)
+PAGES = {}
+
+
+def render_page(template, **context):
+    page = PAGES.get(template)
+    if page is None or app.debug:
+        page = PAGES[template] = StaticBody(render_template(template, **context).encode('utf-8'),
+                                            'text/html; charset=utf-8', REVALIDATE)
+    return static_response(page)
+
+
+def static_response(body):
+    status, headers, data = body.respond(request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    return Response(data, status=status, headers=headers)
 
 
 @app.route('/')
 def home():
-    return render_template('index.html')
+    return render_page('index.html')
 
 # This route is for the enter report page
 @app.route('/enter-report')
 def enter_report():
-    return render_template('enter_report.html', tests=BLOOD_TESTS)
+    return render_page('enter_report.html', tests=BLOOD_TESTS)
 
 # This route is for the results page
 @app.route('/results')
 def results():
-    return render_template('results.html')
+    return render_page('results.html')
 
 
-# Route for handling the API request to analyze blood test results
-@app.route('/api/analyze', methods=['POST'])
-def analyze():
-    data = request.get_json()
-    
-    if not data or 'gender' not in data or 'age' not in data or 'testResults' not in data:
-        return jsonify({'error': 'Missing required fields'}), 400
-    
-    gender = data['gender'].lower()
-    age = int(data['age'])
+# Hashed files of static/dist from memory with immutable cache headers; files of an earlier build from disk
+@app.route('/static/dist/<path:path>')
+def dist_asset(path):
+    body = ASSETS.get(path)
+    if body is None:
+        return app.send_static_file(f'dist/{path}')
+    return static_response(body)
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    watch_model()
+    g.profile = profiler.start(request.headers.get('X-Profile') == '1' and admin_allowed(),
+                               request.endpoint in PROFILED_ENDPOINTS)
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    capture = g.pop('profile', None)
+    if capture is not None:
+        profiler.finish(capture, profile_details(endpoint, response.status_code,
+                                                 response.calculate_content_length()))
+        response.headers['X-Profile-Id'] = capture.id
+    REQUESTS.labels(endpoint, response.status_code).inc()
+    if 'request_started' in g:
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_started)
+    return response
+
+
+# A capture is stopped in record_request(); this only catches requests that never got there
+@app.teardown_request
+def stop_profile(error):
+    capture = g.pop('profile', None)
+    if capture is not None:
+        profiler.finish(capture, dict(profile_details(request.endpoint or 'unmatched', None, None),
+                                      error=repr(error)))
+
+
+def profile_details(endpoint, status, response_bytes):
+    return {'method': request.method, 'path': request.path, 'query': request.query_string.decode('latin-1'),
+            'endpoint': endpoint, 'status': status, 'request_bytes': request.content_length,
+            'response_bytes': response_bytes}
+
+
+# Prometheus metrics of all workers
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+# Readiness probe: 200 once a model is loaded and warmed, 503 (with the load error) otherwise
+@app.route('/ready')
+def ready():
+    serving = model_registry.active
+    status = {'ready': serving is not None, 'error': None if serving else model_load_error, 'pid': os.getpid()}
+    if serving is not None:
+        status.update(serving.status, version=serving.version, model_dir=serving.model_dir)
+    return jsonify(status), 200 if serving else 503
+
+
+# Active and previous model version, load/verify/warm-up/validation timings and the recent load attempts
+@app.route('/api/model')
+def model_info():
+    return jsonify(model_registry.info())
+
+
+def admin_allowed():
+    token = request.headers.get('X-Admin-Token', '')
+    return ADMIN_TOKEN is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+# Load the version current.json points at in this worker now instead of at the next check
+@app.route('/api/model/reload', methods=['POST'])
+def model_reload():
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        model_registry.load_current()
+    except Exception as e:
+        return jsonify({'error': f'Model not loaded: {e}', 'model': model_registry.info()}), 500
+    return jsonify(model_registry.info())
+
+
+# Serve the previous model again; the other workers follow through current.json
+@app.route('/api/model/rollback', methods=['POST'])
+def model_rollback():
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        model_registry.rollback()
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(model_registry.info())
+
+
+# Stored request profiles of all workers, newest first
+@app.route('/api/profiles')
+def profiles():
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'sample_rate': profiler.sample_rate, 'capacity': profiler.capacity,
+                    'captures': profiler.list()})
+
+
+# One file of a capture: prof (cProfile stats), cpu or alloc (folded stacks) or alloc_top
+@app.route('/api/profiles/<capture_id>/<kind>')
+def profile_file(capture_id, kind):
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    path = profiler.path(capture_id, kind)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='application/octet-stream' if kind == 'prof' else 'text/plain',
+                     as_attachment=True, download_name=os.path.basename(path))
+
+
+# Maximum number of reports accepted by a single batch request
+MAX_BATCH_SIZE = 1000
+
+# Highest age accepted in a report
+MAX_AGE = 150
+
+
+# A test value: an int or float (not a bool) that is finite as a float; huge JSON integers overflow float()
+def finite_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(float(value))
+    except OverflowError:
+        return False
+
+
+# Validate a report payload and pull out the gender, age and test results
+# Raises ValueError with a message that can be sent back to the client
+def parse_report(data):
+    if not isinstance(data, dict) or 'gender' not in data or 'age' not in data or 'testResults' not in data:
+        raise ValueError('Missing required fields')
+
+    if not isinstance(data['gender'], str):
+        raise ValueError('Invalid gender')
+
+    # JSON numbers like 1e999 parse as inf, which int() rejects with OverflowError
+    try:
+        age = int(data['age'])
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Invalid age')
+    if not 0 <= age <= MAX_AGE:
+        raise ValueError('Invalid age')
+
     test_results = data['testResults']
-    
-    analysis = {}
-    abnormalities = []
-    ml_input = {'Age': age, 'Sex': gender}
-    print(test_results)
-    
-    # Rule based analysis i.e if the value is out of range, then check the condition and symptoms
+    if not isinstance(test_results, dict):
+        raise ValueError('Invalid testResults')
+
     for test_key, value in test_results.items():
-        test_info = BLOOD_TESTS.get(test_key)
-        if not test_info or value is None:
-            continue
-            
-        # Rule-based analysis
-        ref_range = test_info['ranges'].get(gender, test_info['ranges'])
+        if test_key in BLOOD_TESTS and value is not None and not finite_number(value):
+            raise ValueError(f'Invalid value for {test_key}')
 
-        # print(ref_range)
-        
-        if ref_range:
-            status = 'normal'
-            condition = symptoms = None
-            
-            if value < ref_range['min']:
-                status = 'low'
-                condition = test_info.get('low', {}).get('condition')
-                symptoms = test_info.get('low', {}).get('symptoms')
-            elif value > ref_range['max']:
-                status = 'high'
-                condition = test_info.get('high', {}).get('condition')
-                symptoms = test_info.get('high', {}).get('symptoms')
-            
-            analysis[test_key] = {
-                'name': test_info['name'],
-                'value': value,
-                'status': status,
-                'units': test_info['units'],
-                'reference_range': f"{ref_range['min']}-{ref_range['max']}",
-                'condition': condition,
-                'symptoms': symptoms
-            }
-            
-            # if status != 'Normal':
-            #     abnormalities.append({
-            #         'test': test_info['name'],
-            #         'value': f"{value} {test_info['units']}",
-            #         'status': status,
-            #         'range': f"{ref_range['min']}-{ref_range['max']}",
-            #         'condition': condition,
-            #         'symptoms': symptoms
-            #     })
-
-    # print(analysis)
-
-    # taking the input columns in the same order as the training data
-    for col in train_cols:
+    return data['gender'].lower(), age, test_results
+
+
+# Optional patientId and takenAt (ISO 8601 or unix seconds, default now) of a report payload
+# Returns None when the report has no patientId; raises ValueError like parse_report
+def parse_patient(data):
+    patient_id = data.get('patientId')
+    if patient_id is None:
+        return None
+    if not isinstance(patient_id, (str, int)) or isinstance(patient_id, bool) or str(patient_id) == '':
+        raise ValueError('Invalid patientId')
+    try:
+        taken_at = to_timestamp(data['takenAt']) if data.get('takenAt') is not None else time.time()
+    except (TypeError, ValueError):
+        raise ValueError('Invalid takenAt')
+    return str(patient_id), taken_at
+
+
+# Keep an analyzed report in the patient store
+def record_report(patient, gender, age, test_results, report_data):
+    if patient_store is None or patient is None:
+        return
+    patient_id, taken_at = patient
+    try:
+        patient_store.add_reports([{'patient_id': patient_id, 'taken_at': taken_at, 'gender': gender, 'age': age,
+                                    'testResults': test_results, 'result': report_data}])
+    except Exception:
+        logger.exception('Could not store the report of patient %s', patient_id)
+
+
+# Rule based analysis i.e if the value is out of range, then check the condition and symptoms
+def analyze_test_results(test_results, gender, age):
+    return reference_table.analyze([(test_results, gender, age)])[0]
+
+
+# taking the input columns in the same order as the training data
+def build_ml_input(test_results, gender, age, serving=None):
+    ml_input = {'Age': age, 'Sex': gender}
+
+    for col in (serving or current_model()).train_cols:
         if col in test_results:
             ml_input[col] = test_results[col]
-    
-    print(ml_input)
 
-    # ML model prediction
-    ml_predictions = predict_abnormalities(ml_input)
+    return ml_input
+
 
+# Combine the rule based analysis and the ML predictions into the response for one report
+# explanations (from explain_predictions()) is only added to the response when given
+def build_report(gender, age, analysis, ml_predictions, serving=None, explanations=None):
     # Health summary generation (but not implemented in Frontend yet)
-    summary = generate_health_summary(analysis, gender, age)
-    
+    with STAGE_SECONDS.labels('summary').time():
+        summary = generate_health_summary(analysis, gender, age)
+
     # recommendations = generate_range_recommendations(analysis)
 
     # Rule based recommendations
-    recommendations = generate_recommendations(ml_predictions)
-    
+    with STAGE_SECONDS.labels('recommendations').time():
+        recommendations = generate_recommendations(ml_predictions, serving)
+
+    with STAGE_SECONDS.labels('percentiles').time():
+        percentiles = population_percentiles(analysis, gender, age)
+
     report_data = {
         'gender': gender,
         'age': age,
         'analysis': analysis,
-        'abnormalities': abnormalities,
+        'abnormalities': [],
         'ml_predictions': ml_predictions,
         'recommendations': recommendations,
-        'summary': summary
+        'summary': summary,
+        'percentiles': percentiles
     }
-    
+    if explanations is not None:
+        report_data['explanations'] = explanations
+    return report_data
+
+
+# {test: {'percentile', 'group', 'n'}} of the analysed values within the sex and age band of the report
+def population_percentiles(analysis, gender, age):
+    if population_index is None:
+        return {}
+    return population_index.report({test: entry['value'] for test, entry in analysis.items()}, gender, age)
+
+
+# ?explain=true on /api/analyze and /api/analyze/batch adds the explanations of the predicted conditions
+def explain_requested(value):
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+
+# ?similar=k on /api/analyze and /api/analyze/batch adds the k most similar reference reports, at most MAX_SIMILAR
+def similar_requested(value):
+    try:
+        k = int(value or 0)
+    except ValueError:
+        return 0
+    return min(max(k, 0), MAX_SIMILAR)
+
+
+# {'exact', 'neighbors'} of the k reference reports closest to each (test_results, gender, age)
+def similar_reports(reports, k):
+    if similar_index is None:
+        return [{'error': 'Similar report index is not loaded'}] * len(reports)
+    with STAGE_SECONDS.labels('similar').time():
+        return similar_index.query([{'Age': age, 'Sex': gender, **test_results}
+                                    for test_results, gender, age in reports], k)
+
+
+# Route for handling the API request to analyze blood test results
+@app.route('/api/analyze', methods=['POST'])
+def analyze():
+    data = request.get_json()
+    explain, similar = explain_requested(request.args.get('explain')), similar_requested(request.args.get('similar'))
+    report_data, status, headers = admitted('analyze', 1, lambda: analyze_payload(data, explain, similar),
+                                            lambda reason: rules_only_payload(data, reason))
+    return jsonify(report_data), status, headers
+
+
+# Run compute() once admission control lets the request in; returns (body, status, headers)
+# A shed request gets degrade(reason) with ADMISSION_DEGRADED=1 while its deadline has not passed, else a 503
+# (429 when its client is over the limit) with Retry-After
+def admitted(endpoint, reports, compute, degrade):
+    if admission is None:
+        return compute() + ({},)
+    deadline = admission.deadline(request.headers.get('X-Request-Deadline'), request.headers.get('X-Request-Start'))
+    client = (request.headers.get(ADMISSION_CLIENT_HEADER) or request.remote_addr or '').split(',')[0].strip()
+    try:
+        ticket = admission.admit(endpoint, client, deadline, reports)
+    except Rejected as e:
+        if ADMISSION_DEGRADED and e.reason != 'client' and time.time() < deadline:
+            ADMISSION_DEGRADED_RESPONSES.labels(endpoint, e.reason).inc()
+            return degrade(e.reason) + ({'X-Degraded': e.reason},)
+        ADMISSION_REJECTED.labels(endpoint, e.reason).inc()
+        status = 429 if e.reason == 'client' else 503
+        body = {'error': 'Too many requests, retry later', 'reason': e.reason}
+        return body, status, {'Retry-After': str(e.retry_after)}
+    try:
+        return compute() + ({},)
+    finally:
+        admission.release(ticket)
+
+
+# Response body and status code of /api/analyze for a parsed JSON payload; also used by the pool workers of asgi.py
+# similar reports are looked up for every request, so the cached report is copied rather than extended
+def analyze_payload(data, explain=False, similar=0):
+    try:
+        gender, age, test_results = parse_report(data)
+        patient = parse_patient(data)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    logger.debug('Test results: %s', test_results)
+    serving = current_model()
+
+    # Repeated submissions of the same panel are answered from the result cache
+    cache_key = report_cache_key(gender, age, test_results, serving, explain)
+    report_data = result_cache.get(cache_key, serving.fingerprint)
+    if report_data is not None:
+        record_drift(serving, [(test_results, gender, age, report_data)])
+        record_report(patient, gender, age, test_results, report_data)
+        if similar:
+            report_data = dict(report_data, similar_reports=similar_reports([(test_results, gender, age)], similar)[0])
+        return report_data, 200
+
+    with STAGE_SECONDS.labels('rules').time():
+        analysis = analyze_test_results(test_results, gender, age)
+
+    ml_input = build_ml_input(test_results, gender, age, serving)
+    logger.debug('Model input: %s', ml_input)
+
+    # ML model prediction
+    ml_predictions = predict_abnormalities(ml_input, serving)
+    explanations = explain_predictions([ml_input], [ml_predictions], serving)[0] if explain else None
+
+    report_data = build_report(gender, age, analysis, ml_predictions, serving, explanations)
+    cache_report(cache_key, report_data, serving)
+    record_drift(serving, [(test_results, gender, age, report_data)])
+    record_report(patient, gender, age, test_results, report_data)
+    if similar:
+        report_data = dict(report_data, similar_reports=similar_reports([(test_results, gender, age)], similar)[0])
+
     # session['report_data'] = report_data
-    
-    return jsonify(report_data)
+
+    return report_data, 200
+
+
+# Route for analyzing many reports in one request
+# Accepts {"reports": [...]} (or a bare list) where each item has the same shape as the /api/analyze payload
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    data = request.get_json()
+    reports = data.get('reports') if isinstance(data, dict) else data
+
+    if not isinstance(reports, list) or not reports:
+        return jsonify({'error': 'Expected a non-empty list of reports'}), 400
+    if len(reports) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'Batch size exceeds the limit of {MAX_BATCH_SIZE} reports'}), 413
+
+    explain, similar = explain_requested(request.args.get('explain')), similar_requested(request.args.get('similar'))
+
+    def compute():
+        results = analyze_reports(reports, explain, similar)
+        store_batch(reports, results)
+        return {'results': results}, 200
+
+    body, status, headers = admitted('analyze_batch', len(reports), compute,
+                                     lambda reason: ({'results': analyze_rules_only(reports, reason)}, 200))
+    return jsonify(body), status, headers
+
+
+# Reports with a patientId are kept in the patient store, in one transaction
+def store_batch(reports, results):
+    if patient_store is None:
+        return
+    stored = []
+    for i, data in enumerate(reports):
+        if 'error' in results[i]:
+            continue
+        try:
+            patient = parse_patient(data)
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+            continue
+        if patient is not None:
+            stored.append({'patient_id': patient[0], 'taken_at': patient[1], 'gender': results[i]['gender'],
+                           'age': results[i]['age'], 'testResults': data['testResults'], 'result': results[i]})
+    try:
+        patient_store.add_reports(stored)
+    except Exception:
+        logger.exception('Could not store %d reports', len(stored))
+
+
+# Analyze a list of report payloads with a single ML model call over all valid reports
+# Each result has the same shape as the /api/analyze response, or {'error': ...} for an invalid report
+def analyze_reports(reports, explain=False, similar=0):
+    results = [None] * len(reports)
+    parsed, valid = [], []
+    serving = current_model()
+
+    for i, data in enumerate(reports):
+        try:
+            gender, age, test_results = parse_report(data)
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+            continue
+        valid.append((i, gender, age, test_results))
+
+        cache_key = report_cache_key(gender, age, test_results, serving, explain)
+        results[i] = result_cache.get(cache_key, serving.fingerprint)
+        if results[i] is None:
+            parsed.append((i, cache_key, gender, age, test_results))
+
+    # Rule based analysis of all reports as one matrix
+    with STAGE_SECONDS.labels('rules').time():
+        analyses = reference_table.analyze([(test_results, gender, age)
+                                            for _, _, gender, age, test_results in parsed])
+
+    ml_inputs = [build_ml_input(test_results, gender, age, serving) for _, _, gender, age, test_results in parsed]
+    ml_predictions = predict_abnormalities_batch(ml_inputs, serving)
+    explanations = explain_predictions(ml_inputs, ml_predictions, serving) if explain else [None] * len(parsed)
+
+    for (i, cache_key, gender, age, _), analysis, predictions, explanation in zip(parsed, analyses, ml_predictions,
+                                                                                  explanations):
+        results[i] = build_report(gender, age, analysis, predictions, serving, explanation)
+        cache_report(cache_key, results[i], serving)
+
+    record_drift(serving, [(test_results, gender, age, results[i]) for i, gender, age, test_results in valid])
+    if similar:
+        neighbors = similar_reports([(test_results, gender, age) for _, gender, age, test_results in valid], similar)
+        for (i, _, _, _), entry in zip(valid, neighbors):
+            results[i] = dict(results[i], similar_reports=entry)
+    return results
+
+
+# The rule based part of analyze_reports() alone, for requests shed by admission control: every report gets its
+# analysis, summary and percentiles, with the ML predictions replaced by an error naming the reason. Nothing is
+# cached, counted for drift or stored for the patient.
+def analyze_rules_only(reports, reason):
+    results, parsed = [None] * len(reports), []
+    for i, data in enumerate(reports):
+        try:
+            gender, age, test_results = parse_report(data)
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+            continue
+        parsed.append((i, gender, age, test_results))
+
+    with STAGE_SECONDS.labels('rules').time():
+        analyses = reference_table.analyze([(test_results, gender, age) for _, gender, age, test_results in parsed])
+    predictions = {'Error': f'ML predictions skipped, the server is busy ({reason})'}
+    for (i, gender, age, _), analysis in zip(parsed, analyses):
+        results[i] = dict(build_report(gender, age, analysis, predictions), degraded=True)
+    return results
+
+
+def rules_only_payload(data, reason):
+    report_data = analyze_rules_only([data], reason)[0]
+    return report_data, 400 if 'error' in report_data else 200
+
+
+# Count analysed reports, (test_results, gender, age, report_data) tuples, in the drift monitor of the model
+def record_drift(serving, reports):
+    if serving.drift is not None:
+        serving.drift.record([(test_results, gender, age, report_data['ml_predictions'])
+                              for test_results, gender, age, report_data in reports])
+
+
+# Canonical cache key of a report; only the tests the pipeline reads take part in it
+def report_cache_key(gender, age, test_results, serving=None, explain=False):
+    key = canonical_key(gender, age, test_results, (serving or current_model()).cache_key_tests)
+    return f'{key}:explain' if explain else key
+
+
+# Results computed without a working model are not cached, so they are not served once it is back
+def cache_report(cache_key, report_data, serving=None):
+    if 'Error' not in report_data['ml_predictions']:
+        result_cache.put(cache_key, report_data, (serving or current_model()).fingerprint)
+
+
+# Latest values of a patient's tests, newest first: ?tests=Hemoglobin,PLT&limit=10
+@app.route('/api/patients/<patient_id>/trends')
+def patient_trends(patient_id):
+    if patient_store is None:
+        return jsonify({'error': 'Patient store is disabled (set PATIENT_STORE_PATH)'}), 404
+    tests = request.args.get('tests')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 1000)
+    trends = patient_store.trends(patient_id, tests.split(',') if tests else None, limit)
+    if trends is None:
+        return jsonify({'error': 'Unknown patient'}), 404
+    return jsonify(trends)
+
+
+# Patients whose test changed status recently: ?test=PLT&from=normal&to=low&days=90
+@app.route('/api/patients/changes')
+def patient_changes():
+    if patient_store is None:
+        return jsonify({'error': 'Patient store is disabled (set PATIENT_STORE_PATH)'}), 404
+    test, from_status, to_status = request.args.get('test'), request.args.get('from'), request.args.get('to')
+    if test not in BLOOD_TESTS or from_status not in STATUS_CODES or to_status not in STATUS_CODES:
+        return jsonify({'error': f"Expected test, from and to (one of {', '.join(STATUS_CODES)})"}), 400
+    since = time.time() - request.args.get('days', 90, type=float) * 86400
+    limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+    return jsonify({'changes': patient_store.changes(test, from_status, to_status, since, limit)})
+
+
+# The k reference reports most similar to a report (same payload as /api/analyze): ?k=5
+@app.route('/api/similar', methods=['POST'])
+def similar():
+    if similar_index is None:
+        return jsonify({'error': 'Similar report index is disabled (see neighbors.py and SIMILAR_INDEX)'}), 404
+    try:
+        gender, age, test_results = parse_report(request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    k = min(max(request.args.get('k', DEFAULT_K, type=int), 1), MAX_SIMILAR)
+    return jsonify({'k': k, 'reports': len(similar_index), **similar_reports([(test_results, gender, age)], k)[0]})
+
+
+# Hit/miss/eviction counters of the result cache
+@app.route('/api/cache')
+def cache_stats():
+    return jsonify(result_cache.info())
+
+
+# Drift of the analysed reports from the training data of the serving model, summed over all workers
+@app.route('/api/drift')
+def drift_report():
+    serving = current_model()
+    if serving.drift is None:
+        return jsonify({'enabled': False, 'model_version': serving.version})
+    return jsonify({'enabled': True, 'model_version': serving.version, **serving.drift.report()})
+
+
+# Limits, load and rejections of the admission control of this worker
+@app.route('/api/admission')
+def admission_stats():
+    return jsonify(admission.info() if admission else {'enabled': False})
+
+
+# Batch size and queue wait metrics of the micro-batching scheduler
+@app.route('/api/batching')
+def batching_stats():
+    batcher = current_model().batcher
+    return jsonify(batcher.info() if batcher else {'enabled': False})
 
 
 # Preprocessing the given data as per the model requirements and predict the abnormalities
-def predict_abnormalities(patient_data):
-    if model is None:
-        return {'Error': 'ML model not loaded'}
-    
+def predict_abnormalities(patient_data, serving=None):
+    return predict_abnormalities_batch([patient_data], serving)[0]
+
+
+# Same as predict_abnormalities but for a list of patients, with one predict_proba call over the whole matrix
+def predict_abnormalities_batch(patients, serving=None):
+    serving = serving or current_model()
+    if serving.model is None:
+        MODEL_NOT_LOADED.inc(len(patients))
+        return [{'Error': 'ML model not loaded'} for _ in patients]
+    if not patients:
+        return []
+
     try:
-        patient_df = pd.DataFrame([patient_data])
-        num_cols = patient_df.select_dtypes(include=np.number).columns
-        # print(train_cols)
-        # print(num_cols)
-        patient_df[num_cols] = imputer.transform(patient_df[num_cols])
-        patient_df = pd.get_dummies(patient_df, columns=['Sex'])
-        
-        missing_cols = set(train_cols) - set(patient_df.columns)
-        for col in missing_cols:
-            patient_df[col] = 0
-        patient_df = patient_df[train_cols]
-        # print(patient_df.columns)
-        probs = model.predict_proba(patient_df)
-        predictions = {}
-        
-        for i, condition in enumerate(mlb.classes_):
-            prob = probs[i][0][1]
-            if prob > 0.9:  # Adjust threshold as needed
-                predictions[condition] = round(prob, 4)*100
-        
-        return predictions or {'Normal': 100}
-    except Exception as e:
-        print(f"Prediction error: {e}")
-        return {'Error': 'Prediction failed'}
-    
+        with STAGE_SECONDS.labels('preprocessing').time():
+            X = serving.feature_assembler.assemble_batch(patients)
+        # Probability of each condition being present, one column per entry in classes
+        with STAGE_SECONDS.labels('inference').time():
+            positive = serving.predict(X)
+    except Exception:
+        if len(patients) > 1:
+            # Fall back to one row at a time so a single bad report only fails itself
+            return [predict_abnormalities(patient, serving) for patient in patients]
+        logger.exception('Prediction error')
+        PREDICTION_FAILURES.inc()
+        return [{'Error': 'Prediction failed'}]
+
+    REPORTS_SCORED.inc(len(patients))
+    predictions = []
+    for row in positive:
+        row_predictions = {}
+        for i in np.flatnonzero(row > 0.9):  # Adjust threshold as needed
+            row_predictions[serving.classes[i]] = round(row[i], 4)*100
+        predictions.append(row_predictions or {'Normal': 100})
+        for condition in predictions[-1]:
+            PREDICTED_CONDITIONS.labels(condition).inc()
+
+    return predictions
+
+
+# Which tests drove each reported condition, one dict per patient: condition -> probability and base (percent,
+# like ml_predictions) and the contribution of every model input in percentage points, largest first.
+# base plus the contributions gives the probability. Needs the flat forest engine, see FlatForest.explain().
+def explain_predictions(patients, predictions, serving=None):
+    serving = serving or current_model()
+    if serving.model is None:
+        return [{'Error': 'ML model not loaded'} for _ in patients]
+    if not isinstance(serving.model, FlatForest):
+        return [{'Error': 'Explanations need the flat forest engine'} for _ in patients]
+
+    label_index = {name: i for i, name in enumerate(serving.classes)}
+    pairs = [(row, label_index[condition]) for row, row_predictions in enumerate(predictions)
+             for condition in row_predictions if condition in label_index]
+    with STAGE_SECONDS.labels('explain').time():
+        X = serving.feature_assembler.assemble_batch(patients)
+        bias, contributions = serving.model.explain(X, pairs)
+
+        # The one-hot Sex columns are reported as one input
+        tests, test_of_column = [], []
+        for col in serving.train_cols:
+            test = 'Sex' if col.startswith('Sex_') else col
+            if test not in tests:
+                tests.append(test)
+            test_of_column.append(tests.index(test))
+        percent = np.round(contributions @ np.eye(len(tests))[test_of_column] * 100, 2)
+        order = np.argsort(-np.abs(percent), axis=1, kind='stable').tolist()
+        probability = np.round((bias + contributions.sum(axis=1)) * 100, 2).tolist()
+        base = np.round(bias * 100, 2).tolist()
+        percent = percent.tolist()
+
+        explanations = [{} for _ in patients]
+        inputs = {}
+        for k, (row, label) in enumerate(pairs):
+            if row not in inputs:
+                # Tests that were not submitted entered the model as the training median
+                inputs[row] = [(patients[row][test], True) if patients[row].get(test) is not None else
+                               (float(X[row, serving.feature_assembler.value_positions[test]]), False)
+                               for test in tests]
+            items = [{'test': tests[j], 'value': inputs[row][j][0], 'submitted': inputs[row][j][1],
+                      'contribution': percent[k][j]} for j in order[k] if percent[k][j] != 0]
+            explanations[row][serving.classes[label]] = {'probability': probability[k], 'base': base[k],
+                                                         'contributions': items}
+    return explanations
+
 
 def generate_health_summary(analysis, gender, age):
     abnormalities = []
@@ -593,39 +1421,25 @@ def generate_health_summary(analysis, gender, age):
                 summary.append(f"- High {ab['test']} ({ab['value']}, normal range: {ab['reference_range']})")
     
     # Add age/gender specific notes
-    if age > 50:
-        summary.append("\nNote: Some reference ranges may vary slightly for your age group.")
+    adjusted_tests = [test for test in reference_table.age_adjusted_tests(gender, age) if test in analysis]
+    if adjusted_tests:
+        summary.append(f"\nNote: Age-adjusted reference ranges were used for {', '.join(adjusted_tests)}.")
     
     return "\n".join(summary)
 
 
 # Rule based recommendations table
-def generate_recommendations(ml_predictions):
-    recommendations = []
-    conditions_found = set()
-    
+# The entries come precomputed from the model's recommendation_fragments; only the confidence is added per report
+def generate_recommendations(ml_predictions, serving=None):
     if len(ml_predictions) == 0 or (len(ml_predictions) == 1 and 'Normal' in ml_predictions):
-        recommendations.append({
-            'title': 'General Health',
-            'items': [
-                'No specific recommendations needed as all values are normal',
-                'Maintain a balanced diet and regular exercise'
-            ]
-        })
-    else:
-        for condition, prob in ml_predictions.items():
-            if condition == 'Normal':
-                continue
-            if condition in ABNORMALITIES:
-                condition_data = ABNORMALITIES.get(condition)
-                recommendations.append({
-                    'title': f"For {condition.title()}",
-                    'condition': condition,
-                    'confidence': prob,
-                    'description': condition_data['description'],
-                    'items': condition_data['recommendations']
-                })
-    
+        return GENERAL_RECOMMENDATIONS
+
+    recommendation_fragments = (serving or current_model()).recommendation_fragments
+    recommendations = []
+    for condition, prob in ml_predictions.items():
+        fragment = recommendation_fragments.get(condition)
+        if fragment is not None:
+            recommendations.append({**fragment, 'confidence': prob})
     return recommendations
 
 
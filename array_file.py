@@ -0,0 +1,60 @@
+# Binary container for named numpy arrays plus JSON metadata, used for the flattened forest and the population
+# percentile index
+#
+# Layout: an 8 byte magic, the uint64 length of a JSON header ({'arrays': {name: dtype, shape, offset}, 'meta'}),
+# the header, then the raw arrays, each starting at a multiple of ALIGNMENT from the 64-byte aligned data start.
+# Files are written next to the target and renamed, so a loading app never reads a partial file.
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+ALIGNMENT = 64
+
+
+def write_arrays(path, magic, arrays, meta):
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({'arrays': layout, 'meta': meta}).encode('utf-8')
+    data_start = -(-(len(magic) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    staging = f'{path}.{os.getpid()}.tmp'
+    with open(staging, 'wb') as f:
+        f.write(magic)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(staging, path)
+
+
+# (arrays, meta) of a file; with mmap_arrays=True the arrays are read-only views of the mapped file
+# Raises ValueError if the file does not start with magic
+def read_arrays(path, magic, mmap_arrays=False):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {magic.decode()} file')
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length))
+        data_start = -(-(len(magic) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        if mmap_arrays:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            f.seek(0)
+            buffer = f.read()
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                     offset=data_start + spec['offset']).reshape(spec['shape'])
+    return arrays, header['meta']
@@ -0,0 +1,309 @@
+# ASGI serving mode: HTTP on an event loop, rules and model inference in a pool of warmed processes
+#
+# Usage:
+#   uvicorn asgi:app --host 0.0.0.0 --port 8000                  # ANALYSIS_WORKERS defaults to the CPU count
+#   ANALYSIS_WORKERS=4 uvicorn asgi:app --port 8000
+#
+# The procfile setup (gunicorn sync workers) ties a worker to one request from its first byte to its last,
+# including the time a slow client takes to upload the report or read the answer. Here the event loop reads
+# requests, parses the JSON and writes responses for any number of connections, and only the CPU-bound part,
+# analyze_payload() of app.py, is sent to a worker process. Every worker imports app.py once at startup,
+# which loads and warms static/ml_model; this process never loads the model. The data files app.py reads at import
+# and that are not versioned (the population and similar report indexes) are built first when missing, in a
+# process of their own.
+# The pages are rendered once by a worker through the Flask app and then served from memory, like the built files
+# of static/dist (see assets.py), compressed and with cache headers.
+#
+# /api/analyze goes through the admission control of admission.py before it is sent to the pool, with the
+# ADMISSION_* settings of app.py: ADMISSION_MAX_IN_FLIGHT (default ANALYSIS_WORKERS) requests at a time,
+# ADMISSION_MAX_QUEUE more waiting, per-client limits and deadlines, answered with a 503 or 429 and Retry-After.
+# ADMISSION_DEGRADED is not supported here, shed requests are always rejected.
+#
+# Served routes: /, /enter-report, /results, /api/analyze, /api/admission, /ready and the files under /static.
+
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from admission import AdmissionController, Rejected
+from assets import REVALIDATE, AssetStore, StaticBody, ensure_assets
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', os.cpu_count()))
+MAX_BODY_BYTES = 1024 * 1024
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') != '0'
+ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER', 'X-Client-Id')
+
+PAGES = ['/', '/enter-report', '/results']
+
+logger = logging.getLogger('blood_report_analyser.asgi')
+
+# app.py, imported in each pool process by init_worker()
+analyzer = None
+
+
+def init_worker():
+    global analyzer
+    # app.py loads the model artifacts relative to the project directory
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    import app
+    analyzer = app
+    # Every worker follows newly activated model versions on its own, see model_registry.py
+    analyzer.watch_model()
+
+
+# Pool tasks; they return bytes so the event loop only has to write them out
+
+def worker_status():
+    # Long enough that the tasks sent at startup spread over all the processes
+    time.sleep(0.05)
+    return os.getpid(), analyzer.model_registry.active is not None
+
+
+def render_page(path):
+    response = analyzer.app.test_client().get(path)
+    return response.status_code, response.data
+
+
+# query holds the raw ?explain= and ?similar= values
+def analyze(data, query):
+    report_data, status = analyzer.analyze_payload(data, analyzer.explain_requested(query.get('explain')),
+                                                   analyzer.similar_requested(query.get('similar')))
+    return status, analyzer.app.json.dumps(report_data).encode('utf-8')
+
+
+# Run in a one-off process, so this one does not import pandas
+def ensure_indexes():
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    from neighbors import ensure_index as ensure_similar_index
+    from population import ensure_index as ensure_population_index
+    ensure_population_index()
+    ensure_similar_index()
+
+
+def json_body(data):
+    return json.dumps(data).encode('utf-8')
+
+
+class AnalysisServer:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.pages = {}
+        self.assets = None
+        self.model_ready = False
+        self.starting = None
+        self.warming = None
+        self.admission = None
+        # AdmissionController.admit() blocks while a request waits for a slot, so it runs on these threads
+        self.admission_threads = None
+        if ADMISSION_CONTROL:
+            self.admission = AdmissionController(
+                max_in_flight=int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', workers)),
+                max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', '8')),
+                per_client=int(os.environ.get('ADMISSION_PER_CLIENT', '0')),
+                timeout=float(os.environ.get('ADMISSION_TIMEOUT', '25'))
+            )
+            self.admission_threads = ThreadPoolExecutor(self.admission.max_in_flight + self.admission.max_queue)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        # Built before the workers start, since the pages they render link to the built files
+        await asyncio.to_thread(ensure_assets, STATIC_DIR)
+        self.assets = await asyncio.to_thread(AssetStore, STATIC_DIR)
+        with ProcessPoolExecutor(max_workers=1) as builder:
+            await loop.run_in_executor(builder, ensure_indexes)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        await self.warm_up(self.pool)
+        for path in PAGES:
+            status, body = await loop.run_in_executor(self.pool, render_page, path)
+            self.pages[path] = status, StaticBody(body, 'text/html; charset=utf-8', REVALIDATE)
+
+    # One task per worker starts and warms every process of the pool before it gets requests
+    async def warm_up(self, pool):
+        loop = asyncio.get_running_loop()
+        statuses = await asyncio.gather(*[loop.run_in_executor(pool, worker_status) for _ in range(self.workers)])
+        if pool is self.pool:
+            self.model_ready = all(ready for _, ready in statuses)
+        logger.info('%d analysis workers ready (pids %s)', self.workers, sorted({pid for pid, _ in statuses}))
+
+    # Replace a broken pool by a fresh, warmed one. Every request that was running on it sees the failure,
+    # so only the first of them replaces it; the others find self.pool already moved on.
+    def restart_pool(self, broken):
+        if self.pool is not broken:
+            return
+        logger.error('Analysis worker pool broke, restarting it')
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.model_ready = False
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        self.warming = asyncio.create_task(self.rewarm(self.pool))
+
+    async def rewarm(self, pool):
+        try:
+            await self.warm_up(pool)
+        except Exception:
+            logger.exception('Could not warm the restarted analysis workers')
+
+    async def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        if self.admission_threads is not None:
+            self.admission_threads.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except Exception as e:
+                    logger.exception('Could not start the analysis workers')
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        # Servers without lifespan support start the pool on the first request
+        if self.pool is None:
+            if self.starting is None:
+                self.starting = asyncio.ensure_future(self.start())
+            await asyncio.shield(self.starting)
+
+        path, method = scope['path'], scope['method']
+
+        if path in PAGES:
+            if method not in ('GET', 'HEAD'):
+                return await self.respond(send, 405, json_body({'error': 'Method not allowed'}), allow='GET, HEAD')
+            status, page = self.pages[path]
+            if status != 200:
+                return await self.respond(send, status, page.bodies[None], page.content_type, head=method == 'HEAD')
+            return await self.respond_static(scope, send, page, head=method == 'HEAD')
+
+        if path == '/api/analyze':
+            if method != 'POST':
+                return await self.respond(send, 405, json_body({'error': 'Method not allowed'}), allow='POST')
+            query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            return await self.analyze(scope, receive, send, {name: values[0] for name, values in query.items()})
+
+        if path == '/api/admission':
+            info = self.admission.info() if self.admission else {'enabled': False}
+            return await self.respond(send, 200, json_body(info))
+
+        if path == '/ready':
+            status = {'ready': self.model_ready, 'workers': self.workers, 'pid': os.getpid()}
+            return await self.respond(send, 200 if self.model_ready else 503, json_body(status))
+
+        if path.startswith('/static/') and method in ('GET', 'HEAD'):
+            return await self.static(scope, path, send, head=method == 'HEAD')
+
+        await self.respond(send, 404, json_body({'error': 'Not found'}))
+
+    async def analyze(self, scope, receive, send, query):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                return await self.respond(send, 413, json_body({'error': 'Request body too large'}))
+            if not message.get('more_body'):
+                break
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return await self.respond(send, 400, json_body({'error': 'Invalid JSON'}))
+
+        ticket = None
+        if self.admission is not None:
+            try:
+                ticket = await self.admit(scope)
+            except Rejected as e:
+                status = 429 if e.reason == 'client' else 503
+                body = json_body({'error': 'Too many requests, retry later', 'reason': e.reason})
+                headers = [('Content-Type', 'application/json'), ('Retry-After', str(e.retry_after))]
+                return await self.respond(send, status, body, headers=headers)
+
+        pool = self.pool
+        try:
+            status, response = await asyncio.get_running_loop().run_in_executor(pool, analyze, data, query)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool for the next requests
+            self.restart_pool(pool)
+            return await self.respond(send, 503, json_body({'error': 'Analysis worker restarted, retry'}))
+        finally:
+            if ticket is not None:
+                self.admission.release(ticket)
+        await self.respond(send, status, response)
+
+    # Ticket of an admitted /api/analyze request, named and timed from its headers like in app.py; raises Rejected
+    async def admit(self, scope):
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        deadline = self.admission.deadline(headers.get('x-request-deadline'), headers.get('x-request-start'))
+        peer = scope.get('client')[0] if scope.get('client') else ''
+        client = (headers.get(ADMISSION_CLIENT_HEADER.lower()) or peer).split(',')[0].strip()
+        return await asyncio.get_running_loop().run_in_executor(self.admission_threads, self.admission.admit,
+                                                                'analyze', client, deadline)
+
+    async def static(self, scope, path, send, head):
+        body = self.assets.get(path[len('/static/dist/'):]) if path.startswith('/static/dist/') else None
+        if body is not None:
+            return await self.respond_static(scope, send, body, head)
+
+        # static/ml_model holds the model artifacts, which are not web assets
+        file_path = os.path.realpath(os.path.join(APP_DIR, path.lstrip('/')))
+        if (not file_path.startswith(STATIC_DIR + os.sep) or file_path.startswith(os.path.join(STATIC_DIR, 'ml_model'))
+                or not os.path.isfile(file_path)):
+            return await self.respond(send, 404, json_body({'error': 'Not found'}))
+
+        body = await asyncio.to_thread(read_file, file_path)
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        await self.respond(send, 200, body, content_type, head=head)
+
+    async def respond_static(self, scope, send, body, head):
+        request_headers = dict(scope['headers'])
+        status, headers, data = body.respond(request_headers.get(b'accept-encoding', b'').decode('latin-1'),
+                                             request_headers.get(b'if-none-match', b'').decode('latin-1'))
+        await self.respond(send, status, data, head=head, headers=headers)
+
+    @staticmethod
+    async def respond(send, status, body, content_type='application/json', head=False, allow=None, headers=None):
+        if headers is None:
+            headers = [('Content-Type', content_type)]
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        headers.append((b'content-length', str(len(body)).encode()))
+        if allow:
+            headers.append((b'allow', allow.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if head else bytes(body)})
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+app = AnalysisServer(ANALYSIS_WORKERS)
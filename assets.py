@@ -0,0 +1,327 @@
+# Asset pipeline: fingerprinted, precompressed CSS/JS and resized image variants in static/dist
+#
+# Usage:
+#   python assets.py                 # build static/dist (only what changed) and print the sizes
+#   python assets.py --force         # rebuild everything
+#
+# Every CSS and JS file under static/css and static/js is copied to static/dist with a content hash in its name
+# (css/style.1a2b3c4d5e.css), next to a gzip copy and, with the brotli package installed, a brotli copy. Every
+# image listed in IMAGES is resized to each width in IMAGE_WIDTHS and saved as AVIF, WebP and JPEG, with the hash
+# of the source image in the names. static/dist/manifest.json maps each source file to what was built from it,
+# together with the hash of the source, so a source edited after the build is noticed.
+#
+# Hashed files never change, so they are served with a one-year immutable Cache-Control and an ETag. AssetStore
+# holds them in memory with their compressed copies and picks the encoding from Accept-Encoding; app.py and
+# asgi.py serve /static/dist from it. StaticBody does the same for the rendered HTML pages, which keep their
+# URLs and are revalidated with the ETag instead. Pillow (images) and brotli are only needed to build.
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from model_bundle import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = 'static'
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+
+TEXT_PATTERNS = ['css/*.css', 'js/*.js']
+IMAGES = ['images/frstpage.png']
+IMAGE_WIDTHS = [640, 1024, 1536]
+
+# Image formats, best first; the last one is the <img src> fallback every browser can show
+IMAGE_FORMATS = {
+    'avif': ('AVIF', 'image/avif', {'quality': 50, 'speed': 6}),
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 6}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True})
+}
+
+CONTENT_TYPES = {
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+    '.avif': 'image/avif',
+    '.webp': 'image/webp',
+    '.jpeg': 'image/jpeg'
+}
+
+# Content-Encoding tokens in order of preference, with the suffix of the precompressed copies
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+HASH_LENGTH = 10
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def hashed_name(name, digest, suffix=None):
+    stem, extension = os.path.splitext(name)
+    return f'{stem}{suffix or ""}.{digest}{extension}'
+
+
+def compress(data):
+    encoded = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data, quality=11)
+    # A compressed copy that is not smaller is useless
+    return {encoding: body for encoding, body in encoded.items() if len(body) < len(data)}
+
+
+def read_manifest(static_dir=STATIC_DIR):
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def source_files(static_dir=STATIC_DIR):
+    names = [os.path.relpath(path, static_dir).replace(os.sep, '/')
+             for pattern in TEXT_PATTERNS for path in sorted(glob.glob(os.path.join(static_dir, pattern)))]
+    return names + [name for name in IMAGES if os.path.exists(os.path.join(static_dir, name))]
+
+
+def source_hash(static_dir, name):
+    with open(os.path.join(static_dir, name), 'rb') as f:
+        return content_hash(f.read())
+
+
+# Names of the source files whose build in the manifest is missing or out of date
+def stale_sources(static_dir=STATIC_DIR, manifest=None):
+    manifest = manifest if manifest is not None else read_manifest(static_dir) or {'assets': {}}
+    return [name for name in source_files(static_dir)
+            if manifest['assets'].get(name, {}).get('source_hash') != source_hash(static_dir, name)]
+
+
+def write_file(dist_dir, name, data):
+    path = os.path.join(dist_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_text(static_dir, dist_dir, name):
+    with open(os.path.join(static_dir, name), 'rb') as f:
+        data = f.read()
+    digest = content_hash(data)
+    built = hashed_name(name, digest)
+    write_file(dist_dir, built, data)
+    encoded = compress(data)
+    for encoding, suffix in ENCODINGS:
+        if encoding in encoded:
+            write_file(dist_dir, built + suffix, encoded[encoding])
+    return {
+        'source_hash': digest,
+        'files': {built: {'etag': digest, 'size': len(data),
+                          'encodings': {encoding: len(body) for encoding, body in encoded.items()}}}
+    }
+
+
+def build_image(static_dir, dist_dir, name):
+    from PIL import Image
+    import io
+
+    with open(os.path.join(static_dir, name), 'rb') as f:
+        data = f.read()
+    digest = content_hash(data)
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+
+    entry = {'source_hash': digest, 'files': {}, 'variants': {fmt: [] for fmt in IMAGE_FORMATS}}
+    widths = sorted({min(width, image.width) for width in IMAGE_WIDTHS})
+    for width in widths:
+        resized = image if width == image.width else \
+            image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        for fmt, (pil_format, _, options) in IMAGE_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            body = buffer.getvalue()
+            built = hashed_name(os.path.splitext(name)[0] + '.' + fmt, content_hash(body), f'-{width}')
+            write_file(dist_dir, built, body)
+            entry['files'][built] = {'etag': content_hash(body), 'size': len(body), 'encodings': {}}
+            entry['variants'][fmt].append([built, width])
+    return entry
+
+
+# Build the stale sources (all of them with force) and rewrite the manifest; returns the manifest
+def build_assets(static_dir=STATIC_DIR, force=False):
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    manifest = read_manifest(static_dir) or {'assets': {}}
+    stale = source_files(static_dir) if force else stale_sources(static_dir, manifest)
+    if not stale and os.path.exists(os.path.join(dist_dir, MANIFEST_FILE)):
+        return manifest
+
+    for name in stale:
+        if name in IMAGES:
+            try:
+                manifest['assets'][name] = build_image(static_dir, dist_dir, name)
+            except ImportError:
+                logger.warning('Pillow is not installed, %s is served as it is', name)
+                manifest['assets'].pop(name, None)
+        else:
+            manifest['assets'][name] = build_text(static_dir, dist_dir, name)
+    manifest['assets'] = {name: entry for name, entry in manifest['assets'].items()
+                          if os.path.exists(os.path.join(static_dir, name))}
+
+    # Files of the previous build stay until the next one, so pages already sent out still find their assets
+    built = {name for entry in manifest['assets'].values() for name in entry['files']}
+    keep = built | set(manifest.get('built_files', []))
+    for path in glob.glob(os.path.join(dist_dir, '**', '*.*'), recursive=True):
+        name = os.path.relpath(path, dist_dir).replace(os.sep, '/')
+        base = next((name[:-len(suffix)] for _, suffix in ENCODINGS if name.endswith(suffix)), name)
+        if name != MANIFEST_FILE and base not in keep:
+            os.remove(path)
+    manifest['built_files'] = sorted(built)
+
+    os.makedirs(dist_dir, exist_ok=True)
+    write_json_atomic(os.path.join(dist_dir, MANIFEST_FILE), manifest)
+    return manifest
+
+
+# Build what is stale; used at server start, where a failed build must not stop the server
+def ensure_assets(static_dir=STATIC_DIR):
+    try:
+        build_assets(static_dir)
+    except Exception:
+        logger.exception('Could not build the static assets, serving them unversioned')
+
+
+# Preferred encoding out of the available ones that the Accept-Encoding header allows
+def select_encoding(accept_encoding, available):
+    accepted = {}
+    for part in (accept_encoding or '').lower().split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip()] = quality
+    for encoding, _ in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+# A response body held in memory with its compressed copies
+class StaticBody:
+    def __init__(self, body, content_type, cache_control, etag=None, encoded=None):
+        self.bodies = {None: body}
+        self.bodies.update(compress(body) if encoded is None else encoded)
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = etag or content_hash(body)
+
+    # Status, headers and body for a GET with the given Accept-Encoding and If-None-Match headers
+    def respond(self, accept_encoding=None, if_none_match=None):
+        encoding = select_encoding(accept_encoding, self.bodies)
+        etag = f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"'
+        headers = [('Content-Type', self.content_type), ('Cache-Control', self.cache_control), ('ETag', etag)]
+        if len(self.bodies) > 1:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if if_none_match and (if_none_match.strip() == '*' or etag in
+                              [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]):
+            return 304, headers, b''
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        return 200, headers, self.bodies[encoding]
+
+
+# The built files of static/dist, in memory, and the URLs the templates use for the sources
+class AssetStore:
+    def __init__(self, static_dir=STATIC_DIR, url_prefix='/static'):
+        self.url_prefix = url_prefix
+        self.files = {}
+        self.urls = {}
+        self.srcsets = {}
+
+        manifest = read_manifest(static_dir)
+        if manifest is None:
+            logger.warning('%s has not been built (python assets.py), serving the assets unversioned',
+                           os.path.join(static_dir, DIST_DIR))
+            return
+        dist_dir = os.path.join(static_dir, DIST_DIR)
+        stale = set(stale_sources(static_dir, manifest))
+        if stale:
+            logger.warning('Assets changed since the last build, serving them unversioned: %s', sorted(stale))
+
+        for name, entry in manifest['assets'].items():
+            if name in stale:
+                continue
+            for built, info in entry['files'].items():
+                self.files[built] = StaticBody(read(dist_dir, built), content_type(built), IMMUTABLE, info['etag'],
+                                               {encoding: read(dist_dir, built + suffix)
+                                                for encoding, suffix in ENCODINGS if encoding in info['encodings']})
+            variants = entry.get('variants')
+            if variants:
+                self.srcsets[name] = {fmt: ', '.join(f'{self.dist_url(built)} {width}w' for built, width in files)
+                                      for fmt, files in variants.items()}
+                fallback = list(IMAGE_FORMATS)[-1]
+                self.urls[name] = self.dist_url(variants[fallback][-1][0])
+            else:
+                self.urls[name] = self.dist_url(next(iter(entry['files'])))
+
+    def dist_url(self, built):
+        return f'{self.url_prefix}/{DIST_DIR}/{built}'
+
+    # URL of a source file under static/, the hashed copy when there is one
+    def url(self, name):
+        return self.urls.get(name, f'{self.url_prefix}/{name}')
+
+    # (type, srcset) of the <source> elements for an image, best format first; [] when it was not built
+    def sources(self, name):
+        srcsets = self.srcsets.get(name, {})
+        return [(IMAGE_FORMATS[fmt][1], srcsets[fmt]) for fmt in list(IMAGE_FORMATS)[:-1] if fmt in srcsets]
+
+    # StaticBody of a path under static/dist, None if it is not a built file
+    def get(self, path):
+        return self.files.get(path)
+
+
+def content_type(name):
+    return CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+
+
+def read(dist_dir, name):
+    with open(os.path.join(dist_dir, name), 'rb') as f:
+        return f.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the fingerprinted and compressed static assets')
+    parser.add_argument('--static-dir', default=STATIC_DIR)
+    parser.add_argument('--force', action='store_true', help='Rebuild every asset, not only the changed ones')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    if brotli is None:
+        print('brotli is not installed, only gzip copies are written')
+    manifest = build_assets(args.static_dir, force=args.force)
+
+    print(f"{'source':<24}{'bytes':>10}  {'built':<44}{'bytes':>9}{'gzip':>8}{'br':>8}")
+    for name, entry in manifest['assets'].items():
+        size = os.path.getsize(os.path.join(args.static_dir, name))
+        for i, (built, info) in enumerate(entry['files'].items()):
+            encodings = info['encodings']
+            print(f"{name if i == 0 else '':<24}{size if i == 0 else '':>10}  {built:<44}{info['size']:>9}"
+                  f"{encodings.get('gzip', '-'):>8}{encodings.get('br', '-'):>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# Micro-batching scheduler for model calls
+#
+# With a threaded worker (gunicorn --threads N) several /api/analyze requests can need the model at the same
+# time. Instead of scoring them one predict call each, MicroBatcher stacks their rows into one matrix and makes
+# a single call, then hands every caller its own rows back:
+#   - only one model call per process runs at a time; requests arriving while it runs are queued and coalesced
+#     into the next call
+#   - a queued batch is dispatched once it holds max_batch rows or its oldest request waited max_wait seconds
+#   - when nothing is queued or running the request is scored straight away in the calling thread
+#     (bypass_when_idle), so an idle server pays no batching latency
+#   - if a batched call fails, its requests are retried one by one so only the bad one sees the error
+#
+# This only pays off for models whose per-call overhead dominates, like the sklearn MultiOutputClassifier
+# (~9,000 estimator calls however many rows); see PERFORMANCE.md.
+
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+# Queue waits kept for the percentiles in info()
+WAIT_SAMPLES = 2048
+
+
+class PendingRequest:
+    def __init__(self, X):
+        self.X = X
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    def __init__(self, predict, max_batch=32, max_wait=0.002, bypass_when_idle=True):
+        self.predict_fn = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.bypass_when_idle = bypass_when_idle
+
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.queued_rows = 0
+        self.busy = False
+        self.closed = False
+        self.dispatcher_pid = None
+
+        self.stats = {'requests': 0, 'bypassed': 0, 'model_calls': 0, 'rows': 0, 'failed_batches': 0}
+        self.batch_sizes = Counter()
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    # Scores the rows of X, possibly together with rows of other threads; same result as predict(X)
+    def predict(self, X):
+        with self.cond:
+            self.stats['requests'] += 1
+        if len(X) >= self.max_batch:
+            # Already a full batch
+            return self._call([X])[0]
+
+        with self.cond:
+            closed = self.closed
+            if closed:
+                bypass = False
+            elif self.bypass_when_idle and not self.busy and not self.queue:
+                self.busy = True
+                self.stats['bypassed'] += 1
+                bypass = True
+            else:
+                request = PendingRequest(X)
+                self.queue.append(request)
+                self.queued_rows += len(X)
+                self._ensure_dispatcher()
+                self.cond.notify_all()
+                bypass = False
+
+        if closed:
+            return self._call([X])[0]
+        if bypass:
+            try:
+                return self._call([X])[0]
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    # Stop the dispatcher once the queued requests are done, e.g. when a reload replaced the model; requests
+    # still holding this batcher are then scored directly
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # The dispatcher thread does not survive a fork, so it is started lazily in each worker process
+    def _ensure_dispatcher(self):
+        if self.dispatcher_pid != os.getpid():
+            self.dispatcher_pid = os.getpid()
+            threading.Thread(target=self._dispatch_forever, name='micro-batcher', daemon=True).start()
+
+    def _dispatch_forever(self):
+        while True:
+            with self.cond:
+                while not self.queue or self.busy:
+                    if self.closed and not self.queue:
+                        return
+                    self.cond.wait()
+
+                deadline = self.queue[0].enqueued + self.max_wait
+                while self.queued_rows < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                batch = [self.queue.popleft()]
+                rows = len(batch[0].X)
+                while self.queue and rows + len(self.queue[0].X) <= self.max_batch:
+                    rows += len(self.queue[0].X)
+                    batch.append(self.queue.popleft())
+                self.queued_rows -= rows
+                self.busy = True
+
+                started = time.perf_counter()
+                self.waits.extend(started - request.enqueued for request in batch)
+
+            try:
+                self._run_batch(batch)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _run_batch(self, batch):
+        try:
+            results = self._call([request.X for request in batch])
+        except Exception:
+            with self.cond:
+                self.stats['failed_batches'] += 1
+            results = None
+
+        for i, request in enumerate(batch):
+            if results is not None:
+                request.result = results[i]
+            else:
+                try:
+                    request.result = self._call([request.X])[0]
+                except Exception as e:
+                    request.error = e
+            request.done.set()
+
+    # One model call over the stacked matrices, split back per matrix
+    def _call(self, matrices):
+        X = matrices[0] if len(matrices) == 1 else np.concatenate(matrices)
+        result = self.predict_fn(X)
+        with self.cond:
+            self.stats['model_calls'] += 1
+            self.stats['rows'] += len(X)
+            self.batch_sizes[len(X)] += 1
+        return np.split(result, np.cumsum([len(m) for m in matrices[:-1]]))
+
+    def info(self):
+        with self.cond:
+            waits = np.array(self.waits) * 1000
+            calls = self.stats['model_calls']
+            return dict(
+                self.stats,
+                max_batch=self.max_batch,
+                max_wait_ms=self.max_wait * 1000,
+                bypass_when_idle=self.bypass_when_idle,
+                queued_rows=self.queued_rows,
+                mean_batch_rows=round(self.stats['rows'] / calls, 2) if calls else None,
+                batch_rows={str(size): count for size, count in sorted(self.batch_sizes.items())},
+                queue_wait_ms={
+                    'samples': len(waits),
+                    'p50': round(float(np.percentile(waits, 50)), 3) if len(waits) else None,
+                    'p99': round(float(np.percentile(waits, 99)), 3) if len(waits) else None,
+                    'max': round(float(waits.max()), 3) if len(waits) else None
+                }
+            )
@@ -0,0 +1,269 @@
+# Microbenchmarks of every stage of the /api/analyze pipeline, with saved baselines and regression checks
+#
+# Usage (from the project root):
+#   python benchmarks/bench_pipeline.py run -o benchmarks/baseline.json         # measure and save a baseline
+#   python benchmarks/bench_pipeline.py run -o current.json --compare benchmarks/baseline.json
+#   python benchmarks/bench_pipeline.py compare benchmarks/baseline.json current.json
+#
+# Inputs are reports drawn from synthetic_blood_reports.csv. Every stage is timed on its own with the outputs
+# of the previous stages precomputed, plus the full request through Flask's test client. A sample is the mean
+# time of `number` consecutive calls (number is calibrated so a sample lasts at least SAMPLE_SECONDS), and the
+# raw samples are saved so two runs can be compared with a Mann-Whitney U test. compare exits with status 1
+# when a stage got slower by more than --threshold with p < --alpha.
+#
+# The result cache is disabled while benchmarking; MODEL_ENGINE selects the engine as in app.py.
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_SECONDS = 0.005
+
+STAGES = ['parse', 'rules', 'features', 'predict_proba', 'predict_abnormalities', 'summary', 'recommendations',
+          'percentiles', 'serialize', 'endpoint']
+
+
+def load_reports(path, count, seed):
+    df = pd.read_csv(path).drop(columns=['Patient ID'], errors='ignore')
+    df = df.sample(n=min(count, len(df)), random_state=seed)
+    reports = []
+    for record in df.to_dict('records'):
+        reports.append({
+            'gender': record.pop('Sex').lower(),
+            'age': int(record.pop('Age')),
+            'testResults': record
+        })
+    return reports
+
+
+# Function and argument tuples of every stage; the arguments are the outputs of the earlier stages for one report
+def build_stages(app, reports):
+    serving = app.current_model()
+    parsed = [app.parse_report(report) for report in reports]
+    analyses = [app.analyze_test_results(test_results, gender, age) for gender, age, test_results in parsed]
+    ml_inputs = [app.build_ml_input(test_results, gender, age) for gender, age, test_results in parsed]
+    matrices = [serving.feature_assembler.assemble_batch([ml_input]) for ml_input in ml_inputs]
+    predictions = app.predict_abnormalities_batch(ml_inputs)
+    responses = [app.build_report(gender, age, analysis, ml_predictions)
+                 for (gender, age, _), analysis, ml_predictions in zip(parsed, analyses, predictions)]
+
+    client = app.app.test_client()
+
+    def endpoint(report):
+        response = client.post('/api/analyze', json=report)
+        if response.status_code != 200:
+            raise RuntimeError(f'/api/analyze returned {response.status_code}')
+
+    def assemble(ml_input):
+        return serving.feature_assembler.assemble_batch([ml_input])
+
+    return {
+        'parse': (app.parse_report, [(report,) for report in reports]),
+        'rules': (app.analyze_test_results, [(test_results, gender, age) for gender, age, test_results in parsed]),
+        'features': (assemble, [(ml_input,) for ml_input in ml_inputs]),
+        'predict_proba': (app.condition_probabilities, [(serving.model, X) for X in matrices]),
+        'predict_abnormalities': (app.predict_abnormalities, [(ml_input,) for ml_input in ml_inputs]),
+        'summary': (app.generate_health_summary,
+                    [(analysis, gender, age) for (gender, age, _), analysis in zip(parsed, analyses)]),
+        'recommendations': (app.generate_recommendations, [(ml_predictions,) for ml_predictions in predictions]),
+        'percentiles': (app.population_percentiles,
+                        [(analysis, gender, age) for (gender, age, _), analysis in zip(parsed, analyses)]),
+        'serialize': (app.app.json.dumps, [(response,) for response in responses]),
+        'endpoint': (endpoint, [(report,) for report in reports])
+    }
+
+
+# Seconds for `number` calls, cycling through the inputs from position start
+def time_block(fn, inputs, number, start):
+    calls = [inputs[(start + i) % len(inputs)] for i in range(number)]
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for args in calls:
+            fn(*args)
+        return time.perf_counter() - started
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+# Number of calls per sample so that a sample lasts at least SAMPLE_SECONDS
+def calibrate(fn, inputs):
+    number = 1
+    while True:
+        elapsed = time_block(fn, inputs, number, 0)
+        if elapsed >= SAMPLE_SECONDS:
+            return number
+        number = max(number * 2, int(number * SAMPLE_SECONDS / max(elapsed, 1e-9)))
+
+
+def measure(fn, inputs, number, seconds, min_samples, max_samples, samples):
+    collected = 0
+    deadline = time.perf_counter() + seconds
+    while collected < max_samples and (collected < min_samples or time.perf_counter() < deadline):
+        samples.append(time_block(fn, inputs, number, len(samples) * number) / number)
+        collected += 1
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command(args):
+    # app.py loads the model from paths relative to the project root
+    output, data = os.path.abspath(args.output), os.path.abspath(args.data)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ['RESULT_CACHE_SIZE'] = '0'
+    import app
+
+    if app.model_registry.active is None:
+        raise SystemExit('The model failed to load')
+
+    reports = load_reports(data, args.reports, args.seed)
+    stages = build_stages(app, reports)
+    selected = args.stages or STAGES
+
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_commit': git_commit(),
+            'engine': app.current_model().status['engine'],
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'reports': len(reports),
+            'seed': args.seed,
+            'rounds': args.rounds
+        },
+        'stages': {}
+    }
+
+    # The stages take turns over several rounds, so slow drifts of the machine affect all of them alike
+    numbers = {name: calibrate(*stages[name]) for name in selected}
+    stage_samples = {name: [] for name in selected}
+    for _ in range(args.rounds):
+        for name in selected:
+            fn, inputs = stages[name]
+            measure(fn, inputs, numbers[name], args.seconds / args.rounds, -(-args.min_samples // args.rounds),
+                    -(-args.max_samples // args.rounds), stage_samples[name])
+
+    print(f"{'stage':<24}{'number':>8}{'samples':>9}{'median us':>12}{'p95 us':>12}")
+    for name in selected:
+        number, samples = numbers[name], stage_samples[name]
+        micro = np.array(samples) * 1e6
+        results['stages'][name] = {
+            'unit': 'seconds per call',
+            'number': number,
+            'median': float(np.median(samples)),
+            'mean': float(np.mean(samples)),
+            'stdev': float(np.std(samples)),
+            'samples': samples
+        }
+        print(f"{name:<24}{number:>8}{len(samples):>9}{np.median(micro):>12.1f}{np.percentile(micro, 95):>12.1f}")
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved {args.output}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        return compare(baseline, results, args.threshold, args.alpha)
+    return 0
+
+
+# Per stage verdict: slower/faster when the medians differ by more than threshold and the test says p < alpha
+def compare(baseline, current, threshold, alpha):
+    from scipy.stats import mannwhitneyu
+
+    for key in ('engine', 'machine', 'cpus'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"Warning: {key} differs ({baseline['meta'].get(key)} vs {current['meta'].get(key)})")
+
+    regressions = []
+    print(f"{'stage':<24}{'baseline us':>13}{'current us':>13}{'ratio':>8}{'p':>10}  verdict")
+    for name, base in baseline['stages'].items():
+        if name not in current['stages']:
+            continue
+        cur = current['stages'][name]
+        ratio = cur['median'] / base['median']
+        p_slower = mannwhitneyu(cur['samples'], base['samples'], alternative='greater').pvalue
+        p_faster = mannwhitneyu(cur['samples'], base['samples'], alternative='less').pvalue
+
+        if ratio > 1 + threshold and p_slower < alpha:
+            verdict, p = 'SLOWER', p_slower
+            regressions.append(name)
+        elif ratio < 1 - threshold and p_faster < alpha:
+            verdict, p = 'faster', p_faster
+        else:
+            verdict, p = 'same', min(p_slower, p_faster)
+        print(f"{name:<24}{base['median'] * 1e6:>13.1f}{cur['median'] * 1e6:>13.1f}{ratio:>8.2f}{p:>10.2g}  {verdict}")
+
+    if regressions:
+        print(f"Significant slowdowns: {', '.join(regressions)}")
+        return 1
+    print("No significant slowdowns")
+    return 0
+
+
+def compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return compare(baseline, current, args.threshold, args.alpha)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the analysis pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_compare_options(subparser):
+        subparser.add_argument('--threshold', type=float, default=0.10,
+                               help='Relative change of the median that counts (default 0.10)')
+        subparser.add_argument('--alpha', type=float, default=0.01, help='Significance level (default 0.01)')
+
+    run = subparsers.add_parser('run', help='Measure every stage and save the samples')
+    run.add_argument('-o', '--output', default='benchmarks/baseline.json')
+    run.add_argument('--data', default='synthetic_blood_reports.csv')
+    run.add_argument('--reports', type=int, default=500, help='Reports drawn from the data')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--stages', nargs='+', choices=STAGES)
+    run.add_argument('--seconds', type=float, default=2, help='Time budget per stage')
+    run.add_argument('--rounds', type=int, default=5, help='Passes over the stages the time budget is split into')
+    run.add_argument('--min-samples', type=int, default=10)
+    run.add_argument('--max-samples', type=int, default=400)
+    run.add_argument('--compare', metavar='BASELINE', help='Compare against a saved baseline afterwards')
+    add_compare_options(run)
+    run.set_defaults(func=run_command)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two saved runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    add_compare_options(compare_parser)
+    compare_parser.set_defaults(func=compare_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
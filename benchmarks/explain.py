@@ -0,0 +1,103 @@
+# Latency of /api/analyze with and without ?explain=true
+#
+# Usage (from the project root):
+#   python benchmarks/explain.py --reports 500
+#   python benchmarks/explain.py --reports 500 --batch 64 --data big.csv
+#
+# Reports drawn from synthetic_blood_reports.csv are sent through Flask's test client, one request per report to
+# /api/analyze and --batch reports per request to /api/analyze/batch, first plain and then with explanations.
+# The model-level cost is reported as well: predict_proba of one row against FlatForest.explain() for the
+# conditions that row reports. The explanations are checked to add up to the predicted probabilities.
+# The result cache is disabled.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['RESULT_CACHE_SIZE'] = '0'
+
+from bench_pipeline import load_reports  # noqa: E402
+
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000
+    return np.percentile(samples, 50), np.percentile(samples, 99)
+
+
+def time_calls(function, arguments):
+    samples = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ?explain=true against the plain prediction path')
+    parser.add_argument('--data', default='synthetic_blood_reports.csv')
+    parser.add_argument('--reports', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=64, help='Reports per /api/analyze/batch request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import app
+    serving = app.model_registry.active
+    if serving is None or not isinstance(serving.model, app.FlatForest):
+        raise SystemExit('Explanations need the flat forest engine')
+
+    reports = load_reports(args.data, args.reports, args.seed)
+    client = app.app.test_client()
+
+    def post(path, payload):
+        response = client.post(path, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path} returned {response.status_code}')
+        return response.json
+
+    # Warm-up, and the contribution tables are built on the first explained request
+    started = time.perf_counter()
+    post('/api/analyze?explain=true', reports[0])
+    first_explain = time.perf_counter() - started
+
+    # Model level: the same rows, plain probabilities against the explanation of the reported conditions
+    ml_inputs = [app.build_ml_input(test_results, gender, age)
+                 for gender, age, test_results in map(app.parse_report, reports)]
+    matrices = [serving.feature_assembler.assemble_batch([ml_input]) for ml_input in ml_inputs]
+    probabilities = [serving.predict(X)[0] for X in matrices]
+    pairs = [[(0, label) for label in np.flatnonzero(p > 0.9)] for p in probabilities]
+    conditions = [len(row_pairs) for row_pairs in pairs]
+
+    worst = 0.0
+    for X, p, row_pairs in zip(matrices, probabilities, pairs):
+        if row_pairs:
+            bias, contributions = serving.model.explain(X, row_pairs)
+            worst = max(worst, np.abs(bias + contributions.sum(axis=1) - p[[label for _, label in row_pairs]]).max())
+
+    batches = [reports[i:i + args.batch] for i in range(0, len(reports), args.batch)]
+    rows = [
+        ('predict_proba, 1 row', time_calls(serving.predict, [(X,) for X in matrices]), None),
+        ('explain, 1 row', time_calls(serving.model.explain, zip(matrices, pairs)), None),
+        ('/api/analyze', time_calls(post, [('/api/analyze', report) for report in reports]), None),
+        ('/api/analyze?explain=true', time_calls(post, [('/api/analyze?explain=true', report)
+                                                        for report in reports]), None),
+        (f'batch of {args.batch}', time_calls(post, [('/api/analyze/batch', batch) for batch in batches]), None),
+        (f'batch of {args.batch}, explain', time_calls(post, [('/api/analyze/batch?explain=true', batch)
+                                                               for batch in batches]), None),
+    ]
+
+    print(f"{len(reports)} reports, {np.mean(conditions):.1f} conditions explained per report "
+          f"(max {max(conditions)}), first explained request {first_explain * 1000:.1f} ms")
+    print(f"explanations add up to the probabilities within {worst:.1e}")
+    print(f"{'path':<32}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, samples, _ in rows:
+        p50, p99 = percentiles(samples)
+        print(f"{name:<32}{p50:>9.2f}{p99:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
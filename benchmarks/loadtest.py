@@ -0,0 +1,444 @@
+# End-to-end load test of the deployment: the procfile's gunicorn command, the Flask routes and the model
+#
+# Usage (from the project root; Linux, worker CPU and RSS are read from /proc):
+#   python benchmarks/loadtest.py closed --clients 4 16 --workers 2 --threads 1
+#   python benchmarks/loadtest.py open --rates 50 100 200 400 --workers 1 2 4 --threads 1 4 --slo-ms 200
+#   python benchmarks/loadtest.py open --rates 100 --duration 60 --timeline --output run.json
+#   python benchmarks/loadtest.py closed --clients 8 --url http://127.0.0.1:8000     # a server already running
+#
+# Payloads are built from synthetic_blood_reports.csv and DOC-20250409-WA0001.csv (which also has patient IDs
+# and the HCT and RDW-SD columns). --partial of them keep only a random subset of the panel, --nulls send one to
+# three tests as null, and --invalid drop a required field or send a non-numeric age, for which a 400 is the
+# right answer. --static of the requests load a page or one of the CSS, JS and image files it links to.
+#
+# closed: --clients each send the next request as soon as the previous one is answered.
+# open: requests arrive at --rates per second (Poisson arrivals) however long the server takes, and latency is
+# counted from the scheduled arrival, so a server that falls behind shows it in the tail.
+#
+# For every --workers x --threads combination gunicorn is started with the procfile's command plus those
+# options, warmed up, and driven through the steps (client counts or rates) in order. A step is sustained when
+# the throughput reaches 95% of the rate the requests were sent at, at most 1% of the requests fail and p99
+# stays under --slo-ms; open-loop steps stop at the first one that is not. The saturation point of a combination is its highest
+# sustained rate (open) or the client count that first reaches 95% of its peak throughput (closed).
+# A failed request is a connection error, a 5xx or any status other than the one the payload should get.
+#
+# The load generator runs on the same machine, so on few cores it takes CPU away from the server.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from page_load import decode, subresources  # noqa: E402
+
+DATA_FILES = ['synthetic_blood_reports.csv', 'DOC-20250409-WA0001.csv']
+PAGES = ['/', '/enter-report', '/results']
+QUANTILES = [50, 95, 99, 99.9]
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+# Request payloads as (body, expected status)
+def build_payloads(paths, count, partial, nulls, invalid, seed):
+    rng = random.Random(seed)
+    records = []
+    for path in paths:
+        df = pd.read_csv(path)
+        records += df.to_dict('records')
+
+    payloads = []
+    for _ in range(count):
+        record = dict(rng.choice(records))
+        patient_id = record.pop('Patient ID', None)
+        report = {
+            'gender': str(record.pop('Sex')).lower(),
+            'age': int(record.pop('Age')),
+            'testResults': {test: value for test, value in record.items() if not pd.isna(value)}
+        }
+        tests = list(report['testResults'])
+        if rng.random() < partial:
+            keep = rng.sample(tests, rng.randint(3, len(tests) - 1))
+            report['testResults'] = {test: report['testResults'][test] for test in keep}
+        if rng.random() < nulls:
+            for test in rng.sample(list(report['testResults']), min(rng.randint(1, 3), len(report['testResults']))):
+                report['testResults'][test] = None
+        if patient_id is not None:
+            report['patientId'] = patient_id
+
+        expected = 200
+        if rng.random() < invalid:
+            field = rng.choice(['gender', 'age', 'testResults', 'age_text'])
+            if field == 'age_text':
+                report['age'] = 'unknown'
+            else:
+                del report[field]
+            expected = 400
+        payloads.append((json.dumps(report).encode(), expected))
+    return payloads
+
+
+def http_get(path, port):
+    return (f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nAccept-Encoding: gzip, br\r\n'
+            f'Connection: close\r\n\r\n').encode()
+
+
+def http_post(body, port):
+    return (f'POST /api/analyze HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body
+
+
+async def send(host, port, data, timeout):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(data)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+# Request mix: picks the next request as (kind, raw request, expected status)
+class Traffic:
+    def __init__(self, payloads, static_paths, static_fraction, port, seed):
+        self.requests = [('analyze', http_post(body, port), expected) for body, expected in payloads]
+        self.static = [('static', http_get(path, port), 200) for path in static_paths]
+        self.static_fraction = static_fraction
+        self.rng = random.Random(seed)
+
+    def next(self):
+        if self.static and self.rng.random() < self.static_fraction:
+            return self.rng.choice(self.static)
+        return self.rng.choice(self.requests)
+
+
+# Outcome of every request: (kind, finish time, latency, ok)
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    async def request(self, host, port, traffic, timeout, scheduled=None):
+        kind, data, expected = traffic.next()
+        started = time.perf_counter() if scheduled is None else scheduled
+        try:
+            status = await send(host, port, data, timeout)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            status = None
+        finished = time.perf_counter()
+        self.results.append((kind, finished, finished - started, status == expected))
+
+
+async def closed_loop(host, port, traffic, clients, duration, timeout):
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            await recorder.request(host, port, traffic, timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    return recorder.results, started, time.perf_counter() - started
+
+
+async def open_loop(host, port, traffic, rate, duration, timeout, seed):
+    recorder = Recorder()
+    rng = random.Random(seed)
+    tasks = []
+    started = time.perf_counter()
+    arrival = started
+    while True:
+        arrival += rng.expovariate(rate)
+        if arrival > started + duration:
+            break
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(recorder.request(host, port, traffic, timeout, scheduled=arrival)))
+    await asyncio.gather(*tasks)
+    return recorder.results, started, time.perf_counter() - started
+
+
+# CPU% and RSS of the gunicorn master and its workers, sampled every interval seconds in a thread
+class ProcessMonitor:
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        previous = {pid: (usage[0], time.perf_counter()) for pid in [self.pid] + children(self.pid)
+                    if (usage := cpu_and_rss(pid)) is not None}
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            sample = {'time': now, 'workers': {}}
+            for pid in [self.pid] + children(self.pid):
+                usage = cpu_and_rss(pid)
+                if usage is None:
+                    continue
+                cpu_seconds, rss = usage
+                if pid in previous:
+                    cpu = (cpu_seconds - previous[pid][0]) / (now - previous[pid][1]) * 100
+                    sample['workers'][pid] = {'cpu': round(cpu, 1), 'rss_mb': round(rss / 2 ** 20, 1),
+                                              'master': pid == self.pid}
+                previous[pid] = (cpu_seconds, now)
+            if sample['workers']:
+                self.samples.append(sample)
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def cpu_and_rss(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    # utime and stime are fields 14 and 15 of stat, counted from 1 including pid and comm
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, resident * PAGE_SIZE
+
+
+def summarize(results, elapsed):
+    latencies = np.array([latency for _, _, latency, ok in results if ok]) * 1000
+    failed = sum(1 for *_, ok in results if not ok)
+    summary = {
+        'requests': len(results),
+        'throughput': len(latencies) / elapsed,
+        'error_rate': failed / len(results) if results else 0.0,
+        'static_requests': sum(1 for kind, *_ in results if kind == 'static')
+    }
+    for q in QUANTILES:
+        summary[f'p{q}'] = float(np.percentile(latencies, q)) if len(latencies) else float('nan')
+    return summary
+
+
+# Per-interval throughput, p99 and errors next to the process samples taken during the same interval
+def timeline(results, started, samples, interval):
+    buckets = {}
+    for _, finished, latency, ok in results:
+        bucket = buckets.setdefault(int((finished - started) // interval), {'latencies': [], 'failed': 0})
+        if ok:
+            bucket['latencies'].append(latency * 1000)
+        else:
+            bucket['failed'] += 1
+
+    rows = []
+    for index in sorted(buckets):
+        bucket = buckets[index]
+        # A sample covers the interval that ends when it is taken
+        window = [s for s in samples if max(round((s['time'] - started) / interval) - 1, 0) == index]
+        workers = [w for s in window for w in s['workers'].values() if not w['master']]
+        rows.append({
+            'second': round((index + 1) * interval, 1),
+            'throughput': len(bucket['latencies']) / interval,
+            'p99': float(np.percentile(bucket['latencies'], 99)) if bucket['latencies'] else float('nan'),
+            'errors': bucket['failed'],
+            'worker_cpu': round(sum(w['cpu'] for w in workers) / len(window), 1) if window else None,
+            'max_worker_rss_mb': max((w['rss_mb'] for w in workers), default=None)
+        })
+    return rows
+
+
+def procfile_command(path='procfile'):
+    with open(path) as f:
+        for line in f:
+            process, _, command = line.partition(':')
+            if process.strip() == 'web':
+                return shlex.split(command)
+    raise SystemExit(f'No web process in {path}')
+
+
+def wait_ready(base_url, timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(f'{base_url}/ready', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (OSError, urllib.error.HTTPError):
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f'{base_url} did not become ready')
+
+
+# The pages and the same-origin files they link to
+def static_paths(base_url):
+    paths = list(PAGES)
+    for page in PAGES:
+        request = urllib.request.Request(base_url + page, headers={'Accept-Encoding': 'gzip'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            html = decode(response, response.read()).decode('utf-8')
+        paths += [path for path in subresources(html, 1366) if path not in paths]
+    return paths
+
+
+def run_steps(args, host, port, base_url, payloads, pid=None):
+    traffic = Traffic(payloads, static_paths(base_url) if args.static > 0 else [], args.static, port, args.seed)
+    # Warm-up outside the measurement
+    asyncio.run(closed_loop(host, port, traffic, 4, args.warmup, args.timeout))
+
+    steps = []
+    for step in (args.clients if args.profile == 'closed' else args.rates):
+        monitor = ProcessMonitor(pid, args.interval).start() if pid else None
+        if args.profile == 'closed':
+            results, started, elapsed = asyncio.run(closed_loop(host, port, traffic, step, args.duration,
+                                                                args.timeout))
+        else:
+            results, started, elapsed = asyncio.run(open_loop(host, port, traffic, step, args.duration,
+                                                              args.timeout, args.seed))
+        samples = []
+        if monitor:
+            monitor.stop()
+            samples = monitor.samples
+
+        summary = summarize(results, elapsed)
+        summary['step'] = step
+        summary['sustained'] = (summary['error_rate'] <= 0.01 and summary['p99'] <= args.slo_ms
+                                and (args.profile == 'closed'
+                                     or summary['throughput'] >= 0.95 * summary['requests'] / args.duration))
+        workers = [w for s in samples for w in s['workers'].values() if not w['master']]
+        summary['worker_cpu'] = round(float(np.mean([sum(w['cpu'] for w in s['workers'].values() if not w['master'])
+                                                     for s in samples])), 1) if samples else None
+        summary['max_worker_rss_mb'] = max((w['rss_mb'] for w in workers), default=None)
+        summary['timeline'] = timeline(results, started, samples, args.interval)
+        steps.append(summary)
+        print_step(summary, args)
+
+        if args.profile == 'open' and not summary['sustained']:
+            break
+    return steps
+
+
+def print_step(summary, args):
+    unit = 'clients' if args.profile == 'closed' else 'req/s in'
+    print(f"  {summary['step']:>6} {unit:<9}{summary['throughput']:>9.1f} req/s"
+          + ''.join(f"{summary[f'p{q}']:>9.1f}" for q in QUANTILES)
+          + f"{summary['error_rate']:>8.2%}{optional(summary['worker_cpu']):>8}{optional(summary['max_worker_rss_mb']):>8}"
+          + ('' if summary['sustained'] else '  not sustained'))
+    if args.timeline:
+        print(f"      {'s':>6}{'req/s':>8}{'p99 ms':>9}{'errors':>8}{'CPU %':>8}{'RSS MB':>8}")
+        for row in summary['timeline']:
+            print(f"      {row['second']:>6}{row['throughput']:>8.1f}{row['p99']:>9.1f}{row['errors']:>8}"
+                  f"{optional(row['worker_cpu']):>8}{optional(row['max_worker_rss_mb']):>8}")
+
+
+# CPU and RSS are unknown without process samples (--url, or an interval without a sample)
+def optional(value):
+    return '-' if value is None else value
+
+
+def saturation(steps, profile):
+    if profile == 'open':
+        sustained = [step for step in steps if step['sustained']]
+        return sustained[-1] if sustained else None
+    peak = max(step['throughput'] for step in steps)
+    return next(step for step in steps if step['throughput'] >= 0.95 * peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the gunicorn deployment end to end')
+    parser.add_argument('profile', choices=['closed', 'open'])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Closed-loop steps')
+    parser.add_argument('--rates', type=float, nargs='+', default=[25, 50, 100, 200, 400],
+                        help='Open-loop steps, requests per second')
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1])
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per step')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--interval', type=float, default=1, help='Seconds per timeline sample')
+    parser.add_argument('--timeline', action='store_true', help='Print the per-interval timeline of every step')
+    parser.add_argument('--slo-ms', type=float, default=250, help='p99 a step must stay under to be sustained')
+    parser.add_argument('--static', type=float, default=0.2, help='Fraction of page and asset loads')
+    parser.add_argument('--partial', type=float, default=0.3, help='Fraction of reports with a partial panel')
+    parser.add_argument('--nulls', type=float, default=0.1, help='Fraction of reports with null test values')
+    parser.add_argument('--invalid', type=float, default=0.02, help='Fraction of reports missing a field')
+    parser.add_argument('--payloads', type=int, default=5000, help='Distinct payloads to cycle through')
+    parser.add_argument('--url', help='Load an already running server instead of starting gunicorn')
+    parser.add_argument('--port', type=int, default=8810)
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Save every step with its timeline as JSON')
+    args = parser.parse_args()
+
+    payloads = build_payloads(DATA_FILES, args.payloads, args.partial, args.nulls, args.invalid, args.seed)
+    print(f"{args.profile} loop, {args.duration:.0f}s per step, {args.static:.0%} static, {args.partial:.0%} partial, "
+          f"{args.invalid:.0%} invalid reports, SLO p99 {args.slo_ms:.0f} ms")
+    header = (f"  {'step':>16}{'throughput':>15}" + ''.join(f"{f'p{q} ms':>9}" for q in QUANTILES)
+              + f"{'errors':>8}{'CPU %':>8}{'RSS MB':>8}")
+
+    runs = []
+    if args.url:
+        base_url = args.url.rstrip('/')
+        parsed = urllib.parse.urlsplit(base_url)
+        print(header)
+        runs.append({'url': base_url, 'steps': run_steps(args, parsed.hostname, parsed.port or 80, base_url,
+                                                         payloads)})
+    else:
+        for workers in args.workers:
+            for threads in args.threads:
+                print(f'gunicorn --workers {workers} --threads {threads}')
+                print(header)
+                port = args.port
+                command = procfile_command() + ['--workers', str(workers), '--threads', str(threads),
+                                                '--bind', f'127.0.0.1:{port}']
+                server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    wait_ready(f'http://127.0.0.1:{port}', 600)
+                    steps = run_steps(args, '127.0.0.1', port, f'http://127.0.0.1:{port}', payloads, server.pid)
+                finally:
+                    server.send_signal(signal.SIGTERM)
+                    server.wait()
+                runs.append({'workers': workers, 'threads': threads, 'steps': steps})
+
+        print('Saturation points')
+        print(f"{'workers':>8}{'threads':>8}{'step':>8}{'req/s':>9}{'p99 ms':>9}{'CPU %':>8}")
+        for run in runs:
+            point = saturation(run['steps'], args.profile)
+            if point is None:
+                print(f"{run['workers']:>8}{run['threads']:>8}  none of the steps was sustained")
+            else:
+                print(f"{run['workers']:>8}{run['threads']:>8}{point['step']:>8}{point['throughput']:>9.1f}"
+                      f"{point['p99']:>9.1f}{optional(point['worker_cpu']):>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'runs': runs}, f, indent=1)
+        print(f'Saved {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Throughput and latency of predict_abnormalities() with and without the micro-batching scheduler
+#
+# Usage (from the project root):
+#   MODEL_ENGINE=sklearn python benchmarks/micro_batching.py --concurrency 1 4 16 32
+#   MODEL_ENGINE=flat python benchmarks/micro_batching.py --concurrency 1 4 16
+#
+# Every client thread scores a random row of synthetic_blood_reports.csv in a closed loop, the way the threads
+# of a `gunicorn --threads N` worker call the model. For each concurrency level the run is repeated with the
+# scheduler off (one model call per request) and on, and throughput and latency percentiles are reported.
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MODEL_BATCHING', '0')
+
+import app  # noqa: E402
+from batching import MicroBatcher  # noqa: E402
+
+
+def load_patients(path):
+    df = pd.read_csv(path).drop(columns=['Patient ID'], errors='ignore')
+    df['Sex'] = df['Sex'].str.lower()
+    return df.to_dict('records')
+
+
+def run(patients, concurrency, duration, seed):
+    latencies = [[] for _ in range(concurrency)]
+    stop = time.perf_counter() + duration
+
+    def client(i):
+        rng = np.random.default_rng(seed + i)
+        while time.perf_counter() < stop:
+            patient = patients[rng.integers(len(patients))]
+            started = time.perf_counter()
+            app.predict_abnormalities(patient)
+            latencies[i].append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = np.concatenate([np.array(l) for l in latencies]) * 1000
+    return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the micro-batching scheduler')
+    parser.add_argument('--data', default='synthetic_blood_reports.csv')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per run')
+    parser.add_argument('--max-batch', type=int, default=app.MODEL_BATCH_MAX_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=app.MODEL_BATCH_WAIT_MS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    serving = app.model_registry.active
+    if serving is None:
+        raise SystemExit('The model failed to load')
+    patients = load_patients(args.data)
+
+    def predict(X):
+        return app.condition_probabilities(serving.model, X)
+
+    print(f"engine={serving.status['engine']} max_batch={args.max_batch} max_wait_ms={args.max_wait_ms} "
+          f"duration={args.duration}s")
+    print(f"{'batching':<10}{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'rows/call':>11}")
+    for concurrency in args.concurrency:
+        for batching in (False, True):
+            batcher = MicroBatcher(predict, max_batch=args.max_batch,
+                                   max_wait=args.max_wait_ms / 1000) if batching else None
+            app.model_registry.active = serving._replace(predict=batcher.predict if batching else predict,
+                                                         batcher=batcher)
+            throughput, p50, p99 = run(patients, concurrency, args.duration, args.seed)
+            rows_per_call = batcher.info()['mean_batch_rows'] if batching else 1
+            print(f"{'on' if batching else 'off':<10}{concurrency:>8}{throughput:>10.1f}{p50:>10.1f}{p99:>10.1f}"
+                  f"{rows_per_call:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# Bytes transferred and time to first byte of the pages, on a first and a repeat visit
+#
+# Usage (with a server running, e.g. gunicorn --config gunicorn.conf.py app:app or uvicorn asgi:app):
+#   python benchmarks/page_load.py --url http://127.0.0.1:8000
+#   python benchmarks/page_load.py --url http://127.0.0.1:8000 --requests 500 --viewport 1366
+#
+# Every page is fetched the way a current browser does it: with Accept-Encoding: gzip, br (br only when the
+# brotli package is installed to decode it), then the stylesheets, scripts and images it links to on the same
+# origin. Of a <picture> the first <source> type is taken (AVIF), and of a srcset the smallest candidate at least
+# as wide as --viewport. A repeat visit sends If-None-Match / If-Modified-Since for what a first visit cached and
+# skips the files marked immutable. Bytes are the response bodies as sent (compressed), plus headers.
+# Time to first byte is measured for the page alone, until the status line and headers are read, over
+# --requests requests per page on one kept-alive connection.
+
+import argparse
+import gzip
+import http.client
+import re
+import time
+import urllib.parse
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PAGES = ['/', '/enter-report', '/results']
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+ACCEPT_IMAGE = 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+
+TAG = re.compile(r'<(link|script|img|source)\b([^>]*)>', re.IGNORECASE)
+ATTRIBUTE = re.compile(r'([a-zA-Z-]+)\s*=\s*"([^"]*)"')
+
+
+class Client:
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.connection = None
+
+    def get(self, path, headers):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                started = time.perf_counter()
+                self.connection.request('GET', path, headers=headers)
+                response = self.connection.getresponse()
+                first_byte = time.perf_counter() - started
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The sync gunicorn workers close the connection after every response
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+                continue
+            if response.getheader('Connection', '').lower() == 'close':
+                self.connection.close()
+                self.connection = None
+            header_bytes = sum(len(name) + len(value) + 4 for name, value in response.getheaders()) + 17
+            return response, body, first_byte, header_bytes
+
+
+def decode(response, body):
+    encoding = response.getheader('Content-Encoding')
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'br':
+        return brotli.decompress(body)
+    return body
+
+
+# Same-origin stylesheets, scripts and images a browser with the given viewport width loads for a page
+def subresources(html, viewport):
+    resources = []
+    picture_chosen = False
+    for tag, attributes in TAG.findall(html):
+        attributes = dict(ATTRIBUTE.findall(attributes))
+        tag = tag.lower()
+        if tag == 'link' and attributes.get('rel') == 'stylesheet':
+            resources.append(attributes.get('href'))
+        elif tag == 'script':
+            resources.append(attributes.get('src'))
+        elif tag == 'source' and not picture_chosen:
+            resources.append(pick_candidate(attributes.get('srcset', ''), viewport))
+            picture_chosen = True
+        elif tag == 'img':
+            if not picture_chosen:
+                resources.append(pick_candidate(attributes['srcset'], viewport) if 'srcset' in attributes
+                                 else attributes.get('src'))
+            picture_chosen = False
+    return [url for url in resources if url and url.startswith('/') and not url.startswith('//')]
+
+
+def pick_candidate(srcset, viewport):
+    candidates = []
+    for candidate in srcset.split(','):
+        url, _, width = candidate.strip().partition(' ')
+        candidates.append((int(width.strip().rstrip('w') or 0), url))
+    wide_enough = [candidate for candidate in sorted(candidates) if candidate[0] >= viewport]
+    return (wide_enough or sorted(candidates))[0][1] if candidates else None
+
+
+def visit(client, page, viewport, cache):
+    response, body, _, header_bytes = client.get(page, conditional({'Accept-Encoding': ACCEPT_ENCODING}, cache, page))
+    total_bytes, requests = len(body) + header_bytes, 1
+    if response.status == 200:
+        remember(cache, page, response)
+        cache[page]['html'] = decode(response, body).decode('utf-8')
+    for path in subresources(cache[page]['html'], viewport):
+        if cache.get(path, {}).get('immutable'):
+            continue
+        headers = conditional({'Accept-Encoding': ACCEPT_ENCODING, 'Accept': ACCEPT_IMAGE}, cache, path)
+        response, body, _, header_bytes = client.get(path, headers)
+        total_bytes += len(body) + header_bytes
+        requests += 1
+        if response.status == 200:
+            remember(cache, path, response)
+    return total_bytes, requests
+
+
+def conditional(headers, cache, path):
+    entry = cache.get(path, {})
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def remember(cache, path, response):
+    cache.setdefault(path, {}).update(etag=response.getheader('ETag'),
+                                      last_modified=response.getheader('Last-Modified'),
+                                      immutable='immutable' in (response.getheader('Cache-Control') or ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure bytes transferred and time to first byte of the pages')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per page for the time to first byte')
+    parser.add_argument('--viewport', type=int, default=1366, help='Viewport width in CSS pixels')
+    args = parser.parse_args()
+
+    client = Client(args.url)
+    print(f"{'page':<16}{'first visit KB':>16}{'requests':>10}{'repeat KB':>11}{'requests':>10}"
+          f"{'TTFB p50 ms':>13}{'p99 ms':>9}")
+    for page in PAGES:
+        cache = {}
+        first_bytes, first_requests = visit(client, page, args.viewport, cache)
+        repeat_bytes, repeat_requests = visit(client, page, args.viewport, cache)
+
+        samples = []
+        for _ in range(args.requests):
+            _, _, first_byte, _ = client.get(page, {'Accept-Encoding': ACCEPT_ENCODING})
+            samples.append(first_byte * 1000)
+        print(f"{page:<16}{first_bytes / 1024:>16.1f}{first_requests:>10}{repeat_bytes / 1024:>11.1f}"
+              f"{repeat_requests:>10}{np.percentile(samples, 50):>13.2f}{np.percentile(samples, 99):>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
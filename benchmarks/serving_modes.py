@@ -0,0 +1,165 @@
+# Throughput and tail latency of /api/analyze: procfile setup (gunicorn) vs the ASGI mode (asgi.py)
+#
+# Usage (from the project root):
+#   python benchmarks/serving_modes.py --workers 2 --clients 16 --duration 20
+#   python benchmarks/serving_modes.py --workers 2 --clients 16 --slow-clients 8   # plus clients on a slow link
+#
+# Both servers get the same number of processes doing analysis (gunicorn workers, ASGI pool workers) and are
+# measured one after the other. Fast clients send a new random report as soon as the previous answer arrives,
+# over a new connection each time, so the result cache does not answer them. Slow clients send the same kind of
+# request but trickle the body in --slow-chunks pieces, --slow-delay seconds apart, like a phone on a bad
+# network. Throughput and latency percentiles are reported for the fast clients only.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+TESTS = {
+    'Hemoglobin': (8, 18), 'RBC': (3, 6.5), 'WBC': (2, 16), 'PLT': (80, 500), 'MCV': (65, 110),
+    'MCH': (20, 36), 'MCHC': (28, 38), 'ESR': (2, 60), 'NEU%': (30, 85), 'LYM%': (10, 55)
+}
+
+
+def random_report(rng):
+    return {
+        'gender': rng.choice(['male', 'female']),
+        'age': rng.randint(18, 85),
+        'testResults': {test: round(rng.uniform(low, high), 1) for test, (low, high) in TESTS.items()}
+    }
+
+
+def http_request(port, body):
+    return (f'POST /api/analyze HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body
+
+
+async def post(port, body, chunks=1, delay=0):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        data = http_request(port, body)
+        head = len(data) - len(body)
+        writer.write(data[:head])
+        size = -(-len(body) // chunks)
+        for i in range(0, len(body), size):
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(body[i:i + size])
+            await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    status = int(response.split(b' ', 2)[1])
+    return status
+
+
+async def fast_client(port, rng, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        body = json.dumps(random_report(rng)).encode()
+        started = time.perf_counter()
+        try:
+            status = await post(port, body)
+        except OSError:
+            status = None
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(status)
+
+
+async def slow_client(port, rng, deadline, chunks, delay):
+    while time.perf_counter() < deadline:
+        try:
+            await post(port, json.dumps(random_report(rng)).encode(), chunks, delay)
+        except OSError:
+            pass
+
+
+async def run_load(port, args):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    tasks = [fast_client(port, random.Random(i), deadline, latencies, errors) for i in range(args.clients)]
+    tasks += [slow_client(port, random.Random(-1 - i), deadline, args.slow_chunks, args.slow_delay)
+              for i in range(args.slow_clients)]
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return latencies, errors, time.perf_counter() - started
+
+
+def wait_ready(port, timeout):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/ready', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (OSError, urllib.error.HTTPError):
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f'Server on port {port} did not become ready')
+
+
+def measure(name, command, env, port, args):
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port, args.timeout)
+        # Warm-up outside the measurement
+        args_warmup = argparse.Namespace(**{**vars(args), 'duration': 2, 'slow_clients': 0})
+        asyncio.run(run_load(port, args_warmup))
+        latencies, errors, elapsed = asyncio.run(run_load(port, args))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [float('nan')] * 99
+    return {
+        'mode': name,
+        'rps': len(latencies) / elapsed,
+        'p50': quantiles[49] * 1000,
+        'p99': quantiles[98] * 1000,
+        'max': latencies[-1] * 1000 if latencies else float('nan'),
+        'errors': len(errors)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare gunicorn and the ASGI mode under load')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Analysis processes of both servers')
+    parser.add_argument('--clients', type=int, default=16, help='Closed-loop fast clients')
+    parser.add_argument('--slow-clients', type=int, default=0)
+    parser.add_argument('--slow-chunks', type=int, default=5)
+    parser.add_argument('--slow-delay', type=float, default=0.2)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    servers = [
+        ('gunicorn (procfile)', [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                                 '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}',
+                                 '--timeout', '600', 'app:app'], env),
+        ('asgi (uvicorn)', [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(args.port + 1),
+                            '--no-access-log'], {**env, 'ANALYSIS_WORKERS': str(args.workers)}),
+    ]
+
+    print(f'{args.workers} analysis processes, {args.clients} fast clients, {args.slow_clients} slow clients '
+          f'({args.slow_chunks} chunks, {args.slow_delay}s apart), {args.duration:.0f}s')
+    print(f"{'mode':<22}{'req/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+    for i, (name, command, server_env) in enumerate(servers):
+        result = measure(name, command, server_env, args.port + i, args)
+        print(f"{result['mode']:<22}{result['rps']:>8.1f}{result['p50']:>9.1f}{result['p99']:>9.1f}"
+              f"{result['max']:>9.1f}{result['errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Cold-start time and per-worker memory of the gunicorn deployment (Linux only, reads /proc)
+#
+# Usage (from the project root):
+#   python benchmarks/worker_memory.py --workers 4                          # procfile setup (gunicorn.conf.py)
+#   MODEL_ENGINE=sklearn python benchmarks/worker_memory.py --workers 4 --no-config
+#
+# Starts gunicorn, waits until every worker has answered /ready with 200, sends a few /api/analyze requests,
+# then reports RSS, PSS (RSS with shared pages split between the processes sharing them) and USS
+# (private memory) for the master and each worker.
+
+import argparse
+import json
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+SAMPLE_REPORT = {
+    'gender': 'female',
+    'age': 58,
+    'testResults': {'Hemoglobin': 10.8, 'RBC': 3.5, 'WBC': 3.2, 'PLT': 112, 'MCV': 72, 'ESR': 42}
+}
+
+
+def memory_kb(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                values[parts[0].rstrip(':')] = int(parts[1])
+    uss = values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    return values.get('Rss', 0), values.get('Pss', 0), uss
+
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def request(url, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code == 503:
+            raise SystemExit(f'Model failed to load: {e.read().decode()}')
+        return e.code, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure gunicorn cold start and per-worker memory')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--no-config', action='store_true', help='Run plain `gunicorn app:app` (no preload)')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}',
+               '--timeout', '600']
+    if args.no_config:
+        # An empty config file keeps gunicorn from picking up ./gunicorn.conf.py
+        empty_config = tempfile.NamedTemporaryFile(suffix='.py')
+        command += ['--config', empty_config.name]
+    else:
+        command += ['--config', 'gunicorn.conf.py']
+    command.append('app:app')
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Ready once every worker pid has answered /ready with 200
+        ready_pids = set()
+        while True:
+            if time.perf_counter() - started > args.timeout:
+                raise SystemExit('Timed out waiting for the workers')
+            try:
+                status, body = request(f'{base_url}/ready')
+            except OSError:
+                status, body = None, None
+            if status == 200:
+                ready_pids.add(body['pid'])
+            workers = children(server.pid)
+            if len(workers) == args.workers and ready_pids >= set(workers):
+                break
+            if status == 404:
+                raise SystemExit('/ready is not available in this version of app.py')
+            time.sleep(0.05)
+        cold_start = time.perf_counter() - started
+
+        for _ in range(4 * args.workers):
+            request(f'{base_url}/api/analyze', SAMPLE_REPORT)
+
+        print(f"Cold start until all {args.workers} workers ready: {cold_start:.2f}s")
+        print(f"{'process':<10}{'pid':>8}{'RSS MB':>10}{'PSS MB':>10}{'USS MB':>10}")
+        total_pss = 0
+        for role, pid in [('master', server.pid)] + [('worker', pid) for pid in children(server.pid)]:
+            rss, pss, uss = memory_kb(pid)
+            total_pss += pss
+            print(f"{role:<10}{pid:>8}{rss / 1024:>10.1f}{pss / 1024:>10.1f}{uss / 1024:>10.1f}")
+        print(f"Total PSS: {total_pss / 1024:.1f} MB")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Offline bulk scoring of lab report CSVs with the same logic as /api/analyze
+#
+# Usage:
+#   python bulk_score.py DOC-20250409-WA0001.csv -o scored.jsonl
+#   python bulk_score.py big_export.csv -o scored.csv --format csv --workers 8 --chunksize 20000
+#
+# The CSV is read in chunks which are fanned out to a process pool. Every worker imports app.py once,
+# which loads the static/ml_model artifacts, and scores whole chunks with analyze_reports().
+# Results are written in input order as they complete, with a bounded number of chunks in flight.
+
+import argparse
+import csv
+import io
+import json
+import os
+import resource
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ID_COLUMN = 'Patient ID'
+
+# Set in each worker process by init_worker()
+analyzer = None
+
+
+def init_worker(engine):
+    global analyzer
+    if engine:
+        os.environ['MODEL_ENGINE'] = engine
+    # app.py loads the model artifacts relative to the project directory
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    import app
+    analyzer = app
+
+
+# Convert a chunk of CSV rows into /api/analyze payloads
+def chunk_to_reports(chunk):
+    test_cols = [col for col in chunk.columns if col not in (ID_COLUMN, 'Age', 'Sex')]
+    reports = []
+
+    for row in chunk.to_dict('records'):
+        sex, age = row.get('Sex'), row.get('Age')
+        reports.append({
+            'gender': sex if isinstance(sex, str) else None,
+            'age': None if pd.isna(age) else age,
+            'testResults': {col: None if pd.isna(row[col]) else row[col] for col in test_cols}
+        })
+
+    return reports
+
+
+def blood_test_names():
+    return list(analyzer.BLOOD_TESTS)
+
+
+def csv_columns(test_names):
+    return [ID_COLUMN, 'error', 'abnormal_tests', 'ml_predictions'] + [f'{test} status' for test in test_names]
+
+
+# Flatten one report into a CSV row
+def csv_row(patient_id, result, test_names):
+    if 'error' in result:
+        return [patient_id, result['error'], '', ''] + [''] * len(test_names)
+
+    analysis = result['analysis']
+    abnormal = [f"{test}:{entry['status']}" for test, entry in analysis.items() if entry['status'] != 'normal']
+    predictions = [f'{condition}={prob:.2f}' for condition, prob in result['ml_predictions'].items()]
+    statuses = [analysis[test]['status'] if test in analysis else '' for test in test_names]
+    return [patient_id, '', ';'.join(abnormal), ';'.join(predictions)] + statuses
+
+
+# Score one chunk in a worker and return it already serialized, so only text goes back to the parent
+def score_chunk(chunk, output_format):
+    results = analyzer.analyze_reports(chunk_to_reports(chunk))
+
+    if ID_COLUMN in chunk.columns:
+        patient_ids = chunk[ID_COLUMN].tolist()
+    else:
+        patient_ids = [None] * len(chunk)
+
+    buffer = io.StringIO()
+    if output_format == 'jsonl':
+        for patient_id, result in zip(patient_ids, results):
+            buffer.write(json.dumps({ID_COLUMN: patient_id, **result}))
+            buffer.write('\n')
+    else:
+        writer = csv.writer(buffer)
+        test_names = blood_test_names()
+        for patient_id, result in zip(patient_ids, results):
+            writer.writerow(csv_row(patient_id, result, test_names))
+
+    return buffer.getvalue(), len(chunk)
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score a CSV of blood reports with the /api/analyze pipeline')
+    parser.add_argument('input', help='CSV with Age, Sex and test columns (and optionally Patient ID)')
+    parser.add_argument('-o', '--output', required=True, help='Output file')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='Output format (default: from the output extension)')
+    parser.add_argument('--chunksize', type=int, default=5000, help='Rows per chunk sent to a worker')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--engine', choices=['flat', 'sklearn'],
+                        help='Model engine; sklearn is faster per row on very large chunks (see PERFORMANCE.md)')
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ('csv' if args.output.endswith('.csv') else 'jsonl')
+
+    # Keep a couple of chunks queued per worker; more would only grow memory
+    max_pending = 2 * args.workers
+    pending = deque()
+    total_rows = 0
+    start = time.perf_counter()
+
+    with open(args.output, 'w', newline='', encoding='utf-8') as out, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                initargs=(args.engine,)) as pool:
+        if output_format == 'csv':
+            # The test columns come from BLOOD_TESTS; ask a worker so the parent never loads the model
+            csv.writer(out).writerow(csv_columns(pool.submit(blood_test_names).result()))
+
+        for chunk in pd.read_csv(args.input, chunksize=args.chunksize):
+            pending.append(pool.submit(score_chunk, chunk, output_format))
+
+            while len(pending) >= max_pending or (pending and pending[0].done()):
+                text, rows = pending.popleft().result()
+                out.write(text)
+                total_rows += rows
+
+        while pending:
+            text, rows = pending.popleft().result()
+            out.write(text)
+            total_rows += rows
+
+    elapsed = time.perf_counter() - start
+    print(f"Scored {total_rows} rows in {elapsed:.2f}s ({total_rows / elapsed:.0f} rows/s) with {args.workers} workers")
+    print(f"Peak RSS: parent {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB, "
+          f"largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
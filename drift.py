@@ -0,0 +1,345 @@
+# Input drift monitor: live report values and predicted conditions against statistics of the training data
+#
+# train_model.py stores drift_reference.json in every bundle (for older bundles: `python drift.py reference`):
+#   features     per model input (Age and the tests): the bin edges (minimum, deciles, just above the maximum),
+#                the share of the training values in each bin and the share of missing values
+#   sex          share of male, female and other
+#   conditions   share of held-out reports for which each label crosses THRESHOLD
+#
+# Each process counts the reports it analyses in a fixed array of int64 counters: per feature one counter per bin
+# (a value below the training minimum or above the maximum has its own bin) plus one for a missing value, the
+# sex, and the reports on which each condition was predicted. Recording a report is a bisect per feature and a
+# few increments of shared memory, no allocation. With METRICS_DIR (set by gunicorn.conf.py) the array is a file
+# <METRICS_DIR>/drift_<reference>_<pid>_<start>.bin, so report() adds up the counts of all workers, including ones
+# that have exited; without it the counts are those of the current process. The memory used does not grow with
+# the traffic.
+#
+# report() compares the counts with the reference: the population stability index (PSI) of every feature's
+# bins, missing and out-of-range rates, and the rate of every condition with a binomial z-score.
+#
+# Usage:
+#   python drift.py reference synthetic_blood_reports.csv     # drift_reference.json for the active bundle
+#   python drift.py replay DOC-20250409-WA0001.csv            # drift report of a CSV taken as live traffic
+
+import argparse
+import bisect
+import glob
+import hashlib
+import json
+import math
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from features import FeatureAssembler
+from forest import load_forest, load_sklearn_bundle
+from model_bundle import DRIFT_REFERENCE_FILE, FOREST_FILE, current_model_dir, update_manifest, write_json_atomic
+
+# Label threshold of predict_abnormalities_batch() in app.py, and its answer when no label crosses it
+THRESHOLD = 0.9
+NO_CONDITION = {'Normal': 100}
+
+SEX_CATEGORIES = ('male', 'female', 'other')
+
+# Counters at the start of the array: reports seen, reports the model scored
+REPORTS, SCORED = 0, 1
+
+# Features with fewer live values are reported without a status; PSI above these is moderate / significant drift
+MIN_VALUES = 100
+PSI_MODERATE = 0.1
+PSI_SIGNIFICANT = 0.25
+
+# Share used for empty bins in the PSI, which is otherwise infinite
+PSI_EPSILON = 1e-4
+
+# A condition rate further than this many standard errors from the reference rate is flagged
+CONDITION_Z = 4
+
+
+# Decile bins of a feature's values; the outer edges make values outside the training range bins of their own
+def bin_edges(values):
+    inner = np.quantile(values, np.linspace(0.1, 0.9, 9))
+    return np.unique(np.concatenate([[values.min()], inner, [np.nextafter(values.max(), np.inf)]]))
+
+
+# Reference statistics of a dataset: numeric is a (rows, columns) float matrix with NaN for missing values,
+# sex the sex of every row and probabilities the model's condition probabilities on held-out rows
+def reference_statistics(numeric, columns, sex, probabilities, classes, threshold=THRESHOLD):
+    features = {}
+    for k, name in enumerate(columns):
+        values = numeric[:, k][~np.isnan(numeric[:, k])]
+        if len(values) == 0:
+            continue
+        edges = bin_edges(values)
+        counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+        features[name] = {'edges': edges.tolist(), 'proportions': (counts / len(values)).tolist(),
+                          'missing_rate': 1 - len(values) / len(numeric)}
+
+    sex = pd.Series(sex).astype(str).str.lower()
+    crossed = np.asarray(probabilities) > threshold
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'rows': len(numeric),
+        'features': features,
+        'sex': {category: float((sex == category).mean()) if category != 'other'
+                else float((~sex.isin(SEX_CATEGORIES[:-1])).mean()) for category in SEX_CATEGORIES},
+        'threshold': threshold,
+        'condition_rows': len(crossed),
+        'conditions': {str(name): float(rate) for name, rate in zip(classes, crossed.mean(axis=0))}
+    }
+
+
+# Population stability index of observed against expected bin shares
+def psi(observed, expected):
+    observed = np.maximum(observed, PSI_EPSILON)
+    expected = np.maximum(expected, PSI_EPSILON)
+    return float(np.sum((observed - expected) * np.log(observed / expected)))
+
+
+def psi_status(value, count):
+    if count < MIN_VALUES:
+        return 'insufficient data'
+    if value >= PSI_SIGNIFICANT:
+        return 'significant'
+    return 'moderate' if value >= PSI_MODERATE else 'stable'
+
+
+class DriftMonitor:
+    def __init__(self, reference, directory=None):
+        self.reference = reference
+        self.fingerprint = hashlib.sha256(json.dumps(reference, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.directory = directory
+
+        # (name, bin edges, first bin counter, missing counter) of every feature, then the sex and condition counters
+        self.features = []
+        position = SCORED + 1
+        for name, entry in reference['features'].items():
+            missing = position + len(entry['edges']) + 1
+            self.features.append((name, entry['edges'], position, missing))
+            position = missing + 1
+        self.sex_position = position
+        position += len(SEX_CATEGORIES)
+        self.sex_index = {category: i for i, category in enumerate(SEX_CATEGORIES[:-1])}
+        self.condition_positions = {name: position + i for i, name in enumerate(reference['conditions'])}
+        self.size = position + len(reference['conditions'])
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.counts = None
+
+    @classmethod
+    def load(cls, path, directory=None):
+        with open(path) as f:
+            return cls(json.load(f), directory)
+
+    # Counters of the current process; a forked worker starts its own file instead of writing to its parent's
+    def process_counts(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    if self.directory:
+                        os.makedirs(self.directory, exist_ok=True)
+                        path = os.path.join(self.directory,
+                                            f'drift_{self.fingerprint}_{os.getpid()}_{time.time_ns()}.bin')
+                        with open(path, 'w+b') as f:
+                            f.truncate(self.size * 8)
+                            memory = mmap.mmap(f.fileno(), self.size * 8)
+                    else:
+                        memory = mmap.mmap(-1, self.size * 8)
+                    self.counts = memoryview(memory).cast('q')
+                    self.pid = os.getpid()
+        return self.counts
+
+    # Count analysed reports, given as (test_results, gender, age, ml_predictions) tuples
+    def record(self, reports):
+        counts = self.process_counts()
+        features, sex_position, sex_index = self.features, self.sex_position, self.sex_index
+        condition_positions = self.condition_positions
+        other = len(SEX_CATEGORIES) - 1
+        with self.lock:
+            for test_results, gender, age, ml_predictions in reports:
+                counts[REPORTS] += 1
+                for name, edges, position, missing in features:
+                    value = age if name == 'Age' else test_results.get(name)
+                    if value is None or value != value:
+                        counts[missing] += 1
+                    else:
+                        counts[position + bisect.bisect_right(edges, value)] += 1
+                counts[sex_position + sex_index.get(gender, other)] += 1
+
+                if 'Error' not in ml_predictions:
+                    counts[SCORED] += 1
+                    # {'Normal': 100} stands for no condition over the threshold, not for the model's Normal label
+                    if ml_predictions == NO_CONDITION:
+                        continue
+                    for condition in ml_predictions:
+                        position = condition_positions.get(condition)
+                        if position is not None:
+                            counts[position] += 1
+
+    # Counters summed over the files of all processes using this reference
+    def totals(self):
+        totals = np.zeros(self.size, dtype=np.int64)
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, f'drift_{self.fingerprint}_*.bin')):
+                counts = np.fromfile(path, dtype=np.int64)
+                if len(counts) == self.size:
+                    totals += counts
+        elif self.counts is not None:
+            totals += np.frombuffer(self.counts, dtype=np.int64)
+        return totals
+
+    def report(self):
+        totals = self.totals()
+        reports, scored = int(totals[REPORTS]), int(totals[SCORED])
+
+        features = {}
+        for name, edges, position, missing in self.features:
+            reference = self.reference['features'][name]
+            bins = totals[position:missing]
+            count = int(bins.sum())
+            value = psi(bins / count, reference['proportions']) if count else None
+            features[name] = {
+                'values': count,
+                'psi': round(value, 4) if count else None,
+                'status': psi_status(value, count),
+                'missing_rate': round(int(totals[missing]) / reports, 4) if reports else None,
+                'reference_missing_rate': round(reference['missing_rate'], 4),
+                'below_training_range': round(int(bins[0]) / count, 4) if count else None,
+                'above_training_range': round(int(bins[-1]) / count, 4) if count else None
+            }
+
+        sex_counts = totals[self.sex_position:self.sex_position + len(SEX_CATEGORIES)]
+        sex_reference = [self.reference['sex'][category] for category in SEX_CATEGORIES]
+        sex_psi = psi(sex_counts / reports, sex_reference) if reports else None
+        sex = {'psi': round(sex_psi, 4) if reports else None, 'status': psi_status(sex_psi, reports),
+               'shares': {category: round(int(c) / reports, 4) if reports else None
+                          for category, c in zip(SEX_CATEGORIES, sex_counts)},
+               'reference_shares': dict(zip(SEX_CATEGORIES, sex_reference))}
+
+        conditions = {}
+        for name, position in self.condition_positions.items():
+            expected = self.reference['conditions'][name]
+            rate = int(totals[position]) / scored if scored else None
+            # Binomial z-score; a reference rate of 0 or 1 is taken as one report in the reference set
+            floor = 1 / max(self.reference['condition_rows'], 1)
+            p = min(max(expected, floor), 1 - floor)
+            z = (rate - expected) / math.sqrt(p * (1 - p) / scored) if scored else None
+            conditions[name] = {'rate': round(rate, 4) if scored else None, 'reference_rate': round(expected, 4),
+                                'z': round(z, 2) if scored else None,
+                                'flagged': bool(scored >= MIN_VALUES and abs(z) > CONDITION_Z)}
+
+        return {
+            'reference': {'fingerprint': self.fingerprint, 'created': self.reference.get('created'),
+                          'rows': self.reference['rows']},
+            'reports': reports,
+            'scored_reports': scored,
+            'threshold': self.reference['threshold'],
+            'drifted_features': sorted(name for name, entry in features.items()
+                                       if entry['status'] in ('moderate', 'significant')),
+            'flagged_conditions': sorted(name for name, entry in conditions.items() if entry['flagged']),
+            'features': features,
+            'sex': sex,
+            'conditions': conditions
+        }
+
+
+# Model inputs of a report CSV: numeric columns, sex, and the /api/analyze style dicts of the rows
+def read_reports(path, columns):
+    frame = pd.read_csv(path)
+    numeric = np.column_stack([pd.to_numeric(frame[column], errors='coerce').to_numpy(dtype=float)
+                               if column in frame.columns else np.full(len(frame), np.nan) for column in columns])
+    sex = frame['Sex'].astype(str).str.strip().str.lower().to_numpy()
+    reports = [{'Sex': s, **{column: value for column, value in zip(columns, row) if value == value}}
+               for s, row in zip(sex, numeric.tolist())]
+    return numeric, sex, reports
+
+
+# Labels and condition probabilities of the model of a bundle, flat forest first like app.py
+def model_probabilities(model_dir, reports):
+    path = os.path.join(model_dir, FOREST_FILE)
+    if os.path.exists(path):
+        forest = load_forest(path)
+        X = FeatureAssembler(forest.columns, forest.medians).assemble_batch(reports)
+        return list(forest.classes), forest.predict_proba(X)
+    model, mlb, imputer, train_cols = load_sklearn_bundle(model_dir)
+    X = FeatureAssembler.from_imputer(train_cols, imputer).assemble_batch(reports)
+    return list(mlb.classes_), np.column_stack([label_probs[:, 1] for label_probs in model.predict_proba(X)])
+
+
+def model_columns(model_dir):
+    path = os.path.join(model_dir, FOREST_FILE)
+    columns = load_forest(path).columns if os.path.exists(path) else load_sklearn_bundle(model_dir)[3]
+    return [column for column in columns if not column.startswith('Sex_')]
+
+
+def reference_command(args):
+    columns = model_columns(args.model_dir)
+    numeric, sex, reports = read_reports(args.data, columns)
+    classes, probabilities = model_probabilities(args.model_dir, reports)
+    reference = reference_statistics(numeric, columns, sex, probabilities, classes)
+    output = args.output or os.path.join(args.model_dir, DRIFT_REFERENCE_FILE)
+    write_json_atomic(output, reference)
+    update_manifest(output)
+    print(f"Wrote {output}: {len(reference['features'])} features, {len(classes)} conditions, {len(numeric)} rows")
+
+
+def replay_command(args):
+    reference_path = args.reference or os.path.join(args.model_dir, DRIFT_REFERENCE_FILE)
+    monitor = DriftMonitor.load(reference_path)
+    columns = list(monitor.reference['features'])
+    numeric, sex, reports = read_reports(args.data, columns)
+    classes, probabilities = model_probabilities(args.model_dir, reports)
+
+    records = []
+    for report, row in zip(reports, probabilities):
+        predictions = {classes[i]: round(row[i], 4) * 100 for i in np.flatnonzero(row > THRESHOLD)}
+        records.append(({column: value for column, value in report.items() if column not in ('Sex', 'Age')},
+                        report['Sex'], report.get('Age'), predictions or NO_CONDITION))
+    started = time.perf_counter()
+    monitor.record(records)
+    elapsed = time.perf_counter() - started
+    report = monitor.report()
+
+    print(f"{report['reports']} reports from {args.data} against {reference_path} "
+          f"(recorded in {elapsed / len(records) * 1e6:.1f} µs per report)")
+    print(f"{'feature':<12}{'PSI':>8}{'status':>20}{'missing':>9}{'ref':>7}{'below':>8}{'above':>8}")
+    for name, entry in report['features'].items():
+        psi_text = f"{entry['psi']:.3f}" if entry['psi'] is not None else '-'
+        below = f"{entry['below_training_range']:.2f}" if entry['values'] else '-'
+        above = f"{entry['above_training_range']:.2f}" if entry['values'] else '-'
+        print(f"{name:<12}{psi_text:>8}{entry['status']:>20}{entry['missing_rate']:>9.2f}"
+              f"{entry['reference_missing_rate']:>7.2f}{below:>8}{above:>8}")
+    print(f"Sex: PSI {report['sex']['psi']:.3f} ({report['sex']['status']}), shares {report['sex']['shares']}")
+    print(f"\n{'condition':<32}{'rate':>8}{'reference':>11}{'z':>9}")
+    for name, entry in report['conditions'].items():
+        print(f"{name:<32}{entry['rate']:>8.3f}{entry['reference_rate']:>11.3f}{entry['z']:>9.1f}"
+              f"{'  flagged' if entry['flagged'] else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reference statistics and reports of the input drift monitor')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('reference', help='Write the reference statistics of a dataset for a bundle')
+    command.add_argument('data')
+    command.add_argument('--model-dir', default=current_model_dir())
+    command.add_argument('--output', help=f'Default: {DRIFT_REFERENCE_FILE} in --model-dir')
+    command.set_defaults(run=reference_command)
+
+    command = commands.add_parser('replay', help='Drift report of a report CSV taken as live traffic')
+    command.add_argument('data')
+    command.add_argument('--model-dir', default=current_model_dir())
+    command.add_argument('--reference', help=f'Default: {DRIFT_REFERENCE_FILE} in --model-dir')
+    command.set_defaults(run=replay_command)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
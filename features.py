@@ -0,0 +1,73 @@
+# Pandas-free feature assembly for predict_abnormalities()
+#
+# The training columns and the fitted SimpleImputer medians are compiled once into a template row.
+# Assembling a request is then a copy of that row plus one assignment per submitted value,
+# instead of building a DataFrame, imputing, one-hot encoding and reordering columns.
+#
+# tests/test_features.py checks the assembler against the original pandas pipeline (`python -m pytest tests`).
+
+import numpy as np
+
+
+class FeatureAssembler:
+    # medians maps each imputed column to the value used when it is missing
+    def __init__(self, train_cols, medians):
+        self.columns = list(train_cols)
+
+        # Columns the imputer did not see are filled with 0, like the missing columns in the pandas path
+        self.template = np.zeros(len(self.columns))
+        self.value_positions = {}
+        self.sex_positions = {}
+
+        for pos, col in enumerate(self.columns):
+            if col.startswith('Sex_'):
+                self.sex_positions[col[len('Sex_'):]] = pos
+            else:
+                self.value_positions[col] = pos
+                self.template[pos] = medians.get(col, 0)
+
+    @classmethod
+    def from_imputer(cls, train_cols, imputer):
+        return cls(train_cols, dict(zip(imputer.feature_names_in_, imputer.statistics_)))
+
+    # Write one patient into a row that already holds the template values
+    def _fill(self, row, patient_data):
+        for key, value in patient_data.items():
+            if key == 'Sex':
+                pos = self.sex_positions.get(value)
+                if pos is not None:
+                    row[pos] = 1
+                continue
+
+            pos = self.value_positions.get(key)
+            # None and NaN are missing values, which the template already holds the median for
+            if pos is not None and value is not None and value == value:
+                row[pos] = value
+
+    def assemble(self, patient_data):
+        row = self.template.copy()
+        self._fill(row, patient_data)
+        return row
+
+    # Model input matrix for a list of patients, one preallocated row each
+    def assemble_batch(self, patients):
+        matrix = np.empty((len(patients), len(self.columns)))
+        matrix[:] = self.template
+        for row, patient_data in zip(matrix, patients):
+            self._fill(row, patient_data)
+        return matrix
+
+    # The same for a DataFrame of reports with a Sex column, one column at a time, for offline jobs over large files
+    def assemble_frame(self, frame):
+        matrix = np.empty((len(frame), len(self.columns)))
+        matrix[:] = self.template
+        for col, pos in self.value_positions.items():
+            if col in frame.columns:
+                values = frame[col].to_numpy(dtype=float)
+                present = ~np.isnan(values)
+                matrix[present, pos] = values[present]
+        sex = frame['Sex'].to_numpy(dtype=object) if 'Sex' in frame.columns else np.full(len(frame), None)
+        for value, pos in self.sex_positions.items():
+            matrix[sex == value, pos] = 1
+        return matrix
+
@@ -0,0 +1,501 @@
+# Flattened, array-based inference engine for the blood report RandomForest
+#
+# The model trained in train_ml_model.ipynb is a MultiOutputClassifier holding one 200-tree
+# RandomForestClassifier per condition label. export_forest() flattens every tree of every label into
+# contiguous node arrays, renumbered so the two children of a node are adjacent:
+#     feature[n], threshold[n]   split of node n (leaves get threshold +inf)
+#     value[n]                   probability of the positive class at node n
+#     node_code[n]               left child of n shifted left by split_bits, OR the id of the split of n
+#                                (the right child is the left child + 1, a leaf points to itself)
+# The ~600k internal nodes only use ~12k distinct (feature, threshold) splits. FlatForest evaluates those
+# splits once per row, then walks all trees of all labels for a block of rows at once, one depth level per
+# step, with two gathers per step: the node code and the outcome of its split.
+#
+# The file format (array_file.py) is a small JSON header followed by the raw arrays, so it can be memory-mapped.
+# Besides the trees it carries the training columns, imputer medians and label names, which makes it
+# a complete serving bundle that needs only NumPy to load.
+#
+# Usage:
+#   python forest.py export      # *.pkl -> blood_report_forest.bin in the active model bundle (model_bundle.py)
+#   python forest.py benchmark   # latency and throughput against sklearn on synthetic_blood_reports.csv
+#   python forest.py compact --prune --max-trees 100   # blood_report_forest.compact.bin, see compact_forest()
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from array_file import read_arrays, write_arrays
+from model_bundle import COMPACT_FOREST_FILE, FOREST_FILE, current_model_dir, update_manifest
+
+MAGIC = b'BRFOREST'
+
+# Rows evaluated together; bounds the (rows x trees) working arrays to a few MB
+BLOCK_ROWS = 64
+
+
+class FlatForest:
+    def __init__(self, arrays, meta):
+        self.arrays = dict(arrays)
+        # Not needed for scoring; compact forests leave them out
+        self.feature = arrays.get('feature')
+        self.threshold = arrays.get('threshold')
+        self.value = arrays['value']
+        self.node_code = arrays['node_code']
+        self.split_feature = arrays['split_feature']
+        self.split_threshold = arrays['split_threshold']
+        self.roots = arrays['roots']
+        self.label_offsets = arrays['label_offsets']
+
+        self.meta = meta
+        self.columns = meta['columns']
+        self.classes = meta['classes']
+        self.medians = meta['medians']
+        self.max_depth = meta['max_depth']
+        self.split_bits = meta['split_bits']
+        self.split_mask = (1 << self.split_bits) - 1
+        self.trees_per_label = np.diff(self.label_offsets)
+        # Trees each label's sum of leaf values is divided by; more than it keeps when all-zero trees were pruned
+        self.divisor = arrays.get('divisor', self.trees_per_label)
+        self._contribution_tables = None
+
+    @property
+    def child(self):
+        return self.node_code >> self.split_bits
+
+    # Leaf reached by every (row, tree) pair
+    def apply(self, X):
+        # sklearn trees compare float32 inputs against float64 thresholds; cast the same way. Compact forests
+        # store the thresholds rounded down to float32, which gives the same outcomes for float32 inputs.
+        X = np.asarray(X, dtype=np.float32).astype(self.split_threshold.dtype)
+        n_rows = len(X)
+        n_splits = len(self.split_threshold)
+
+        # Outcome of every distinct split for every row; the extra last column is the never-true leaf split
+        go_right = np.zeros((n_rows, n_splits + 1), dtype=np.int64)
+        np.greater(X[:, self.split_feature], self.split_threshold, out=go_right[:, :n_splits], casting='unsafe')
+        go_right = go_right.ravel()
+        row_offsets = (np.arange(n_rows, dtype=np.int64) * (n_splits + 1))[:, None]
+
+        nodes = np.repeat(self.roots[None, :], n_rows, axis=0)
+        for _ in range(self.max_depth):
+            code = self.node_code[nodes]
+            nodes = (code >> self.split_bits) + go_right[(code & self.split_mask) + row_offsets]
+        return nodes
+
+    # Probability of every label being present, shape (n_rows, n_labels)
+    def predict_proba(self, X):
+        X = np.atleast_2d(X)
+        probs = np.empty((len(X), len(self.classes)))
+
+        for start in range(0, len(X), BLOCK_ROWS):
+            leaf_values = self.value[self.apply(X[start:start + BLOCK_ROWS])]
+            probs[start:start + BLOCK_ROWS] = np.add.reduceat(leaf_values, self.label_offsets[:-1], axis=1)
+
+        probs /= self.divisor
+        return probs
+
+    # Per-node tables for explain(), built on first use:
+    #   delta[n]           value of node n minus the value of its parent (0 for roots)
+    #   parent_feature[n]  column the parent of n splits on, the input that sent a row to n
+    #   bias[label]        mean root value of the label's trees, its probability before any split
+    def contribution_tables(self):
+        if self._contribution_tables is None:
+            code = self.node_code.astype(np.int64)
+            child = code >> self.split_bits
+            internal = np.flatnonzero(child != np.arange(len(code)))
+            left = child[internal]
+            values = self.value.astype(np.float64)
+
+            delta = np.zeros(len(code), dtype=np.float32)
+            parent_feature = np.zeros(len(code), dtype=np.int16)
+            for side in (left, left + 1):
+                delta[side] = values[side] - values[internal]
+                parent_feature[side] = self.split_feature[code[internal] & self.split_mask]
+            bias = np.add.reduceat(values[self.roots], self.label_offsets[:-1]) / self.divisor
+            self._contribution_tables = (delta, parent_feature, bias)
+        return self._contribution_tables
+
+    # Contribution of every input column to the probability of selected labels (the tree interpreter of Saabas):
+    # each split a row passes moves it from the value of the parent to the value of the child, and the change is
+    # credited to the split column. Summed over the trees of a label and divided like predict_proba, the
+    # contributions add up to the probability minus the bias. Only the trees of the requested labels are walked.
+    # pairs lists (row of X, label index); returns the bias of every pair and an (n_pairs, n_columns) matrix
+    def explain(self, X, pairs):
+        delta, parent_feature, bias = self.contribution_tables()
+        n_columns = len(self.columns)
+        if not pairs:
+            return np.empty(0), np.empty((0, n_columns))
+
+        X = np.asarray(X, dtype=np.float32).astype(self.split_threshold.dtype)
+        rows, labels = np.array(pairs, dtype=np.int64).T
+        row_ids, row_index = np.unique(rows, return_inverse=True)
+        n_splits = len(self.split_threshold)
+        go_right = np.zeros((len(row_ids), n_splits + 1), dtype=np.uint8)
+        np.greater(X[row_ids][:, self.split_feature], self.split_threshold, out=go_right[:, :n_splits],
+                   casting='unsafe')
+        go_right = go_right.ravel()
+
+        # The trees of every pair's label, one after the other
+        tree_counts = self.trees_per_label[labels]
+        pair_of_tree = np.repeat(np.arange(len(pairs)), tree_counts)
+        trees = np.arange(len(pair_of_tree)) - np.repeat(np.cumsum(tree_counts) - tree_counts
+                                                         - self.label_offsets[labels], tree_counts)
+        row_offsets = row_index[pair_of_tree] * (n_splits + 1)
+
+        # Node of every tree after each step; a leaf points to itself, so only changes are real moves
+        nodes = self.roots[trees].astype(np.int64)
+        path = np.empty((self.max_depth + 1, len(trees)), dtype=np.int64)
+        path[0] = nodes
+        for depth in range(self.max_depth):
+            code = self.node_code[nodes]
+            nodes = (code >> self.split_bits) + go_right[(code & self.split_mask) + row_offsets]
+            path[depth + 1] = nodes
+        moved = path[1:] != path[:-1]
+        visited = path[1:][moved]
+
+        cells = np.broadcast_to(pair_of_tree, moved.shape)[moved] * n_columns + parent_feature[visited]
+        contributions = np.bincount(cells, weights=delta[visited], minlength=len(pairs) * n_columns)
+        contributions = contributions.reshape(len(pairs), n_columns) / self.divisor[labels, None]
+        return bias[labels], contributions
+
+
+# Flatten a fitted MultiOutputClassifier of RandomForestClassifiers
+def export_forest(model, columns, medians, classes):
+    features, thresholds, children, values, roots = [], [], [], [], []
+    label_offsets = [0]
+    n_nodes = 0
+    max_depth = 0
+
+    for label_model in model.estimators_:
+        positive = list(label_model.classes_).index(1) if 1 in label_model.classes_ else None
+
+        for estimator in label_model.estimators_:
+            tree = estimator.tree_
+            max_depth = max(max_depth, tree.max_depth)
+
+            # Breadth-first renumbering so that siblings get consecutive ids
+            order = [0]
+            new_child = np.zeros(tree.node_count, dtype=np.int64)
+            for node in order:
+                if tree.children_left[node] == -1:
+                    continue
+                new_child[node] = len(order)
+                order.extend((tree.children_left[node], tree.children_right[node]))
+
+            order = np.array(order)
+            position = np.empty(tree.node_count, dtype=np.int64)
+            position[order] = np.arange(tree.node_count)
+            is_leaf = tree.children_left[order] == -1
+
+            node_values = tree.value[order, 0, :]
+            node_values = node_values / node_values.sum(axis=1, keepdims=True)
+
+            features.append(np.where(is_leaf, 0, tree.feature[order]))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold[order]))
+            children.append(n_nodes + np.where(is_leaf, position[order], new_child[order]))
+            values.append(node_values[:, positive] if positive is not None else np.zeros(tree.node_count))
+            roots.append(n_nodes)
+            n_nodes += tree.node_count
+
+        label_offsets.append(len(roots))
+
+    feature = np.concatenate(features).astype(np.int32)
+    threshold = np.concatenate(thresholds).astype(np.float64)
+    child = np.concatenate(children).astype(np.int64)
+
+    # Distinct splits of the internal nodes; leaves use the extra split id that never goes right
+    internal = np.isfinite(threshold)
+    splits, split_ids = np.unique(np.stack([feature[internal].astype(np.float64), threshold[internal]]),
+                                  axis=1, return_inverse=True)
+    node_split = np.full(len(threshold), splits.shape[1], dtype=np.int64)
+    node_split[internal] = split_ids.ravel()
+    split_bits = int(splits.shape[1]).bit_length()
+
+    arrays = {
+        'feature': feature,
+        'threshold': threshold,
+        'value': np.concatenate(values).astype(np.float64),
+        'node_code': (child << split_bits) | node_split,
+        'split_feature': splits[0].astype(np.int64),
+        'split_threshold': splits[1],
+        'roots': np.array(roots, dtype=np.int64),
+        'label_offsets': np.array(label_offsets, dtype=np.int64)
+    }
+    meta = {
+        'columns': list(columns),
+        'classes': [str(name) for name in classes],
+        'medians': {str(col): float(median) for col, median in medians.items()},
+        'max_depth': int(max_depth),
+        'split_bits': split_bits
+    }
+    return FlatForest(arrays, meta)
+
+
+# Smaller copy of a forest for serving: float32 leaf values and thresholds, no feature/threshold arrays per node,
+# only the distinct splits the remaining trees use and int32 node codes when they fit.
+# max_trees keeps the first trees of every label; the trees of a forest are independent bootstrap fits, so this
+# is a smaller forest of the same kind. With prune_threshold, trees whose leaves are all zero are dropped (they
+# add nothing to the sum) and so are labels whose probability cannot exceed the threshold for any input.
+def compact_forest(forest, max_trees=None, prune_threshold=None):
+    split = forest.node_code & forest.split_mask
+    child = forest.child
+    n_splits = len(forest.split_threshold)
+    is_leaf = split == n_splits
+    ends = np.append(forest.roots[1:], len(forest.node_code))
+
+    # Largest leaf value of every tree bounds what it can add to its label's sum
+    tree_max = np.maximum.reduceat(np.where(is_leaf, forest.value, 0.0), forest.roots)
+
+    kept_trees, label_offsets, divisors, classes, pruned = [], [0], [], [], []
+    for label, name in enumerate(forest.classes):
+        trees = np.arange(forest.label_offsets[label], forest.label_offsets[label + 1])[:max_trees]
+        divisor = len(trees)
+        if prune_threshold is not None:
+            # Margin for the float32 sums
+            if tree_max[trees].sum() / divisor <= prune_threshold - 1e-6:
+                pruned.append(name)
+                continue
+            trees = trees[tree_max[trees] > 0]
+        kept_trees.append(trees)
+        label_offsets.append(label_offsets[-1] + len(trees))
+        divisors.append(divisor)
+        classes.append(name)
+
+    trees = np.concatenate(kept_trees)
+    sizes = ends[trees] - forest.roots[trees]
+    roots = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    nodes = np.concatenate([np.arange(forest.roots[tree], ends[tree]) for tree in trees])
+    node_child = child[nodes] + np.repeat(roots - forest.roots[trees], sizes)
+
+    # Renumber the splits still in use; leaves get the extra id after them
+    used_splits, node_split = np.unique(split[nodes], return_inverse=True)
+    if used_splits[-1] == n_splits:
+        used_splits = used_splits[:-1]
+    split_bits = int(len(used_splits)).bit_length()
+    node_code = (node_child << split_bits) | node_split
+    code_type = np.int32 if node_code.max() < 2 ** 31 else np.int64
+
+    # Rounded down, so that x > threshold keeps its outcome for every float32 x
+    split_threshold = forest.split_threshold[used_splits]
+    rounded = split_threshold.astype(np.float32)
+    rounded = np.where(rounded > split_threshold, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+
+    arrays = {
+        'value': forest.value[nodes].astype(np.float32),
+        'node_code': node_code.astype(code_type),
+        'split_feature': forest.split_feature[used_splits].astype(np.int32),
+        'split_threshold': rounded.astype(np.float32),
+        'roots': roots.astype(code_type),
+        'label_offsets': np.array(label_offsets, dtype=np.int64),
+        'divisor': np.array(divisors, dtype=np.float64)
+    }
+    meta = dict(forest.meta, classes=classes, split_bits=split_bits,
+                compact={'max_trees': max_trees, 'prune_threshold': prune_threshold, 'pruned_labels': pruned})
+    return FlatForest(arrays, meta)
+
+
+def save_forest(forest, path):
+    write_arrays(path, MAGIC, forest.arrays, forest.meta)
+
+
+# Load a forest file; with mmap=True the arrays are read-only views of the mapped file
+def load_forest(path, mmap_arrays=False):
+    try:
+        arrays, meta = read_arrays(path, MAGIC, mmap_arrays)
+    except ValueError:
+        raise ValueError(f'{path} is not a flattened forest file')
+    return FlatForest(arrays, meta)
+
+
+def load_sklearn_bundle(model_dir=None):
+    import joblib
+
+    model_dir = model_dir or current_model_dir()
+    model = joblib.load(f'{model_dir}/blood_report_model.pkl')
+    mlb = joblib.load(f'{model_dir}/label_binarizer.pkl')
+    imputer = joblib.load(f'{model_dir}/imputer.pkl')
+    train_cols = joblib.load(f'{model_dir}/training_columns.pkl')
+    return model, mlb, imputer, train_cols
+
+
+def export_command(args):
+    args.output = args.output or os.path.join(args.model_dir, FOREST_FILE)
+    model, mlb, imputer, train_cols = load_sklearn_bundle(args.model_dir)
+    forest = export_forest(model, train_cols, dict(zip(imputer.feature_names_in_, imputer.statistics_)), mlb.classes_)
+    save_forest(forest, args.output)
+    update_manifest(args.output)
+    print(f"Exported {len(forest.roots)} trees ({len(forest.feature)} nodes) for {len(forest.classes)} labels to {args.output}")
+
+
+def benchmark_command(args):
+    import pandas as pd
+    from features import FeatureAssembler
+
+    args.forest = args.forest or os.path.join(args.model_dir, FOREST_FILE)
+    model, mlb, imputer, train_cols = load_sklearn_bundle(args.model_dir)
+    forest = load_forest(args.forest)
+
+    df = pd.read_csv(args.data)
+    df['Sex'] = df['Sex'].str.lower()
+    X = FeatureAssembler.from_imputer(train_cols, imputer).assemble_batch(df.to_dict('records'))
+
+    def sklearn_proba(rows):
+        return np.column_stack([label_probs[:, 1] for label_probs in model.predict_proba(rows)])
+
+    def timed(fn, rows, repeat):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(rows)
+            times.append(time.perf_counter() - start)
+        return np.array(times)
+
+    import warnings
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    expected = sklearn_proba(X)
+    actual = forest.predict_proba(X)
+    print(f"Rows: {len(X)}, labels: {len(forest.classes)}, trees: {len(forest.roots)}")
+    print(f"Max abs difference vs sklearn: {np.abs(expected - actual).max():.2e}")
+    print(f"Labels over 0.9 that differ: {int(((expected > 0.9) != (actual > 0.9)).sum())}")
+
+    print(f"{'engine':<10}{'rows':>7}{'p50 ms':>11}{'p99 ms':>11}{'rows/s':>11}")
+    for rows in (1, 100, len(X)):
+        repeat = max(3, min(args.repeat, 2000 // rows))
+        for name, fn in (('sklearn', sklearn_proba), ('flat', forest.predict_proba)):
+            times = timed(fn, X[:rows], repeat)
+            print(f"{name:<10}{rows:>7}{np.percentile(times, 50) * 1000:>11.2f}"
+                  f"{np.percentile(times, 99) * 1000:>11.2f}{rows / np.median(times):>11.0f}")
+
+
+# Resident memory of a fresh interpreter after loading a forest file and scoring one block, in MB
+def resident_mb(path):
+    import subprocess
+    import sys
+
+    # Peak RSS from /proc (in kB): ru_maxrss would include the peak of this process, which survives the exec
+    script = (
+        'import sys\n'
+        'import numpy as np\n'
+        'from forest import load_forest\n'
+        'def peak():\n'
+        '    with open("/proc/self/status") as f:\n'
+        '        return next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))\n'
+        'before = peak()\n'
+        'forest = load_forest(sys.argv[1])\n'
+        'forest.predict_proba(np.zeros((64, len(forest.columns))))\n'
+        'print(peak() - before)\n'
+    )
+    output = subprocess.run([sys.executable, '-c', script, os.path.abspath(path)], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return int(output) / 1024
+
+
+def latency_ms(forest, X, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        forest.predict_proba(X[i % len(X):i % len(X) + 1])
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+# Largest number of trees per label whose single-row latency fits the budget
+def trees_for_budget(forest, X, budget_ms, prune_threshold, repeat):
+    low, high = 1, int(forest.trees_per_label.max())
+    while low < high:
+        middle = (low + high + 1) // 2
+        if latency_ms(compact_forest(forest, middle, prune_threshold), X, repeat) <= budget_ms:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def compact_command(args):
+    import pandas as pd
+    from features import FeatureAssembler
+
+    args.forest = args.forest or os.path.join(args.model_dir, FOREST_FILE)
+    args.output = args.output or os.path.join(args.model_dir, COMPACT_FOREST_FILE)
+    forest = load_forest(args.forest)
+    prune_threshold = args.threshold if args.prune else None
+
+    df = pd.read_csv(args.data)
+    df['Sex'] = df['Sex'].str.lower()
+    X = FeatureAssembler(forest.columns, forest.medians).assemble_batch(df.to_dict('records'))
+
+    max_trees = args.max_trees
+    if args.latency_budget_ms:
+        max_trees = trees_for_budget(forest, X, args.latency_budget_ms, prune_threshold, args.repeat)
+        print(f"Latency budget {args.latency_budget_ms} ms: {max_trees} trees per label")
+
+    compact = compact_forest(forest, max_trees, prune_threshold)
+    save_forest(compact, args.output)
+    update_manifest(args.output)
+
+    # Pruned labels count as probability 0
+    expected = forest.predict_proba(X)
+    actual = np.zeros_like(expected)
+    actual[:, [forest.classes.index(name) for name in compact.classes]] = compact.predict_proba(X)
+    changed = (expected > args.threshold) != (actual > args.threshold)
+
+    print(f"Rows: {len(X)} from {args.data}; labels {len(forest.classes)} -> {len(compact.classes)}, "
+          f"trees {len(forest.roots)} -> {len(compact.roots)}, nodes {len(forest.node_code)} -> {len(compact.node_code)}")
+    if compact.meta['compact']['pruned_labels']:
+        print(f"Pruned labels: {', '.join(compact.meta['compact']['pruned_labels'])}")
+    print(f"Max abs probability difference: {np.abs(expected - actual).max():.2e}")
+    print(f"Predicted labels (> {args.threshold}) that changed: {int(changed.sum())} of {changed.size}, "
+          f"in {int(changed.any(axis=1).sum())} of {len(X)} reports")
+
+    print(f"{'forest':<10}{'disk MB':>10}{'RSS MB':>10}{'1 row ms':>10}{'64 rows ms':>12}")
+    for name, model, path in (('full', forest, args.forest), ('compact', compact, args.output)):
+        block = X[:BLOCK_ROWS]
+        start = time.perf_counter()
+        for _ in range(args.repeat // 10 or 1):
+            model.predict_proba(block)
+        block_ms = (time.perf_counter() - start) / (args.repeat // 10 or 1) * 1000
+        print(f"{name:<10}{os.path.getsize(path) / 1e6:>10.1f}{resident_mb(path):>10.1f}"
+              f"{latency_ms(model, X, args.repeat):>10.2f}{block_ms:>12.2f}")
+    print(f"Saved {args.output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Flattened RandomForest export and benchmark')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='Flatten the sklearn model into a forest file')
+    export.add_argument('--model-dir', default=current_model_dir())
+    export.add_argument('--output', help='Default: blood_report_forest.bin in --model-dir')
+    export.set_defaults(handler=export_command)
+
+    benchmark = commands.add_parser('benchmark', help='Compare the flat engine with sklearn predict_proba')
+    benchmark.add_argument('--model-dir', default=current_model_dir())
+    benchmark.add_argument('--forest', help='Default: blood_report_forest.bin in --model-dir')
+    benchmark.add_argument('--data', default='synthetic_blood_reports.csv')
+    benchmark.add_argument('--repeat', type=int, default=50)
+    benchmark.set_defaults(handler=benchmark_command)
+
+    compact = commands.add_parser('compact', help='Write a smaller forest for serving and report what changes')
+    compact.add_argument('--model-dir', default=current_model_dir())
+    compact.add_argument('--forest', help='Default: blood_report_forest.bin in --model-dir')
+    compact.add_argument('--output', help='Default: blood_report_forest.compact.bin in --model-dir')
+    compact.add_argument('--max-trees', type=int, help='Keep at most this many trees per label')
+    compact.add_argument('--latency-budget-ms', type=float,
+                         help='Keep as many trees per label as fit this single-row latency')
+    compact.add_argument('--prune', action='store_true',
+                         help='Drop all-zero trees and labels that can never exceed --threshold')
+    compact.add_argument('--threshold', type=float, default=0.9, help='Threshold of predict_abnormalities()')
+    compact.add_argument('--data', default='synthetic_blood_reports.csv',
+                         help='Reports to compare on; preferably held out, e.g. from generate_dataset.py')
+    compact.add_argument('--repeat', type=int, default=200)
+    compact.set_defaults(handler=compact_command)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# Streaming generator of synthetic CBC reports, the scalable version of create_dataset.ipynb
+#
+# Usage:
+#   python generate_dataset.py 1000000 -o reports_1m.csv
+#   python generate_dataset.py 50000000 -o reports_50m.parquet --workers 8 --chunksize 250000 --seed 7
+#   python generate_dataset.py 100000 -o sick.csv --prevalence iron_deficiency=0.3 --missing-rate 0.1
+#
+# The columns are those of synthetic_blood_reports.csv (Age, Sex and the 16 tests), which is what
+# train_model.py and predict_abnormalities() expect; --extra-columns adds HCT and RDW-SD, --ids a Patient ID.
+#
+# Every row is built from a few physiological quantities, so the values agree with each other:
+#   RBC, MCV (cell volume) and MCHC (haemoglobin concentration in the cells) are drawn per sex and age,
+#   HCT = RBC x MCV / 10, Hemoglobin = HCT x MCHC / 100 (so HCT is about 3 x Hemoglobin) and
+#   MCH = Hemoglobin / RBC x 10; RDW-SD follows RDW-CV and MCV.
+#   WBC is log-normal and the differential (NEU/LYM/MON/EOS/BAS %) sums to 100;
+#   LYM# = WBC x LYM% / 100 and GRA# = WBC x (NEU% + EOS% + BAS%) / 100.
+# Conditions (DISEASES) are switched on per row with their prevalence and shift those quantities, e.g. iron
+# deficiency lowers MCV and MCHC and widens RDW, a bacterial infection raises WBC, NEU% and ESR.
+# Finally values are rounded like the notebook and blanked with --missing-rate (or --column-missing-rate).
+#
+# Rows are produced in chunks by a process pool and written in order, with at most two chunks per worker
+# in memory. Chunk i is generated from SeedSequence(seed, spawn_key=(i,)), so the same seed and chunk size
+# give the same file whatever the number of workers.
+
+import argparse
+import os
+import resource
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['Age', 'Sex', 'Hemoglobin', 'RBC', 'WBC', 'PLT', 'MCV', 'MCH', 'MCHC', 'RDW-CV',
+           'NEU%', 'LYM%', 'MON%', 'EOS%', 'BAS%', 'LYM#', 'GRA#', 'ESR']
+EXTRA_COLUMNS = ['HCT', 'RDW-SD']
+ID_COLUMN = 'Patient ID'
+
+# Decimals kept per column, as in create_dataset.ipynb
+DECIMALS = {
+    'Hemoglobin': 1, 'RBC': 2, 'WBC': 1, 'PLT': 0,
+    'MCV': 0, 'MCH': 1, 'MCHC': 1, 'RDW-CV': 1,
+    'NEU%': 1, 'LYM%': 1, 'MON%': 1, 'EOS%': 1, 'BAS%': 1,
+    'LYM#': 2, 'GRA#': 2, 'ESR': 0, 'HCT': 1, 'RDW-SD': 1
+}
+
+# Default share of rows with each condition; a row can have several
+DISEASES = {
+    'iron_deficiency': 0.08,
+    'b12_folate_deficiency': 0.03,
+    'thalassemia_trait': 0.02,
+    'chronic_disease_anemia': 0.04,
+    'polycythemia': 0.01,
+    'dehydration': 0.03,
+    'bacterial_infection': 0.06,
+    'viral_infection': 0.06,
+    'allergy': 0.05,
+    'chronic_inflammation': 0.05,
+    'thrombocytopenia': 0.02,
+    'leukemia': 0.003
+}
+
+# Mean share of NEU, LYM, MON, EOS, BAS in the differential, and how concentrated rows are around it
+DIFFERENTIAL = np.array([58.0, 30.0, 7.0, 3.0, 0.7])
+DIFFERENTIAL_CONCENTRATION = 0.8
+
+
+def chunk_seed(seed, index):
+    return np.random.SeedSequence(seed, spawn_key=(index,))
+
+
+# One chunk of reports as a DataFrame; prevalence maps DISEASES names to the share of affected rows and
+# missing_rates test columns to the share of blank values
+def generate_chunk(n, seed_sequence, prevalence, missing_rates, extra_columns=False, first_id=None):
+    rng = np.random.default_rng(seed_sequence)
+    age = rng.integers(18, 91, size=n)
+    male = rng.random(n) < 0.5
+    has = {name: rng.random(n) < rate for name, rate in prevalence.items()}
+
+    def shift(mask, low, high):
+        # Uniform effect size for the affected rows, zero elsewhere
+        return np.where(mask, rng.uniform(low, high, n), 0.0)
+
+    # Red cells: count (10^6/uL), mean cell volume (fL) and haemoglobin concentration in the cells (g/dL)
+    rbc = np.where(male, rng.normal(5.05, 0.35, n) - 0.004 * (age - 40), rng.normal(4.55, 0.3, n))
+    mcv = rng.normal(90.0, 4.0, n) + 0.04 * (age - 40)
+    mchc = rng.normal(33.5, 0.8, n)
+    rdw = rng.normal(13.0, 0.7, n)
+    wbc = rng.lognormal(np.log(6.8), 0.22, n)
+    plt = rng.lognormal(np.log(np.where(male, 240.0, 265.0)), 0.2, n)
+    esr = rng.lognormal(np.log(np.where(male, 3 + age / 10, 6 + age / 8)), 0.45, n)
+    differential = np.tile(DIFFERENTIAL, (n, 1))
+
+    iron = has.get('iron_deficiency', np.zeros(n, dtype=bool))
+    rbc *= 1 - shift(iron, 0.05, 0.2)
+    mcv -= shift(iron, 8, 20)
+    mchc -= shift(iron, 1, 3)
+    rdw += shift(iron, 1.5, 5)
+    plt *= 1 + shift(iron, 0, 0.4)
+
+    megaloblastic = has.get('b12_folate_deficiency', np.zeros(n, dtype=bool))
+    rbc *= 1 - shift(megaloblastic, 0.15, 0.4)
+    mcv += shift(megaloblastic, 10, 22)
+    rdw += shift(megaloblastic, 1, 4)
+    wbc *= 1 - shift(megaloblastic, 0, 0.3)
+    plt *= 1 - shift(megaloblastic, 0, 0.4)
+
+    thalassemia = has.get('thalassemia_trait', np.zeros(n, dtype=bool))
+    rbc *= 1 + shift(thalassemia, 0.05, 0.2)
+    mcv -= shift(thalassemia, 12, 22)
+    mchc -= shift(thalassemia, 0, 1.5)
+
+    chronic_anemia = has.get('chronic_disease_anemia', np.zeros(n, dtype=bool))
+    rbc *= 1 - shift(chronic_anemia, 0.1, 0.3)
+    esr += shift(chronic_anemia, 5, 30)
+
+    polycythemia = has.get('polycythemia', np.zeros(n, dtype=bool))
+    rbc *= 1 + shift(polycythemia, 0.15, 0.35)
+    wbc *= 1 + shift(polycythemia, 0, 0.5)
+    plt *= 1 + shift(polycythemia, 0.1, 0.8)
+
+    # Less plasma concentrates every cell count
+    dehydration = 1 + shift(has.get('dehydration', np.zeros(n, dtype=bool)), 0.05, 0.15)
+    rbc *= dehydration
+    wbc *= dehydration
+    plt *= dehydration
+
+    bacterial = has.get('bacterial_infection', np.zeros(n, dtype=bool))
+    wbc *= 1 + shift(bacterial, 0.4, 1.5)
+    differential[:, 0] *= 1 + shift(bacterial, 0.2, 0.6)
+    differential[:, 1] *= 1 - shift(bacterial, 0.2, 0.6)
+    esr += shift(bacterial, 10, 50)
+
+    viral = has.get('viral_infection', np.zeros(n, dtype=bool))
+    wbc *= 1 - shift(viral, 0, 0.4)
+    differential[:, 0] *= 1 - shift(viral, 0.1, 0.45)
+    differential[:, 1] *= 1 + shift(viral, 0.3, 1.0)
+    plt *= 1 - shift(viral, 0, 0.4)
+
+    allergy = has.get('allergy', np.zeros(n, dtype=bool))
+    differential[:, 3] *= 1 + shift(allergy, 1.5, 5)
+    differential[:, 4] *= 1 + shift(allergy, 0.5, 2.5)
+
+    inflammation = has.get('chronic_inflammation', np.zeros(n, dtype=bool))
+    esr += shift(inflammation, 15, 60)
+    plt *= 1 + shift(inflammation, 0.1, 0.6)
+    differential[:, 2] *= 1 + shift(inflammation, 0.2, 0.8)
+
+    plt *= 1 - shift(has.get('thrombocytopenia', np.zeros(n, dtype=bool)), 0.4, 0.85)
+
+    leukemia = has.get('leukemia', np.zeros(n, dtype=bool))
+    wbc *= 1 + shift(leukemia, 2, 10)
+    differential[:, 1] *= 1 + shift(leukemia, 0.5, 2)
+    rbc *= 1 - shift(leukemia, 0.2, 0.4)
+    plt *= 1 - shift(leukemia, 0.3, 0.7)
+
+    # Physiological limits
+    rbc = np.clip(rbc, 1.5, 8.0)
+    mcv = np.clip(mcv, 55, 130)
+    mchc = np.clip(mchc, 26, 38)
+    rdw = np.clip(rdw, 10, 30)
+    wbc = np.clip(wbc, 0.5, 150)
+    plt = np.clip(plt, 5, 1500)
+    esr = np.clip(esr, 1, 140)
+
+    # Derived red cell indices
+    hct = rbc * mcv / 10
+    hemoglobin = hct * mchc / 100
+    mch = hemoglobin / rbc * 10
+    rdw_sd = rdw * mcv / 100 * 3.6
+
+    # The differential as percentages summing to 100, then the absolute counts
+    percentages = rng.gamma(differential * DIFFERENTIAL_CONCENTRATION * 10)
+    percentages *= 100 / percentages.sum(axis=1, keepdims=True)
+    neu, lym, mon, eos, bas = percentages.T
+
+    data = {
+        'Age': age,
+        'Sex': np.where(male, 'male', 'female'),
+        'Hemoglobin': hemoglobin, 'RBC': rbc, 'WBC': wbc, 'PLT': plt, 'MCV': mcv, 'MCH': mch, 'MCHC': mchc,
+        'RDW-CV': rdw, 'NEU%': neu, 'LYM%': lym, 'MON%': mon, 'EOS%': eos, 'BAS%': bas,
+        'LYM#': wbc * lym / 100, 'GRA#': wbc * (neu + eos + bas) / 100, 'ESR': esr,
+        'HCT': hct, 'RDW-SD': rdw_sd
+    }
+    columns = COLUMNS + (EXTRA_COLUMNS if extra_columns else [])
+    df = pd.DataFrame({col: data[col] for col in columns})
+
+    for col in columns[2:]:
+        values = df[col].to_numpy().round(DECIMALS[col])
+        values[rng.random(n) < missing_rates.get(col, 0.0)] = np.nan
+        df[col] = values
+
+    if first_id is not None:
+        df.insert(0, ID_COLUMN, np.arange(first_id, first_id + n))
+    return df
+
+
+# Generate chunk `index` in a worker and return it serialized for the parent to write
+def generate_serialized(index, n, seed, prevalence, missing_rates, extra_columns, first_id, output_format):
+    df = generate_chunk(n, chunk_seed(seed, index), prevalence, missing_rates, extra_columns, first_id)
+    if output_format == 'csv':
+        return df.to_csv(header=False, index=False), n
+    return df, n
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+# NAME=RATE overrides of the DISEASES prevalence
+def parse_prevalence(items, scale):
+    prevalence = dict(DISEASES)
+    for item in items:
+        name, _, rate = item.partition('=')
+        if name not in DISEASES:
+            raise SystemExit(f"Unknown condition {name!r}; choose from {', '.join(DISEASES)}")
+        prevalence[name] = float(rate)
+    return {name: min(rate * scale, 1.0) for name, rate in prevalence.items()}
+
+
+# --missing-rate for every test, with COLUMN=RATE overrides
+def parse_missing_rates(rate, items):
+    missing_rates = {col: rate for col in COLUMNS[2:] + EXTRA_COLUMNS}
+    for item in items:
+        col, _, value = item.rpartition('=')
+        if col not in missing_rates:
+            raise SystemExit(f"Unknown test column {col!r}")
+        missing_rates[col] = float(value)
+    return missing_rates
+
+
+# Writes DataFrame chunks to one Parquet file; pyarrow is only needed for Parquet output
+class ParquetOutput:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Parquet output needs pyarrow (pip install pyarrow)')
+        self.pyarrow = pyarrow
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        table = self.pyarrow.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate synthetic blood reports for training and load tests')
+    parser.add_argument('rows', type=int, help='Number of reports')
+    parser.add_argument('-o', '--output', required=True, help='Output .csv or .parquet file')
+    parser.add_argument('--format', choices=['csv', 'parquet'], help='Output format (default: from the extension)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='Rows per chunk; the output depends on the seed and the chunk size')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--prevalence', action='append', default=[], metavar='NAME=RATE',
+                        help=f"Share of reports with a condition, repeatable ({', '.join(DISEASES)})")
+    parser.add_argument('--disease-scale', type=float, default=1.0, help='Multiply every prevalence')
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='Share of blank values per test')
+    parser.add_argument('--column-missing-rate', action='append', default=[], metavar='COLUMN=RATE',
+                        help='Share of blank values for one test, repeatable')
+    parser.add_argument('--extra-columns', action='store_true', help=f"Add {' and '.join(EXTRA_COLUMNS)}")
+    parser.add_argument('--ids', action='store_true', help=f'Add a {ID_COLUMN} column numbered from 1')
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    prevalence = parse_prevalence(args.prevalence, args.disease_scale)
+    missing_rates = parse_missing_rates(args.missing_rate, args.column_missing_rate)
+    columns = ([ID_COLUMN] if args.ids else []) + COLUMNS + (EXTRA_COLUMNS if args.extra_columns else [])
+
+    # Keep a couple of chunks queued per worker; more would only grow memory
+    max_pending = 2 * args.workers
+    pending = deque()
+    total_rows = 0
+    start = time.perf_counter()
+
+    if output_format == 'csv':
+        out = open(args.output, 'w', newline='', encoding='utf-8')
+        out.write(','.join(columns) + '\n')
+    else:
+        out = ParquetOutput(args.output)
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            def collect():
+                nonlocal total_rows
+                data, rows = pending.popleft().result()
+                out.write(data)
+                total_rows += rows
+
+            for index, first_row in enumerate(range(0, args.rows, args.chunksize)):
+                n = min(args.chunksize, args.rows - first_row)
+                pending.append(pool.submit(generate_serialized, index, n, args.seed, prevalence, missing_rates,
+                                           args.extra_columns, first_row + 1 if args.ids else None, output_format))
+
+                while len(pending) >= max_pending or (pending and pending[0].done()):
+                    collect()
+
+            while pending:
+                collect()
+    finally:
+        out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {total_rows} rows to {args.output} in {elapsed:.2f}s ({total_rows / elapsed:.0f} rows/s) "
+          f"with {args.workers} workers")
+    print(f"Peak RSS: parent {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB, "
+          f"largest worker {peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Gunicorn settings used by the procfile
+#
+# The app is imported once in the master and the workers are forked from it, so the model is loaded
+# and warmed a single time. The flattened forest is memory-mapped, which keeps one copy of its arrays
+# in the page cache for all workers; the sklearn pickle (MODEL_ENGINE=sklearn) is shared copy-on-write.
+# The number of workers comes from WEB_CONCURRENCY or --workers as usual.
+#
+# Workers are sync workers with one thread unless WEB_THREADS is set: a number of threads per worker (gthread), or
+# 'admission' for enough threads for the admission control of app.py, ADMISSION_MAX_IN_FLIGHT requests analysed
+# plus ADMISSION_MAX_QUEUE waiting and 2 more so pages and static files always find a thread. A sync worker holds
+# one request at a time, so the in-flight and queue limits only engage with threads. --threads or
+# GUNICORN_CMD_ARGS still override it.
+#
+# Each process records its metrics and drift counts in files under METRICS_DIR, which /metrics and /api/drift
+# sum up (see metrics.py and drift.py), and its admitted requests per client, which the admission control of the
+# other workers reads (admission.py). Unless METRICS_DIR is set, every server start gets a fresh temporary
+# directory, removed on exit.
+#
+# The static assets (see assets.py) are built here, before the app is imported, when a source changed, and so is
+# the population and similar report indexes when there are none (see population.py and neighbors.py).
+
+import gc
+import glob
+import os
+import shutil
+import tempfile
+
+from assets import ensure_assets
+from neighbors import ensure_index as ensure_similar_index
+from population import ensure_index as ensure_population_index
+
+preload_app = True
+
+if os.environ.get('WEB_THREADS') == 'admission':
+    threads = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', '4')) + int(os.environ.get('ADMISSION_MAX_QUEUE', '8')) + 2
+elif os.environ.get('WEB_THREADS'):
+    threads = int(os.environ['WEB_THREADS'])
+
+ensure_assets()
+ensure_population_index()
+ensure_similar_index()
+
+if os.environ.get('METRICS_DIR'):
+    # Counts of a previous run of the server must not be added to this one
+    for pattern in ('metrics_*.db', 'drift_*.bin', 'admission_*.bin'):
+        for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], pattern)):
+            os.remove(path)
+    created_metrics_dir = None
+else:
+    created_metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='blood_report_metrics_')
+
+
+def when_ready(server):
+    # Everything allocated while loading the model lives for the whole process. Freezing it keeps the
+    # garbage collector in the workers from writing to those objects and un-sharing their pages.
+    gc.freeze()
+
+
+def on_exit(server):
+    if created_metrics_dir:
+        shutil.rmtree(created_metrics_dir, ignore_errors=True)
@@ -0,0 +1,165 @@
+# Condition knowledge base compiled once at startup
+#
+# Three sources describe the same conditions:
+#   BLOOD_TESTS        per test and direction (low/high), the conditions and symptoms as comma-joined text
+#   ABNORMALITIES      description and recommendations of the conditions that have an entry, keyed by exact name
+#   the reference CSV  per test and direction, more conditions plus food suggestions (FOOD_SUGGESTIONS_CSV)
+# KnowledgeBase parses them into read-only indexes:
+#   names       normalized name (case, spacing, parentheses, ALIASES) -> canonical condition name
+#   conditions  canonical name -> Condition with its recommendations and the (test, direction) pairs naming it
+#   by_test     (test, direction) -> TestDirection with its conditions, symptoms and food suggestions
+# Conditions without an ABNORMALITIES entry (most model labels) are described by the tests that name them and
+# get the food suggestions of those tests as recommendations.
+
+import csv
+import logging
+import os
+import re
+import sys
+from collections import namedtuple
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+FOOD_SUGGESTIONS_CSV = 'Blood_Test_Reference_Table_With_Food_Suggestions.csv'
+DIRECTIONS = ('low', 'high')
+
+# Normalized spelling variants -> canonical condition name. Only spellings of one name belong here: related but
+# distinct conditions (e.g. 'Bone marrow failure' and 'Bone marrow disorder') are separate model labels, and an
+# alias would give one of them the recommendations of the other.
+ALIASES = {
+    'anaemia': 'Anemia',
+    'b12 deficiency': 'Vitamin B12 deficiency',
+    'iron deficiency anaemia': 'Iron deficiency anemia',
+    'viral': 'Viral infection',
+}
+
+# Entries of the CSV condition columns that are not conditions
+NOT_CONDITIONS = {'normal', 'not a concern', 'not clinically significant', 'rarely significant'}
+
+Condition = namedtuple('Condition', ['name', 'description', 'recommendations', 'tests'])
+TestDirection = namedtuple('TestDirection', ['conditions', 'symptoms', 'suggestions'])
+
+
+def normalize_name(name):
+    name = re.sub(r'\([^)]*\)', ' ', name)
+    return ' '.join(name.casefold().split())
+
+
+# Split comma-joined text, ignoring commas inside parentheses
+def split_list(text):
+    return [part.strip() for part in re.split(r',(?![^(]*\))', text or '') if part.strip()]
+
+
+# Split a paragraph of advice into one item per sentence
+def split_sentences(text):
+    return [sentence.strip() for sentence in re.split(r'(?<=\.)\s+', text or '') if sentence.strip()]
+
+
+# Rows of the reference CSV keyed by test name; empty when the file is missing
+def read_food_suggestions(path):
+    if not os.path.exists(path):
+        logger.warning('%s not found, food suggestions are disabled', path)
+        return {}
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        return {row['Test Name'].strip(): row for row in csv.DictReader(f)}
+
+
+class KnowledgeBase:
+    def __init__(self, blood_tests, abnormalities, suggestions_path=FOOD_SUGGESTIONS_CSV):
+        self.suggestions_path = suggestions_path
+        csv_rows = read_food_suggestions(suggestions_path)
+
+        names = {normalize_name(alias): sys.intern(name) for alias, name in ALIASES.items()}
+        for name in abnormalities:
+            names[normalize_name(name)] = sys.intern(name)
+
+        def canonical(name):
+            key = normalize_name(name)
+            if key not in names:
+                names[key] = sys.intern(name.strip())
+            return names[key]
+
+        by_test = {}
+        tests_of = {}
+        for test, info in blood_tests.items():
+            row = csv_rows.get(test, {})
+            for direction in DIRECTIONS:
+                label = direction.capitalize()
+                found = split_list(info.get(direction, {}).get('condition'))
+                found += [name for name in split_list(row.get(f'{label} Condition'))
+                          if normalize_name(name) not in NOT_CONDITIONS]
+
+                conditions = []
+                for name in found:
+                    name = canonical(name)
+                    if name not in conditions:
+                        conditions.append(name)
+                        tests_of.setdefault(name, []).append((test, direction))
+
+                by_test[(test, direction)] = TestDirection(
+                    conditions=tuple(conditions),
+                    symptoms=tuple(split_list(info.get(direction, {}).get('symptoms'))),
+                    suggestions=tuple(split_sentences(row.get(f'{label} Suggestions')))
+                )
+
+        conditions = {}
+        for name in set(names.values()):
+            tests = tuple(tests_of.get(name, ()))
+            if name in abnormalities:
+                entry = abnormalities[name]
+                conditions[name] = Condition(name, entry['description'], tuple(entry['recommendations']), tests)
+            elif tests:
+                conditions[name] = Condition(name, self._describe(tests), self._suggestions(by_test, tests), tests)
+
+        self.names = MappingProxyType(names)
+        self.by_test = MappingProxyType(by_test)
+        self.conditions = MappingProxyType(conditions)
+
+    @staticmethod
+    def _describe(tests):
+        return 'Associated with ' + ', '.join(f'{direction} {test}' for test, direction in tests) + '.'
+
+    @staticmethod
+    def _suggestions(by_test, tests):
+        items = []
+        for key in tests:
+            for item in by_test[key].suggestions:
+                if item not in items:
+                    items.append(item)
+        return tuple(items)
+
+    # Canonical Condition for any spelling of its name, or None
+    def lookup(self, name):
+        canonical = self.names.get(normalize_name(name))
+        return self.conditions.get(canonical) if canonical else None
+
+    # Food suggestions for one out-of-range test, e.g. suggestions('MCV', 'low')
+    def suggestions(self, test, direction):
+        entry = self.by_test.get((test, direction))
+        return entry.suggestions if entry else ()
+
+    # Recommendation entry of a predicted label without the confidence, in the shape of the /api/analyze response
+    def recommendation(self, label):
+        condition = self.lookup(label)
+        if condition is None or not condition.recommendations:
+            return None
+        return MappingProxyType({
+            'title': f'For {label.title()}',
+            'condition': label,
+            'description': condition.description,
+            'items': list(condition.recommendations)
+        })
+
+    # Recommendation entries of all model labels, computed once per loaded model
+    def recommendations_for(self, labels):
+        fragments = {}
+        for label in labels:
+            # A model label is a condition of its own, never a spelling of another one
+            if normalize_name(label) in ALIASES:
+                logger.warning('Model label %r is listed in ALIASES, it gets no recommendations', label)
+                continue
+            fragment = self.recommendation(label)
+            if fragment is not None:
+                fragments[label] = fragment
+        return MappingProxyType(fragments)
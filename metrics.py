@@ -0,0 +1,291 @@
+# Counters and histograms exposed in the Prometheus text format, aggregated over all gunicorn workers
+#
+# Every process keeps its samples in a memory-mapped file <METRICS_DIR>/metrics_<pid>_<start>.db, so recording a
+# value is a write to shared memory with no system call. /metrics reads the files of all processes,
+# including workers that have exited so counters never go backwards, and sums them per sample.
+# gunicorn.conf.py points METRICS_DIR at a fresh directory for every server start; without METRICS_DIR
+# (flask run, scripts) the samples live in anonymous memory and cover the current process only.
+#
+# File layout: an 8 byte header holding the number of bytes in use, then entries of
+#     uint32 key length, key (JSON [sample name, labels]) padded to 8 bytes, float64 value
+# The header is updated after the entry is complete, so a reader never sees a half-written entry.
+
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+# Seconds; fit the stages (tens of microseconds) as well as sklearn scoring (hundreds of milliseconds)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+INITIAL_SIZE = 64 * 1024
+HEADER = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+
+
+def padded(length):
+    return length + (-length % 8)
+
+
+# Key to value map of one process, backed by a file in METRICS_DIR or by anonymous memory
+class ProcessValues:
+    def __init__(self, path=None):
+        self.path = path
+        self.offsets = {}
+        self.lock = threading.Lock()
+        if path:
+            self.file = open(path, 'w+b')
+            self.file.truncate(INITIAL_SIZE)
+            self.memory = mmap.mmap(self.file.fileno(), INITIAL_SIZE)
+        else:
+            self.file = None
+            self.memory = mmap.mmap(-1, INITIAL_SIZE)
+        self.used = HEADER.size
+        HEADER.pack_into(self.memory, 0, self.used)
+
+    def add(self, key, amount):
+        with self.lock:
+            offset = self.offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            VALUE.pack_into(self.memory, offset, VALUE.unpack_from(self.memory, offset)[0] + amount)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        size = KEY_LENGTH.size + padded(len(encoded)) + VALUE.size
+        if self.used + size > len(self.memory):
+            self._grow(self.used + size)
+
+        KEY_LENGTH.pack_into(self.memory, self.used, len(encoded))
+        self.memory[self.used + KEY_LENGTH.size:self.used + KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self.used + KEY_LENGTH.size + padded(len(encoded))
+        VALUE.pack_into(self.memory, offset, 0.0)
+        self.used += size
+        HEADER.pack_into(self.memory, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = len(self.memory)
+        while size < needed:
+            size *= 2
+        if self.file is not None:
+            self.memory.close()
+            self.file.truncate(size)
+            self.memory = mmap.mmap(self.file.fileno(), size)
+        else:
+            memory = mmap.mmap(-1, size)
+            memory[:self.used] = self.memory[:self.used]
+            self.memory.close()
+            self.memory = memory
+
+    def items(self):
+        with self.lock:
+            return list(read_entries(bytes(self.memory[:self.used])))
+
+
+def read_entries(data):
+    used = HEADER.unpack_from(data, 0)[0]
+    position = HEADER.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        key = data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length].decode('utf-8')
+        position += KEY_LENGTH.size + padded(length)
+        yield key, VALUE.unpack_from(data, position)[0]
+        position += VALUE.size
+
+
+class Registry:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.metrics = []
+        self.pid = None
+        self.values = None
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Values of the current process; a forked worker starts its own file instead of writing to its parent's
+    def process_values(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    path = None
+                    if self.directory:
+                        os.makedirs(self.directory, exist_ok=True)
+                        # The start time keeps a reused pid from overwriting the file of an exited worker
+                        path = os.path.join(self.directory, f'metrics_{os.getpid()}_{time.time_ns()}.db')
+                    self.values = ProcessValues(path)
+                    self.pid = os.getpid()
+        return self.values
+
+    # Summed samples of all processes, keyed by (sample name, labels JSON)
+    def collect(self):
+        totals = defaultdict(float)
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if len(data) < HEADER.size:
+                    continue
+                for key, value in read_entries(data):
+                    totals[key] += value
+        elif self.values is not None:
+            for key, value in self.values.items():
+                totals[key] += value
+        return totals
+
+    # Prometheus text exposition format, version 0.0.4
+    def render(self):
+        totals = defaultdict(list)
+        for key, value in self.collect().items():
+            name, labels = json.loads(key)
+            totals[name].append((labels, value))
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render(totals))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.children = {}
+        self.registry.register(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}')
+            child = self.children[values] = self.child_class(self, dict(zip(self.labelnames, map(str, values))))
+        return child
+
+    def key(self, suffix, labels):
+        return json.dumps([self.name + suffix, labels], sort_keys=True)
+
+
+class CounterChild:
+    def __init__(self, metric, labels):
+        self.registry = metric.registry
+        self.key = metric.key('_total', labels)
+
+    def inc(self, amount=1):
+        self.registry.process_values().add(self.key, amount)
+
+
+class Counter(Metric):
+    kind = 'counter'
+    child_class = CounterChild
+
+    # Counter names end in _total
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name[:-len('_total')] if name.endswith('_total') else name, documentation, labelnames,
+                         registry)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self, totals):
+        series = sorted(totals.get(self.name + '_total', []), key=lambda item: sorted(item[0].items()))
+        if not series and not self.labelnames:
+            series = [({}, 0)]
+        return [f'{self.name}_total{format_labels(labels)} {format_value(value)}' for labels, value in series]
+
+
+class HistogramChild:
+    def __init__(self, metric, labels):
+        self.registry = metric.registry
+        self.bounds = metric.buckets
+        # Per bucket (not cumulative) counts; the last bucket is +Inf
+        self.bucket_keys = [metric.key('_bucket', dict(labels, le=format_value(bound)))
+                            for bound in metric.buckets] + [metric.key('_bucket', dict(labels, le='+Inf'))]
+        self.sum_key = metric.key('_sum', labels)
+
+    def observe(self, value):
+        values = self.registry.process_values()
+        values.add(self.bucket_keys[bisect.bisect_left(self.bounds, value)], 1)
+        values.add(self.sum_key, value)
+
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    child_class = HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    # Cumulative buckets plus _count, per label set
+    def render(self, totals):
+        series = defaultdict(dict)
+        for labels, value in totals.get(self.name + '_bucket', []):
+            le = labels.pop('le')
+            series[json.dumps(labels, sort_keys=True)][le] = value
+        sums = {json.dumps(labels, sort_keys=True): value for labels, value in totals.get(self.name + '_sum', [])}
+
+        lines = []
+        for key in sorted(series):
+            labels = json.loads(key)
+            cumulative = 0
+            for le in [format_value(bound) for bound in self.buckets] + ['+Inf']:
+                cumulative += series[key].get(le, 0)
+                lines.append(f'{self.name}_bucket{format_labels(dict(labels, le=le))} {format_value(cumulative)}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(sums.get(key, 0))}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {format_value(cumulative)}')
+        return lines
+
+
+REGISTRY = Registry(METRICS_DIR)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
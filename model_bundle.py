@@ -0,0 +1,222 @@
+# Location of the model artifacts served by app.py
+#
+# train_model.py publishes every trained model as a complete bundle directory static/ml_model/versions/<version>/
+# and then points static/ml_model/current.json at it. The directory is renamed into place only after all of its
+# files are written, and current.json is swapped with os.replace(), so a reader that resolves the pointer once
+# and loads everything from that directory never sees a half-written or mixed set of files.
+# Without current.json the files directly in static/ml_model are used, as before.
+#
+# Every bundle has a manifest.json with the size and SHA-256 of its files, checked before a bundle is served
+# (see model_registry.py). current.json also remembers the version it replaced, for rollback.
+#
+# Usage:
+#   python model_bundle.py list                      # versions, the active one marked with *
+#   python model_bundle.py activate 20250601-120000
+#   python model_bundle.py rollback                  # back to the version active before the current one
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+MODEL_DIR = 'static/ml_model'
+POINTER_FILE = 'current.json'
+VERSIONS_DIR = 'versions'
+
+# Files read by the sklearn engine, the flattened forest written by `python forest.py export` and its reduced
+# copy from `python forest.py compact`
+SKLEARN_FILES = ['blood_report_model.pkl', 'label_binarizer.pkl', 'imputer.pkl', 'training_columns.pkl']
+FOREST_FILE = 'blood_report_forest.bin'
+COMPACT_FOREST_FILE = 'blood_report_forest.compact.bin'
+MANIFEST_FILE = 'manifest.json'
+# Held-out reports with the predictions of the trained model, written by train_model.py
+GOLDEN_FILE = 'golden.json'
+# Training data statistics the input drift monitor compares live reports with (see drift.py)
+DRIFT_REFERENCE_FILE = 'drift_reference.json'
+
+
+# Contents of current.json, or None without one
+def read_pointer(model_dir=MODEL_DIR):
+    pointer = os.path.join(model_dir, POINTER_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return json.load(f)
+
+
+# Directory of the active bundle
+def current_model_dir(model_dir=MODEL_DIR):
+    pointer = read_pointer(model_dir)
+    if pointer is None:
+        return model_dir
+    return os.path.join(model_dir, VERSIONS_DIR, pointer['version'])
+
+
+def list_versions(model_dir=MODEL_DIR):
+    versions_dir = os.path.join(model_dir, VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(name for name in os.listdir(versions_dir)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(versions_dir, name)))
+
+
+# Write a new bundle; writers maps each file name to a function that writes that file to the given path
+def publish_bundle(writers, version, model_dir=MODEL_DIR, activate=True):
+    versions_dir = os.path.join(model_dir, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+    final_dir = os.path.join(versions_dir, version)
+    if os.path.exists(final_dir):
+        raise FileExistsError(f'Model version {version} already exists')
+
+    staging_dir = tempfile.mkdtemp(prefix=f'.{version}-', dir=versions_dir)
+    try:
+        for name, write in writers.items():
+            write(os.path.join(staging_dir, name))
+        write_manifest(staging_dir, version)
+        for name in list(writers) + [MANIFEST_FILE]:
+            fsync_path(os.path.join(staging_dir, name))
+        # mkdtemp creates the directory private to this user
+        os.chmod(staging_dir, 0o755)
+        os.rename(staging_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    if activate:
+        set_current_version(version, model_dir)
+    return final_dir
+
+
+def set_current_version(version, model_dir=MODEL_DIR):
+    if not os.path.isdir(os.path.join(model_dir, VERSIONS_DIR, version)):
+        raise FileNotFoundError(f'Model version {version} does not exist')
+
+    current = read_pointer(model_dir)
+    previous = current['version'] if current else None
+    if previous == version:
+        return
+    write_json_atomic(os.path.join(model_dir, POINTER_FILE), {'version': version, 'previous': previous})
+
+
+# Remove current.json, so the unversioned files directly in model_dir are served again; this is how a rollback
+# to the model that was deployed before the first versioned bundle is written down for every worker
+def clear_current_version(model_dir=MODEL_DIR):
+    try:
+        os.remove(os.path.join(model_dir, POINTER_FILE))
+    except FileNotFoundError:
+        pass
+
+
+# Point current.json back at the version it replaced; returns that version
+def rollback_version(model_dir=MODEL_DIR):
+    current = read_pointer(model_dir)
+    if not current or not current.get('previous'):
+        raise LookupError('No previous model version to roll back to')
+    set_current_version(current['previous'], model_dir)
+    return current['previous']
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Record the size and hash of every file in a bundle directory
+def write_manifest(bundle_dir, version):
+    files = {}
+    for name in sorted(os.listdir(bundle_dir)):
+        path = os.path.join(bundle_dir, name)
+        if name != MANIFEST_FILE and os.path.isfile(path):
+            files[name] = {'bytes': os.path.getsize(path), 'sha256': file_sha256(path)}
+    manifest = {'version': version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'files': files}
+    write_json_atomic(os.path.join(bundle_dir, MANIFEST_FILE), manifest)
+    return manifest
+
+
+# Re-record a bundle's manifest after a file was added to it (e.g. by `python forest.py compact`)
+def update_manifest(path):
+    bundle_dir = os.path.dirname(os.path.abspath(path))
+    manifest = read_manifest(bundle_dir)
+    if manifest is not None:
+        write_manifest(bundle_dir, manifest['version'])
+
+
+def read_manifest(bundle_dir):
+    path = os.path.join(bundle_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Check the given files of a bundle against its manifest; raises ValueError on a missing, unlisted or changed file.
+# Bundles published before manifests existed have none and are not checked (returns None).
+def verify_bundle(bundle_dir, names):
+    manifest = read_manifest(bundle_dir)
+    if manifest is None:
+        return None
+    problems = []
+    for name in names:
+        path = os.path.join(bundle_dir, name)
+        entry = manifest['files'].get(name)
+        if entry is None:
+            problems.append(f'{name} is not in the manifest')
+        elif not os.path.exists(path):
+            problems.append(f'{name} is missing')
+        elif os.path.getsize(path) != entry['bytes'] or file_sha256(path) != entry['sha256']:
+            problems.append(f'{name} does not match the manifest')
+    if problems:
+        raise ValueError(f"Bundle {bundle_dir}: {'; '.join(problems)}")
+    return manifest
+
+
+def write_json_atomic(path, data):
+    staging = f'{path}.{os.getpid()}.tmp'
+    with open(staging, 'w') as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(staging, path)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List, activate and roll back model bundles')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='Published versions, the active one marked with *')
+    activate = commands.add_parser('activate', help='Serve another published version')
+    activate.add_argument('version')
+    commands.add_parser('rollback', help='Serve the version active before the current one')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    # Running servers pick up the new pointer within MODEL_RELOAD_INTERVAL seconds (see model_registry.py)
+    if args.command == 'list':
+        pointer = read_pointer(args.model_dir) or {}
+        for version in list_versions(args.model_dir):
+            manifest = read_manifest(os.path.join(args.model_dir, VERSIONS_DIR, version))
+            marker = '*' if version == pointer.get('version') else ' '
+            print(f"{marker} {version}  {manifest['created'] if manifest else '(no manifest)'}")
+    elif args.command == 'activate':
+        set_current_version(args.version, args.model_dir)
+        print(f'Active version: {args.version}')
+    else:
+        print(f'Active version: {rollback_version(args.model_dir)}')
+
+
+if __name__ == '__main__':
+    main()
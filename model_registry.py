@@ -0,0 +1,212 @@
+# Model registry: which bundle a process serves, and switching bundles without a restart
+#
+# Bundles are published by train_model.py into static/ml_model/versions/<version>/ and activated through
+# static/ml_model/current.json (see model_bundle.py). ModelRegistry holds the model one process serves:
+#   - load_current() resolves the pointer, checks the bundle files against their manifest, loads and warms the
+#     model (the load callback of app.py) and scores the bundle's golden reports, comparing the labels with the
+#     ones recorded at training time. Only a model that passes is put in service.
+#   - Putting a model in service is one attribute assignment. A request reads registry.active once and uses
+#     that snapshot throughout, so it never mixes files of two bundles, and requests already running finish on
+#     the model they started with.
+#   - A watcher thread checks current.json every MODEL_RELOAD_INTERVAL seconds and loads a newly activated
+#     version in the background while the current one keeps serving. A version that fails is not retried until
+#     the pointer changes again.
+#   - The replaced model stays loaded, so rollback() is a swap back plus a pointer update for the other workers,
+#     which hold it too and swap just as fast.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from model_bundle import (GOLDEN_FILE, MODEL_DIR, clear_current_version, current_model_dir, read_pointer,
+                          set_current_version, verify_bundle)
+
+logger = logging.getLogger(__name__)
+
+# Label threshold of predict_abnormalities_batch() in app.py
+GOLDEN_THRESHOLD = 0.9
+
+# Load attempts kept for info()
+EVENT_HISTORY = 20
+
+
+# Fraction of golden label decisions the model gets differently from the recorded predictions
+# A compact forest exported with --prune serves only some of the recorded labels; the labels it dropped cannot
+# exceed the threshold and count as probability 0. Raises ValueError if the model has labels that were not
+# recorded or does not produce predictions for the golden reports at all.
+def check_golden(serving, golden, threshold=GOLDEN_THRESHOLD):
+    classes = list(golden['classes'])
+    if not set(serving.classes) <= set(classes):
+        raise ValueError('Golden reports were recorded for other labels')
+    predicted = serving.predict(serving.feature_assembler.assemble_batch(golden['reports']))
+    expected = np.asarray(golden['probabilities'])
+    if predicted.shape != (len(expected), len(serving.classes)) or not np.isfinite(predicted).all():
+        raise ValueError('Golden predictions have the wrong shape or are not finite')
+    probabilities = np.zeros_like(expected, dtype=float)
+    probabilities[:, [classes.index(name) for name in serving.classes]] = predicted
+    changed = (probabilities > threshold) != (expected > threshold)
+    return float(changed.mean()), float(np.abs(probabilities - expected).max())
+
+
+class ModelRegistry:
+    # files(bundle_dir) names the bundle files the load reads, which are checked against the manifest first.
+    # load(bundle_dir, version) returns a loaded and warmed model with version, model_dir, classes,
+    # feature_assembler, predict (X -> probabilities), batcher and status (a dict with load and warm-up times).
+    # on_activate(serving) is called whenever a model is put in service.
+    def __init__(self, load, files, model_dir=MODEL_DIR, golden_tolerance=0.01, keep_previous=True,
+                 on_activate=None):
+        self.load = load
+        self.files = files
+        self.on_activate = on_activate
+        self.model_dir = model_dir
+        self.golden_tolerance = golden_tolerance
+        self.keep_previous = keep_previous
+
+        self.active = None
+        self.previous = None
+        self.failed = None
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.watcher_pid = None
+        self.interval = None
+
+    # Version named by current.json, None for the unversioned layout
+    def pointer_version(self):
+        pointer = read_pointer(self.model_dir)
+        return pointer['version'] if pointer else None
+
+    # Load the bundle current.json points at unless it is already served; raises if it cannot be put in service
+    def load_current(self):
+        with self.lock:
+            version, bundle_dir = self.pointer_version(), current_model_dir(self.model_dir)
+            if self.active is not None and (self.active.version, self.active.model_dir) == (version, bundle_dir):
+                return self.active
+            if self.previous is not None and (self.previous.version, self.previous.model_dir) == (version, bundle_dir):
+                self._swap(self.previous, 'swapped back')
+                return self.active
+            return self._load(version, bundle_dir)
+
+    def _load(self, version, bundle_dir):
+        event = {'version': version, 'model_dir': bundle_dir, 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+        serving = None
+        try:
+            started = time.perf_counter()
+            verify_bundle(bundle_dir, self.files(bundle_dir))
+            event['verify_seconds'] = round(time.perf_counter() - started, 3)
+
+            serving = self.load(bundle_dir, version)
+            event.update(load_seconds=serving.status['load_seconds'], warmup_seconds=serving.status['warmup_seconds'])
+
+            started = time.perf_counter()
+            self._validate(serving, bundle_dir, event)
+            event['validate_seconds'] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            logger.exception('Could not load model version %s from %s', version, bundle_dir)
+            self.retire(serving)
+            event.update(outcome='failed', error=repr(e))
+            self.events.append(event)
+            self.failed = (version, bundle_dir)
+            raise
+
+        serving.status.update((key, value) for key, value in event.items() if key.endswith('_seconds'))
+        self._swap(serving, 'loaded', event)
+        return serving
+
+    def _validate(self, serving, bundle_dir, event):
+        golden_path = os.path.join(bundle_dir, GOLDEN_FILE)
+        if not os.path.exists(golden_path):
+            event['golden_reports'] = 0
+            return
+        with open(golden_path) as f:
+            golden = json.load(f)
+        changed, max_diff = check_golden(serving, golden)
+        event.update(golden_reports=len(golden['reports']), golden_changed=round(changed, 6),
+                     golden_max_diff=round(max_diff, 6))
+        if changed > self.golden_tolerance:
+            raise ValueError(f'{changed:.2%} of the golden label decisions changed '
+                             f'(tolerance {self.golden_tolerance:.2%})')
+
+    def _swap(self, serving, outcome, event=None):
+        if self.on_activate is not None:
+            self.on_activate(serving)
+        replaced, self.active = self.active, serving
+        if self.keep_previous:
+            if self.previous is not serving:
+                self.retire(self.previous)
+            self.previous = replaced
+        else:
+            self.retire(replaced)
+        self.failed = None
+
+        serving.status['activated'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        event = event or {'version': serving.version, 'model_dir': serving.model_dir,
+                          'started': serving.status['activated']}
+        event['outcome'] = outcome
+        self.events.append(event)
+        logger.info('Serving model version %s from %s (%s)', serving.version, serving.model_dir, outcome)
+
+    @staticmethod
+    def retire(serving):
+        if serving is not None and serving.batcher is not None:
+            serving.batcher.close()
+
+    # Serve the previous model again at once and point current.json at it, so the other workers follow
+    def rollback(self):
+        with self.lock:
+            if self.previous is None:
+                raise LookupError('No previous model is loaded')
+            if self.previous.version is not None:
+                set_current_version(self.previous.version, self.model_dir)
+            else:
+                # The previous model is the unversioned one, which workers serve when there is no pointer
+                clear_current_version(self.model_dir)
+            self._swap(self.previous, 'rolled back')
+            return self.active
+
+    # Load a newly activated version; errors are logged and leave the current model serving
+    def check(self):
+        try:
+            version, bundle_dir = self.pointer_version(), current_model_dir(self.model_dir)
+        except (OSError, ValueError, KeyError):
+            logger.exception('Could not read the model pointer')
+            return
+        active = self.active
+        if (active is not None and (active.version, active.model_dir) == (version, bundle_dir)) \
+                or self.failed == (version, bundle_dir):
+            return
+        try:
+            self.load_current()
+        except Exception:
+            pass
+
+    # The watcher thread does not survive a fork, so it is started lazily in each worker process
+    def ensure_watching(self, interval):
+        if interval <= 0 or self.watcher_pid == os.getpid():
+            return
+        with self.lock:
+            if self.watcher_pid == os.getpid():
+                return
+            self.watcher_pid, self.interval = os.getpid(), interval
+            threading.Thread(target=self._watch_forever, name='model-watcher', daemon=True).start()
+
+    def _watch_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def info(self):
+        active, previous = self.active, self.previous
+        return {
+            'active': dict(active.status, version=active.version, model_dir=active.model_dir) if active else None,
+            'previous': {'version': previous.version, 'model_dir': previous.model_dir} if previous else None,
+            'pointer_version': self.pointer_version(),
+            'reload_interval': self.interval if self.watcher_pid == os.getpid() else None,
+            'golden_tolerance': self.golden_tolerance,
+            'events': list(self.events),
+            'pid': os.getpid()
+        }
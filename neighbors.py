@@ -0,0 +1,499 @@
+# Most similar reference reports of a report, from a partitioned nearest-neighbor index built offline
+#
+# A report is turned into the model input row of predict_abnormalities() (FeatureAssembler: missing tests get the
+# training medians, Sex is one-hot encoded), then every column is standardized with the mean and standard
+# deviation of the reference reports. Similarity is the Euclidean distance between those rows.
+#
+# The blood tests are only weakly correlated, so the rows fill all of their ~19 dimensions and a KD-tree would
+# end up visiting most of its leaves. Instead `build` groups the reference rows into about sqrt(n) cells with
+# k-means and stores them cell by cell, with the centroid and radius of every cell. A query ranks the cells by
+# the distance of their centroid, scans the closest PROBES cells, and then every other cell that can still hold
+# a closer report: one whose centroid distance minus its radius is below the current k-th distance. Scanning
+# those makes the answer exact; when more than MAX_PROBES cells would be needed, only the closest MAX_PROBES are
+# scanned and the answer is marked approximate. A cell is a contiguous slice, so scanning it is one matrix-vector
+# product against the stored squared norms of its rows.
+#
+# The index is an array_file.py file (magic BRNEIGHB) the app memory-maps: the standardized rows, the original
+# values, sex, conditions as a bit matrix, patient ids and the source file and row of every report. It carries
+# the training columns and medians it was built with, so queries are assembled the same way whatever model is
+# loaded. `add` writes further reports to a delta segment next to it (<index>.delta), which queries scan in full;
+# `compact` moves them into the nearest cells of the main file.
+# The index is a build output kept next to the model artifacts (static/ml_model/similar_reports.bin, not
+# versioned); the server builds it from DEFAULT_SOURCES at start when it is missing (ensure_index()).
+#
+# Usage:
+#   python neighbors.py build data_with_conditions.csv synthetic_data_with_conditions.csv   # -> similar_reports.bin
+#   python neighbors.py add new_reports.csv       # delta segment
+#   python neighbors.py compact                   # fold the delta segment into the cells
+#   python neighbors.py benchmark --rows 2000000  # latency and exactness on generated reports
+
+import argparse
+import ast
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from array_file import read_arrays, write_arrays
+from features import FeatureAssembler
+from forest import load_forest, load_sklearn_bundle
+from model_bundle import FOREST_FILE, MODEL_DIR, current_model_dir
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BRNEIGHB'
+DEFAULT_INDEX = os.path.join(MODEL_DIR, 'similar_reports.bin')
+DELTA_SUFFIX = '.delta'
+
+# Report CSVs of the repository the index is built from when there is none
+DEFAULT_SOURCES = ['data_with_conditions.csv', 'synthetic_data_with_conditions.csv']
+
+DEFAULT_K = 5
+MAX_K = 50
+
+# Cells always scanned per query, and the most scanned when proving the answer exact would need more
+PROBES = 8
+MAX_PROBES = 64
+
+# k-means: rows sampled for fitting the centroids, Lloyd iterations, rows per assignment step
+KMEANS_SAMPLE = 100000
+KMEANS_ITERATIONS = 15
+ASSIGN_ROWS = 50000
+
+CHUNK_ROWS = 200000
+ID_COLUMN = 'Patient ID'
+CONDITIONS_COLUMN = 'Conditions'
+SEXES = ('male', 'female')
+
+# Arrays with one entry per reference report, in the main file and the delta segment alike
+ROW_ARRAYS = ('points', 'norms', 'values', 'sex', 'labels', 'patient_ids', 'source', 'row')
+
+
+# Model input assembler of a bundle, flat forest first like app.py
+def model_assembler(model_dir):
+    path = os.path.join(model_dir, FOREST_FILE)
+    if os.path.exists(path):
+        forest = load_forest(path)
+        return FeatureAssembler(forest.columns, forest.medians)
+    _, _, imputer, train_cols = load_sklearn_bundle(model_dir)
+    return FeatureAssembler.from_imputer(train_cols, imputer)
+
+
+def parse_conditions(text):
+    if not isinstance(text, str) or not text.strip():
+        return []
+    try:
+        conditions = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return [part.strip() for part in text.split(',') if part.strip()]
+    return [str(condition) for condition in conditions] if isinstance(conditions, (list, tuple)) else []
+
+
+# Reference reports of CSV files: model input rows, original values, sex, condition lists, ids and origin
+def read_reports(paths, assembler, value_columns, source_offset=0):
+    rows = {name: [] for name in ('inputs', 'values', 'sex', 'conditions', 'patient_ids', 'source', 'row')}
+    for source, path in enumerate(paths, source_offset):
+        start = 0
+        for chunk in pd.read_csv(path, chunksize=CHUNK_ROWS):
+            chunk['Sex'] = chunk['Sex'].astype(str).str.strip().str.lower()
+            rows['inputs'].append(assembler.assemble_frame(chunk).astype(np.float32))
+            rows['values'].append(np.column_stack([chunk[col].to_numpy(dtype=np.float32) if col in chunk.columns
+                                                   else np.full(len(chunk), np.nan, dtype=np.float32)
+                                                   for col in value_columns]))
+            sex = chunk['Sex'].to_numpy()
+            rows['sex'].append(np.select([sex == s for s in SEXES], range(len(SEXES)), len(SEXES)).astype(np.uint8))
+            if CONDITIONS_COLUMN in chunk.columns:
+                # Archives repeat the same condition lists, so each distinct text is parsed once
+                parsed = {text: parse_conditions(text) for text in chunk[CONDITIONS_COLUMN].dropna().unique()}
+                rows['conditions'] += [parsed.get(text, []) for text in chunk[CONDITIONS_COLUMN]]
+            else:
+                rows['conditions'] += [[] for _ in range(len(chunk))]
+            ids = chunk[ID_COLUMN].astype(str) if ID_COLUMN in chunk.columns else pd.Series([''] * len(chunk))
+            rows['patient_ids'].append(ids.to_numpy(dtype='S'))
+            rows['source'].append(np.full(len(chunk), source, dtype=np.uint16))
+            rows['row'].append(np.arange(start, start + len(chunk), dtype=np.int64))
+            start += len(chunk)
+    width = max(ids.dtype.itemsize for ids in rows['patient_ids'])
+    return {
+        'inputs': np.concatenate(rows['inputs']),
+        'values': np.concatenate(rows['values']),
+        'sex': np.concatenate(rows['sex']),
+        'conditions': rows['conditions'],
+        'patient_ids': np.concatenate(rows['patient_ids']).astype(f'S{width}'),
+        'source': np.concatenate(rows['source']),
+        'row': np.concatenate(rows['row'])
+    }
+
+
+# Condition lists as a packed bit matrix over the vocabulary, which grows with new conditions
+def pack_conditions(conditions, vocabulary):
+    index = {name: i for i, name in enumerate(vocabulary)}
+    for names in conditions:
+        for name in names:
+            if name not in index:
+                index[name] = len(vocabulary)
+                vocabulary.append(name)
+    bits = np.zeros((len(conditions), max(len(vocabulary), 1)), dtype=bool)
+    for i, names in enumerate(conditions):
+        bits[i, [index[name] for name in names]] = True
+    return np.packbits(bits, axis=1)
+
+
+# Index of the nearest centroid of every row, and its squared distance
+def nearest_centroid(points, centroids):
+    labels = np.empty(len(points), dtype=np.int64)
+    distances = np.empty(len(points), dtype=np.float32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(points), ASSIGN_ROWS):
+        block = points[start:start + ASSIGN_ROWS]
+        squared = centroid_norms[None, :] - 2 * block @ centroids.T
+        labels[start:start + len(block)] = squared.argmin(axis=1)
+        distances[start:start + len(block)] = np.maximum(
+            squared[np.arange(len(block)), labels[start:start + len(block)]] + (block ** 2).sum(axis=1), 0)
+    return labels, distances
+
+
+def kmeans(points, cells, rng):
+    sample = points[rng.choice(len(points), min(len(points), KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), cells, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        labels, _ = nearest_centroid(sample, centroids)
+        counts = np.bincount(labels, minlength=cells)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # Empty cells keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class Segment:
+    def __init__(self, arrays, meta):
+        for name in ROW_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.vocabulary = meta['labels']
+        self.sources = meta['sources']
+
+    def __len__(self):
+        return len(self.points)
+
+    # Response entries of the given rows
+    def describe(self, rows, distances, value_columns):
+        conditions = np.unpackbits(self.labels[rows], axis=1, count=len(self.vocabulary)).astype(bool)
+        values = self.values[rows].tolist()
+        results = []
+        for k, row in enumerate(rows.tolist()):
+            entry_values = {col: value for col, value in zip(value_columns, values[k]) if value == value}
+            results.append({
+                'distance': round(float(distances[k]), 4),
+                'patient_id': self.patient_ids[row].decode('utf-8') or None,
+                'source': self.sources[int(self.source[row])]['file'],
+                'row': int(self.row[row]),
+                'age': entry_values.pop('Age', None),
+                'sex': (SEXES + ('other',))[int(self.sex[row])],
+                'conditions': [name for name, present in zip(self.vocabulary, conditions[k]) if present],
+                'values': {col: round(value, 4) for col, value in entry_values.items()}
+            })
+        return results
+
+
+class NeighborIndex:
+    def __init__(self, arrays, meta, delta=None):
+        self.main = Segment(arrays, meta)
+        self.delta = delta
+        self.mean = arrays['mean']
+        self.scale = arrays['scale']
+        self.centroids = arrays['centroids']
+        self.radius = arrays['radius']
+        self.offsets = arrays['offsets']
+        self.meta = meta
+        self.value_columns = meta['value_columns']
+        self.assembler = FeatureAssembler(meta['columns'], meta['medians'])
+
+    @classmethod
+    def load(cls, path, mmap_arrays=True):
+        arrays, meta = read_arrays(path, MAGIC, mmap_arrays)
+        delta = None
+        if os.path.exists(path + DELTA_SUFFIX):
+            delta = Segment(*read_arrays(path + DELTA_SUFFIX, MAGIC))
+        return cls(arrays, meta, delta)
+
+    def __len__(self):
+        return len(self.main) + (len(self.delta) if self.delta is not None else 0)
+
+    # Standardized model input rows of /api/analyze style model inputs ({'Age', 'Sex', test: value})
+    def encode(self, patients):
+        return ((self.assembler.assemble_batch(patients) - self.mean) / self.scale).astype(np.float32)
+
+    # k nearest reports of every patient: a list of response entries per patient, plus whether each is exact
+    def query(self, patients, k=DEFAULT_K):
+        results = []
+        for point in self.encode(patients):
+            results.append(self.nearest(point, k))
+        return results
+
+    def nearest(self, point, k):
+        centroid_distance = np.sqrt(((self.centroids - point) ** 2).sum(axis=1))
+        order = np.argsort(centroid_distance)
+        lower_bound = centroid_distance[order] - self.radius[order]
+        point_norm = float(point @ point)
+
+        # The delta segment and the closest cells first, then the cells the k-th distance does not rule out
+        candidates = []
+        if self.delta is not None and len(self.delta):
+            candidates.append((self.delta, np.arange(len(self.delta)),
+                               self.delta.norms - 2 * (self.delta.points @ point) + point_norm))
+        candidates += [self.scan(cell, point, point_norm) for cell in order[:PROBES].tolist()]
+        kth_squared = kth_smallest([c[2] for c in candidates], k)
+        remaining = order[PROBES:][lower_bound[PROBES:] < np.sqrt(max(kth_squared, 0))]
+        exact = len(remaining) <= MAX_PROBES - PROBES
+        candidates += [self.scan(cell, point, point_norm) for cell in remaining[:MAX_PROBES - PROBES].tolist()]
+
+        squared = np.concatenate([c[2] for c in candidates])
+        rows = np.concatenate([c[1] for c in candidates])
+        in_delta = np.concatenate([np.full(len(c[1]), c[0] is self.delta) for c in candidates])
+        # The k nearest are within the k-th distance of the first cells, which leaves few rows to sort
+        best = np.flatnonzero(squared <= kth_squared)
+        best = best[np.argsort(squared[best], kind='stable')[:k]]
+
+        neighbors = []
+        for segment, chosen in ((self.delta, best[in_delta[best]]), (self.main, best[~in_delta[best]])):
+            if len(chosen):
+                neighbors += segment.describe(rows[chosen], np.sqrt(np.maximum(squared[chosen], 0)),
+                                              self.value_columns)
+        neighbors.sort(key=lambda entry: entry['distance'])
+        return {'exact': bool(exact), 'neighbors': neighbors}
+
+    # (segment, rows, squared distances) of the rows of a cell, which are stored contiguously
+    def scan(self, cell, point, point_norm):
+        start, end = int(self.offsets[cell]), int(self.offsets[cell + 1])
+        main = self.main
+        return main, np.arange(start, end), main.norms[start:end] - 2 * (main.points[start:end] @ point) + point_norm
+
+
+def kth_smallest(arrays, k):
+    values = np.concatenate(arrays)
+    return np.partition(values, k - 1)[k - 1] if len(values) >= k else np.inf
+
+
+# Squared length of every standardized row, so a scan is one matrix-vector product
+def row_norms(points):
+    return np.einsum('ij,ij->i', points, points)
+
+
+def build_index(paths, output, model_dir, cells=None, log=print):
+    assembler = model_assembler(model_dir)
+    value_columns = [col for col in assembler.columns if not col.startswith('Sex_')]
+    reports = read_reports(paths, assembler, value_columns)
+    inputs = reports['inputs']
+
+    mean = inputs.mean(axis=0, dtype=np.float64)
+    scale = inputs.std(axis=0, dtype=np.float64)
+    scale[scale == 0] = 1
+    points = ((inputs - mean) / scale).astype(np.float32)
+
+    cells = cells or max(1, min(int(np.sqrt(len(points))), 4096))
+    started = time.perf_counter()
+    centroids = kmeans(points, cells, np.random.default_rng(0))
+    labels, _ = nearest_centroid(points, centroids)
+    order = np.argsort(labels, kind='stable')
+    vocabulary = []
+    arrays = {
+        'mean': mean, 'scale': scale, 'centroids': centroids,
+        'radius': np.zeros(cells, dtype=np.float32),
+        'offsets': np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=cells))]).astype(np.int64),
+        'points': points[order],
+        'norms': row_norms(points[order]),
+        'values': reports['values'][order],
+        'sex': reports['sex'][order],
+        'labels': pack_conditions([reports['conditions'][i] for i in order.tolist()], vocabulary),
+        'patient_ids': reports['patient_ids'][order],
+        'source': reports['source'][order],
+        'row': reports['row'][order]
+    }
+    arrays['radius'] = cell_radius(arrays['points'], labels[order], centroids)
+    meta = {'columns': assembler.columns, 'medians': dict(zip(assembler.columns, assembler.template.tolist())),
+            'value_columns': value_columns, 'labels': vocabulary,
+            'sources': [{'file': os.path.basename(path)} for path in paths]}
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    write_arrays(output, MAGIC, arrays, meta)
+    if os.path.exists(output + DELTA_SUFFIX):
+        os.remove(output + DELTA_SUFFIX)
+    log(f'Wrote {output}: {len(points)} reports in {cells} cells, {len(vocabulary)} conditions '
+        f'({os.path.getsize(output) / 1e6:.1f} MB, clustering {time.perf_counter() - started:.1f}s)')
+
+
+def build(args):
+    build_index(args.csv, args.output, args.model_dir, args.cells)
+
+
+# Build the index from DEFAULT_SOURCES with the current model's columns when it is missing; used at server start,
+# where a failed build must not stop the server (the app then runs with similar reports disabled)
+def ensure_index(path=DEFAULT_INDEX, sources=DEFAULT_SOURCES, model_dir=None):
+    if os.path.exists(path):
+        return
+    try:
+        build_index(sources, path, model_dir or current_model_dir(), log=logger.info)
+    except Exception:
+        logger.exception('Could not build the similar report index %s', path)
+
+
+# Distance from each cell's centroid to its farthest row, rounded up so float32 error cannot exclude a row
+def cell_radius(points, labels, centroids):
+    distances = np.sqrt(((points - centroids[labels]) ** 2).sum(axis=1))
+    radius = np.zeros(len(centroids), dtype=np.float32)
+    np.maximum.at(radius, labels, distances)
+    return radius * np.float32(1 + 1e-5) + np.float32(1e-6)
+
+
+def add(args):
+    index = NeighborIndex.load(args.index, mmap_arrays=False)
+    delta = index.delta
+    sources = delta.sources if delta is not None else []
+    vocabulary = list(delta.vocabulary) if delta is not None else list(index.main.vocabulary)
+    reports = read_reports(args.csv, index.assembler, index.value_columns, source_offset=len(sources))
+
+    conditions = []
+    if delta is not None:
+        bits = np.unpackbits(delta.labels, axis=1, count=len(delta.vocabulary)).astype(bool)
+        conditions = [[name for name, present in zip(delta.vocabulary, row) if present] for row in bits]
+    conditions += reports['conditions']
+
+    points = ((reports['inputs'] - index.mean) / index.scale).astype(np.float32)
+    new = {
+        'points': points, 'norms': row_norms(points),
+        'values': reports['values'], 'sex': reports['sex'], 'patient_ids': reports['patient_ids'],
+        'source': reports['source'], 'row': reports['row']
+    }
+    arrays = {}
+    for name in ROW_ARRAYS:
+        if name == 'labels':
+            arrays[name] = pack_conditions(conditions, vocabulary)
+        elif delta is not None:
+            old = getattr(delta, name)
+            if name == 'patient_ids':
+                width = max(old.dtype.itemsize, new[name].dtype.itemsize)
+                arrays[name] = np.concatenate([old.astype(f'S{width}'), new[name].astype(f'S{width}')])
+            else:
+                arrays[name] = np.concatenate([old, new[name]])
+        else:
+            arrays[name] = new[name]
+    sources += [{'file': os.path.basename(path)} for path in args.csv]
+    write_arrays(args.index + DELTA_SUFFIX, MAGIC, arrays, {'labels': vocabulary, 'sources': sources})
+    print(f'Added {len(new["points"])} reports to {args.index + DELTA_SUFFIX} ({len(arrays["points"])} in total)')
+
+
+def compact(args):
+    index = NeighborIndex.load(args.index, mmap_arrays=False)
+    if index.delta is None:
+        print(f'{args.index} has no delta segment')
+        return
+    main, delta = index.main, index.delta
+    cells = len(index.centroids)
+
+    # Rows of both segments, grouped by cell; the delta rows go to their nearest centroid
+    main_labels = np.repeat(np.arange(cells), np.diff(index.offsets))
+    delta_labels, _ = nearest_centroid(delta.points, index.centroids)
+    labels = np.concatenate([main_labels, delta_labels])
+    order = np.argsort(labels, kind='stable')
+
+    vocabulary = list(main.vocabulary)
+    conditions = []
+    for segment in (main, delta):
+        bits = np.unpackbits(segment.labels, axis=1, count=len(segment.vocabulary)).astype(bool)
+        names = np.array(segment.vocabulary, dtype=object)
+        conditions += [list(names[row]) for row in bits]
+    width = max(main.patient_ids.dtype.itemsize, delta.patient_ids.dtype.itemsize)
+
+    arrays = {'mean': index.mean, 'scale': index.scale, 'centroids': index.centroids}
+    arrays['offsets'] = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=cells))]).astype(np.int64)
+    for name in ROW_ARRAYS:
+        if name == 'labels':
+            arrays[name] = pack_conditions([conditions[i] for i in order.tolist()], vocabulary)
+        elif name == 'patient_ids':
+            arrays[name] = np.concatenate([main.patient_ids.astype(f'S{width}'),
+                                           delta.patient_ids.astype(f'S{width}')])[order]
+        elif name == 'source':
+            arrays[name] = np.concatenate([main.source, delta.source + len(main.sources)])[order]
+        else:
+            arrays[name] = np.concatenate([getattr(main, name), getattr(delta, name)])[order]
+    arrays['radius'] = cell_radius(arrays['points'], labels[order], index.centroids)
+
+    meta = dict(index.meta, labels=vocabulary, sources=main.sources + delta.sources)
+    write_arrays(args.index, MAGIC, arrays, meta)
+    os.remove(args.index + DELTA_SUFFIX)
+    print(f'Moved {len(delta)} reports into the cells of {args.index} ({len(labels)} in total)')
+
+
+# Latency and exactness against a linear scan, on an index of generated reports
+def benchmark(args):
+    from generate_dataset import main as generate
+
+    os.makedirs(args.workdir, exist_ok=True)
+    data = os.path.join(args.workdir, f'reports_{args.rows}.csv')
+    if not os.path.exists(data):
+        generate([str(args.rows), '-o', data, '--workers', '1', '--seed', '11'])
+    output = os.path.join(args.workdir, f'similar_{args.rows}.bin')
+    started = time.perf_counter()
+    build_index([data], output, args.model_dir)
+    build_seconds = time.perf_counter() - started
+
+    index = NeighborIndex.load(output)
+    queries = pd.read_csv('synthetic_blood_reports.csv').sample(args.queries, random_state=0)
+    patients = [{key: value for key, value in record.items() if value == value}
+                for record in queries.assign(Sex=queries['Sex'].str.lower()).to_dict('records')]
+
+    latencies, exact, agree = [], 0, 0
+    for patient in patients:
+        started = time.perf_counter()
+        result = index.query([patient], args.k)[0]
+        latencies.append(time.perf_counter() - started)
+        exact += result['exact']
+
+        point = index.encode([patient])[0]
+        truth = np.sort(np.sqrt(((index.main.points - point) ** 2).sum(axis=1)))[:args.k]
+        found = np.array([entry['distance'] for entry in result['neighbors']])
+        agree += np.allclose(found, truth, atol=1e-3)
+    latencies = np.array(latencies) * 1000
+    print(f'{len(index)} reports in {len(index.centroids)} cells, built in {build_seconds:.1f}s, '
+          f'{os.path.getsize(output) / 1e6:.0f} MB')
+    print(f'k={args.k}: p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms; '
+          f'proven exact {exact}/{len(patients)}, same distances as a linear scan {agree}/{len(patients)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and update the similar report index')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('build', help='Index report CSVs (with a Conditions column where available)')
+    command.add_argument('csv', nargs='+')
+    command.add_argument('-o', '--output', default=DEFAULT_INDEX)
+    command.add_argument('--model-dir', default=current_model_dir())
+    command.add_argument('--cells', type=int, help='Default: the square root of the number of reports')
+    command.set_defaults(run=build)
+
+    command = commands.add_parser('add', help='Add report CSVs to the delta segment of an index')
+    command.add_argument('csv', nargs='+')
+    command.add_argument('--index', default=DEFAULT_INDEX)
+    command.set_defaults(run=add)
+
+    command = commands.add_parser('compact', help='Move the delta segment into the cells of the index')
+    command.add_argument('--index', default=DEFAULT_INDEX)
+    command.set_defaults(run=compact)
+
+    command = commands.add_parser('benchmark', help='Query latency and exactness on generated reports')
+    command.add_argument('--rows', type=int, default=1000000)
+    command.add_argument('--queries', type=int, default=200)
+    command.add_argument('-k', type=int, default=DEFAULT_K)
+    command.add_argument('--model-dir', default=current_model_dir())
+    command.add_argument('--workdir', default='/tmp/blood_report_neighbors')
+    command.set_defaults(run=benchmark)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
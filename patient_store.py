@@ -0,0 +1,355 @@
+# Longitudinal store of analyzed reports per patient, in one SQLite file
+#
+# Usage:
+#   python patient_store.py ingest DOC-20250409-WA0001.csv --db patients.sqlite --date-column Date
+#   python patient_store.py trends PAC2000 --db patients.sqlite --tests Hemoglobin PLT --limit 5
+#   python patient_store.py changes PLT normal low --days 90 --db patients.sqlite
+#
+# Tables:
+#   patients     external Patient ID -> integer id
+#   reports      one row per report: patient, time (unix seconds), gender, age, content key, /api/analyze JSON
+#   test_values  one row per measured test of a report, with its status and the status of the same test in the
+#                patient's previous report; the primary key (patient, test, taken_at, report) keeps every series
+#                contiguous and in time order, so "last N values of a test for a patient" is one index range read
+#   tests        test name -> integer id
+# The index test_values_change on (test, previous_status, status, taken_at) answers "whose PLT went from
+# normal to low in the last 90 days" without scanning the series. previous_status is recomputed with a
+# window function from the oldest report of every write on, so reports may arrive in any order.
+# A report is stored once per (patient, time, content); ingesting the same file twice adds nothing.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from reference_ranges import STATUS_NAMES
+from result_cache import canonical_key
+
+STATUS_CODES = {name: code for code, name in STATUS_NAMES.items()}
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS patients (id INTEGER PRIMARY KEY, external_id TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS tests (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS reports ('
+    'id INTEGER PRIMARY KEY, patient INTEGER NOT NULL, taken_at REAL NOT NULL, gender TEXT, age INTEGER, '
+    'key TEXT NOT NULL, result TEXT, UNIQUE (patient, taken_at, key))',
+    'CREATE TABLE IF NOT EXISTS test_values ('
+    'patient INTEGER NOT NULL, test INTEGER NOT NULL, taken_at REAL NOT NULL, report INTEGER NOT NULL, '
+    'value REAL NOT NULL, status INTEGER NOT NULL, previous_status INTEGER, '
+    'PRIMARY KEY (patient, test, taken_at, report)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS test_values_change ON test_values (test, previous_status, status, taken_at)'
+]
+
+# Sets previous_status for the values of the patients in temp.touched taken at or after their `since`, the time
+# of the oldest report just added. The window starts at the value before `since`, so only the new part of each
+# series is read and an append touches the new rows only. CROSS JOIN pins that join order in SQLite; the
+# planner would otherwise scan test_values.
+UPDATE_PREVIOUS = '''
+UPDATE test_values SET previous_status = series.previous
+FROM (SELECT v.patient, v.test, v.taken_at, v.report, t.since,
+             LAG(v.status) OVER (PARTITION BY v.patient, v.test ORDER BY v.taken_at, v.report) AS previous
+      FROM temp.touched t CROSS JOIN tests s
+      CROSS JOIN test_values v ON v.patient = t.id AND v.test = s.id
+       AND v.taken_at >= COALESCE((SELECT MAX(p.taken_at) FROM test_values p
+                                   WHERE p.patient = t.id AND p.test = s.id AND p.taken_at < t.since), t.since)
+     ) AS series
+WHERE test_values.patient = series.patient AND test_values.test = series.test
+  AND test_values.taken_at = series.taken_at AND test_values.report = series.report
+  AND series.taken_at >= series.since AND test_values.previous_status IS NOT series.previous
+'''
+
+
+# Unix seconds from a number, an ISO 8601 string (naive times are UTC) or a datetime
+def to_timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    raise ValueError(f'Invalid timestamp {value!r}')
+
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class PatientStore:
+    # cache_mb is SQLite's page cache per connection; bulk ingestion into a large file wants a big one
+    def __init__(self, path, reference_table, cache_mb=64):
+        self.path = path
+        self.cache_mb = cache_mb
+        self.reference_table = reference_table
+        self.local = threading.local()
+        self.test_ids = {}
+        db = self._connection()
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    # One connection per thread and process, as in result_cache.SharedStore
+    def _connection(self):
+        pid, db = getattr(self.local, 'connection', (None, None))
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(f'PRAGMA cache_size=-{int(self.cache_mb * 1024)}')
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS touched (id INTEGER PRIMARY KEY, since REAL NOT NULL)')
+            self.local.connection = (os.getpid(), db)
+        return db
+
+    def _test_id(self, db, name):
+        test_id = self.test_ids.get(name)
+        if test_id is None:
+            db.execute('INSERT OR IGNORE INTO tests (name) VALUES (?)', (name,))
+            test_id = self.test_ids[name] = db.execute('SELECT id FROM tests WHERE name = ?', (name,)).fetchone()[0]
+        return test_id
+
+    # Store reports, each a dict with patient_id, taken_at, gender, age, testResults and optionally result
+    # (the /api/analyze response). Returns the number of reports that were not stored before.
+    def add_reports(self, reports):
+        if not reports:
+            return 0
+        table = self.reference_table
+        values, sex_idx, band_idx = table.encode([(report['testResults'], report['gender'], report['age'])
+                                                  for report in reports])
+        status = table.classify(values, sex_idx, band_idx)
+
+        db = self._connection()
+        added = 0
+        with db:
+            test_ids = [self._test_id(db, name) for name in table.tests]
+            db.execute('DELETE FROM temp.touched')
+            patient_ids = self._patient_ids(db, {str(report['patient_id']) for report in reports})
+            since = {}
+            rows = []
+
+            for i, report in enumerate(reports):
+                patient = patient_ids[str(report['patient_id'])]
+                taken_at = to_timestamp(report['taken_at'])
+                key = canonical_key(report['gender'], report['age'] or 0, report['testResults'], table.index)
+                result = report.get('result')
+                cursor = db.execute(
+                    'INSERT OR IGNORE INTO reports (patient, taken_at, gender, age, key, result) VALUES (?, ?, ?, ?, ?, ?)',
+                    (patient, taken_at, report['gender'], report['age'], key,
+                     json.dumps(result) if result is not None else None))
+                if not cursor.rowcount:
+                    continue
+                added += 1
+                since[patient] = min(taken_at, since.get(patient, taken_at))
+
+                report_id = cursor.lastrowid
+                for j in np.flatnonzero(~np.isnan(values[i])).tolist():
+                    rows.append((patient, test_ids[j], taken_at, report_id, float(values[i, j]), int(status[i, j])))
+
+            # In primary key order, so the inserts walk the B-tree instead of jumping around it
+            rows.sort()
+            db.executemany('INSERT INTO test_values (patient, test, taken_at, report, value, status) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.executemany('INSERT INTO temp.touched VALUES (?, ?)', since.items())
+            db.execute(UPDATE_PREVIOUS)
+        return added
+
+    # Integer ids of external Patient IDs, created for new patients
+    def _patient_ids(self, db, external_ids):
+        db.executemany('INSERT OR IGNORE INTO patients (external_id) VALUES (?)', [(i,) for i in external_ids])
+        ids = {}
+        external_ids = list(external_ids)
+        # Stay under SQLite's limit on bound parameters
+        for start in range(0, len(external_ids), 500):
+            batch = external_ids[start:start + 500]
+            ids.update(db.execute(f"SELECT external_id, id FROM patients WHERE external_id IN ({','.join('?' * len(batch))})",
+                                  batch))
+        return ids
+
+    def _patient(self, db, external_id):
+        row = db.execute('SELECT id FROM patients WHERE external_id = ?', (str(external_id),)).fetchone()
+        return row[0] if row else None
+
+    # Last `limit` values of one test for a patient, newest first, as (taken_at, value, status name)
+    def last_values(self, patient_id, test, limit=10):
+        db = self._connection()
+        patient = self._patient(db, patient_id)
+        if patient is None:
+            return []
+        rows = db.execute(
+            'SELECT v.taken_at, v.value, v.status FROM test_values v JOIN tests t ON t.id = v.test '
+            'WHERE v.patient = ? AND t.name = ? ORDER BY v.taken_at DESC, v.report DESC LIMIT ?',
+            (patient, test, limit)).fetchall()
+        return [(taken_at, value, STATUS_NAMES.get(status)) for taken_at, value, status in rows]
+
+    # Series of the given tests (default: every stored test) for one patient; None for an unknown patient
+    def trends(self, patient_id, tests=None, limit=10):
+        db = self._connection()
+        patient = self._patient(db, patient_id)
+        if patient is None:
+            return None
+
+        count, first, last = db.execute('SELECT COUNT(*), MIN(taken_at), MAX(taken_at) FROM reports WHERE patient = ?',
+                                        (patient,)).fetchone()
+        tests = tests or [name for name, in db.execute('SELECT name FROM tests ORDER BY id')]
+        series = {}
+        for test in tests:
+            values = self.last_values(patient_id, test, limit)
+            if not values:
+                continue
+            series[test] = {
+                'values': [{'taken_at': iso_time(taken_at), 'value': value, 'status': status}
+                           for taken_at, value, status in values],
+                # Change between the two most recent values
+                'change': round(values[0][1] - values[1][1], 6) if len(values) > 1 else None
+            }
+        return {
+            'patient_id': str(patient_id),
+            'reports': count,
+            'first_report': iso_time(first),
+            'last_report': iso_time(last),
+            'tests': series
+        }
+
+    # Patients whose test went from one status to another at a report taken since `since` (unix seconds)
+    def changes(self, test, from_status, to_status, since, limit=1000):
+        rows = self._connection().execute(
+            'SELECT p.external_id, v.taken_at, v.value FROM test_values v '
+            'JOIN patients p ON p.id = v.patient '
+            'WHERE v.test = (SELECT id FROM tests WHERE name = ?) AND v.previous_status = ? AND v.status = ? '
+            'AND v.taken_at >= ? ORDER BY v.taken_at DESC LIMIT ?',
+            (test, STATUS_CODES[from_status], STATUS_CODES[to_status], since, limit)).fetchall()
+        return [{'patient_id': external_id, 'taken_at': iso_time(taken_at), 'value': value}
+                for external_id, taken_at, value in rows]
+
+    # The stored /api/analyze response of a patient's latest report, if one was stored
+    def latest_result(self, patient_id):
+        db = self._connection()
+        row = db.execute('SELECT r.result FROM reports r JOIN patients p ON p.id = r.patient '
+                         'WHERE p.external_id = ? ORDER BY r.taken_at DESC LIMIT 1', (str(patient_id),)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def info(self):
+        db = self._connection()
+        return {
+            'path': self.path,
+            'patients': db.execute('SELECT COUNT(*) FROM patients').fetchone()[0],
+            'reports': db.execute('SELECT MAX(id) FROM reports').fetchone()[0] or 0
+        }
+
+
+# Reports of one CSV chunk; the time comes from date_column, or is `taken_at` for every row
+def chunk_to_reports(chunk, date_column, taken_at, id_column):
+    if date_column:
+        times = pd_to_timestamps(chunk[date_column])
+    else:
+        times = [taken_at] * len(chunk)
+    test_cols = [col for col in chunk.columns if col not in (id_column, date_column, 'Age', 'Sex')]
+
+    reports = []
+    for row, timestamp in zip(chunk.to_dict('records'), times):
+        sex = row.get('Sex')
+        reports.append({
+            'patient_id': row[id_column],
+            'taken_at': timestamp,
+            'gender': sex.lower() if isinstance(sex, str) else None,
+            'age': None if row.get('Age') != row.get('Age') else int(row['Age']),
+            'testResults': {col: row[col] for col in test_cols if row[col] == row[col]}
+        })
+    return reports
+
+
+def pd_to_timestamps(column):
+    import pandas as pd
+    times = pd.to_datetime(column, utc=True)
+    return (times.astype('int64') / 1e9).tolist()
+
+
+def open_store(path, cache_mb=64):
+    # The reference ranges live in app.py; loading it also loads the model, which ingest --predict needs anyway
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.abspath(path)
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    import app
+    return app, PatientStore(path, app.reference_table, cache_mb)
+
+
+def ingest_command(args):
+    import pandas as pd
+
+    app, store = open_store(args.db, args.cache_mb)
+    taken_at = to_timestamp(args.taken_at) if args.taken_at else time.time()
+    started = time.perf_counter()
+    total = added = 0
+
+    for chunk in pd.read_csv(args.input, chunksize=args.chunksize):
+        reports = chunk_to_reports(chunk, args.date_column, taken_at, args.id_column)
+        if args.predict:
+            results = app.analyze_reports([{'gender': report['gender'], 'age': report['age'],
+                                            'testResults': report['testResults']} for report in reports])
+            for report, result in zip(reports, results):
+                report['result'] = result
+        added += store.add_reports(reports)
+        total += len(reports)
+
+    elapsed = time.perf_counter() - started
+    print(f"Read {total} reports, stored {added} new ones in {elapsed:.2f}s ({total / elapsed:.0f} reports/s)")
+    print(json.dumps(store.info()))
+
+
+def trends_command(args):
+    _, store = open_store(args.db)
+    print(json.dumps(store.trends(args.patient_id, args.tests, args.limit), indent=2))
+
+
+def changes_command(args):
+    _, store = open_store(args.db)
+    since = time.time() - args.days * 86400
+    print(json.dumps(store.changes(args.test, args.from_status, args.to_status, since, args.limit), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Store of analyzed reports per patient')
+    commands = parser.add_subparsers(dest='command', required=True)
+    statuses = list(STATUS_CODES)
+
+    ingest = commands.add_parser('ingest', help='Add the reports of a CSV (Patient ID, Age, Sex and test columns)')
+    ingest.add_argument('input')
+    ingest.add_argument('--db', default='patients.sqlite')
+    ingest.add_argument('--id-column', default='Patient ID')
+    ingest.add_argument('--date-column', help='Column with the time of each report')
+    ingest.add_argument('--taken-at', help='Time of every report without --date-column (default: now)')
+    ingest.add_argument('--chunksize', type=int, default=20000)
+    ingest.add_argument('--cache-mb', type=float, default=512, help='SQLite page cache while ingesting')
+    ingest.add_argument('--predict', action='store_true',
+                        help='Also store the full /api/analyze response with the ML predictions (slower)')
+    ingest.set_defaults(handler=ingest_command)
+
+    trends = commands.add_parser('trends', help='Latest values of a patient')
+    trends.add_argument('patient_id')
+    trends.add_argument('--db', default='patients.sqlite')
+    trends.add_argument('--tests', nargs='+')
+    trends.add_argument('--limit', type=int, default=10)
+    trends.set_defaults(handler=trends_command)
+
+    changes = commands.add_parser('changes', help='Patients whose test changed status recently')
+    changes.add_argument('test')
+    changes.add_argument('from_status', choices=statuses)
+    changes.add_argument('to_status', choices=statuses)
+    changes.add_argument('--days', type=float, default=90)
+    changes.add_argument('--db', default='patients.sqlite')
+    changes.add_argument('--limit', type=int, default=1000)
+    changes.set_defaults(handler=changes_command)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
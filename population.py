@@ -0,0 +1,373 @@
+# Population percentiles of blood test values, from precomputed histogram sketches
+#
+# For every (test, sex, age band) the index keeps the counts of the values over a fixed grid of the test:
+# BINS equal-width bins between a low and a high bound set when the index is built, plus one bin below and one
+# above for the tails. Counts on the same grid simply add up, so new
+# reports are folded into an existing index (`add`) and indexes built separately are merged (`merge`) without
+# going back to the data. The grid is only chosen by `build`: from robust bounds of the data, widened a little.
+#
+# PercentileIndex turns the counts into a table of percentiles once, at load: a value's percentile is the share
+# of the group below its bin plus half of the share in its bin, the mid-rank of the bin. That is exact for values
+# many reports share (BAS% is 0.0 or 3.0 in most synthetic reports) and off by at most half a bin elsewhere.
+# A lookup is then one bin computation and one gather for all tests of a report.
+# A group with fewer than MIN_GROUP_SIZE values falls back to the same sex over all ages, then to everyone.
+#
+# The file is written with array_file.py (magic BRPOPIDX): the uint32 counts and the grid bounds, and the tests, age bands and source files as metadata.
+# It is a build output kept next to the model artifacts (static/ml_model/population_index.bin, not versioned);
+# the server builds it from DEFAULT_SOURCES at start when it is missing (ensure_index()).
+#
+# Usage:
+#   python population.py build synthetic_blood_reports.csv DOC-20250409-WA0001.csv   # -> population_index.bin
+#   python population.py add new_reports.csv               # fold more reports into population_index.bin
+#   python population.py merge site_a.bin site_b.bin -o static/ml_model/population_index.bin
+#   python population.py info --check synthetic_blood_reports.csv   # size, groups, accuracy and lookup time
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from array_file import read_arrays, write_arrays
+from model_bundle import MODEL_DIR
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BRPOPIDX'
+DEFAULT_INDEX = os.path.join(MODEL_DIR, 'population_index.bin')
+
+# Report CSVs of the repository the index is built from when there is none
+DEFAULT_SOURCES = ['synthetic_blood_reports.csv', 'DOC-20250409-WA0001.csv']
+
+# Grid of every test: BINS bins between the bounds, plus the underflow and overflow bins
+BINS = 128
+
+# The bounds are these quantiles of the data, widened by GRID_MARGIN of their distance on both sides
+GRID_QUANTILES = (0.001, 0.999)
+GRID_MARGIN = 0.05
+
+# Rows per chunk when reading a CSV, and rows per chunk kept for choosing the grid
+CHUNK_ROWS = 100000
+GRID_SAMPLE_ROWS = 20000
+
+SEXES = ('male', 'female')
+AGE_EDGES = [30, 40, 50, 60, 70, 80]
+
+# Smaller groups answer with the percentile of the same sex over all ages, or of everyone
+MIN_GROUP_SIZE = 50
+
+# Columns of the report CSVs that are not blood tests
+NON_TEST_COLUMNS = {'Age', 'Sex', 'Patient ID', 'Conditions'}
+
+
+def age_band_names():
+    starts = [None] + AGE_EDGES
+    ends = AGE_EDGES + [None]
+    return [f'under {end}' if start is None else f'{start}+' if end is None else f'{start}-{end - 1}'
+            for start, end in zip(starts, ends)]
+
+
+# Blood test columns of a report CSV chunk: everything numeric except age
+def test_columns(frame):
+    return [column for column in frame.columns
+            if column not in NON_TEST_COLUMNS and pd.api.types.is_numeric_dtype(frame[column])]
+
+
+# Value counts per (test, sex, age band) on a fixed grid; see the top of the file
+class PopulationSketches:
+    def __init__(self, tests, low, high, counts=None, sources=None):
+        self.tests = list(tests)
+        self.index = {test: j for j, test in enumerate(self.tests)}
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+
+        shape = (len(self.tests), len(SEXES), len(AGE_EDGES) + 1)
+        self.counts = np.zeros(shape + (BINS + 2,), dtype=np.uint32) if counts is None else np.array(counts)
+        self.sources = list(sources or [])
+
+    # Grid for the tests of a sample of reports
+    @classmethod
+    def for_sample(cls, frame):
+        tests = test_columns(frame)
+        low, high = [], []
+        for test in tests:
+            values = frame[test].dropna().to_numpy(dtype=np.float64)
+            if len(values) == 0:
+                q_low, q_high = 0.0, 1.0
+            else:
+                q_low, q_high = np.quantile(values, GRID_QUANTILES)
+            margin = max((q_high - q_low) * GRID_MARGIN, 1e-6)
+            low.append(q_low - margin)
+            high.append(q_high + margin)
+        return cls(tests, low, high)
+
+    # Fold a chunk of reports (Age, Sex and test columns) into the counts; returns the rows used
+    # Rows without an age or with a sex other than male/female are skipped, columns of other tests are ignored
+    def add_frame(self, frame):
+        sex = frame['Sex'].astype(str).str.strip().str.lower().to_numpy()
+        age = pd.to_numeric(frame['Age'], errors='coerce').to_numpy(dtype=np.float64)
+        sex_index = np.select([sex == s for s in SEXES], range(len(SEXES)), -1)
+        keep = (sex_index >= 0) & ~np.isnan(age)
+        sex_index = sex_index[keep]
+        band_index = np.searchsorted(AGE_EDGES, age[keep], side='right')
+
+        for test in test_columns(frame):
+            j = self.index.get(test)
+            if j is None:
+                continue
+            values = frame[test].to_numpy(dtype=np.float64)[keep]
+            present = ~np.isnan(values)
+            values, s, b = values[present], sex_index[present], band_index[present]
+            if len(values) == 0:
+                continue
+            np.add.at(self.counts[j], (s, b, bin_of(values, self.low[j], self.high[j])), 1)
+        return int(keep.sum())
+
+    # Fold a report CSV in chunks; returns the rows used
+    def add_csv(self, path):
+        rows = 0
+        for chunk in pd.read_csv(path, chunksize=CHUNK_ROWS):
+            rows += self.add_frame(chunk)
+        self.sources.append({'file': os.path.basename(path), 'rows': rows})
+        return rows
+
+    # Add the counts of another index with the same grid
+    def merge(self, other):
+        if (self.tests != other.tests or not np.array_equal(self.low, other.low)
+                or not np.array_equal(self.high, other.high)):
+            raise ValueError('Population indexes with different tests or grids cannot be merged')
+        self.counts += other.counts
+        self.sources += other.sources
+
+    def save(self, path):
+        write_arrays(path, MAGIC, {'counts': self.counts, 'low': self.low, 'high': self.high},
+                     {'tests': self.tests, 'sexes': list(SEXES), 'age_edges': AGE_EDGES, 'bins': BINS,
+                      'sources': self.sources})
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_arrays(path, MAGIC)
+        if meta['sexes'] != list(SEXES) or meta['age_edges'] != AGE_EDGES or meta['bins'] != BINS:
+            raise ValueError(f'{path} was built with different sexes, age bands or bins')
+        return cls(meta['tests'], arrays['low'], arrays['high'], arrays['counts'], meta['sources'])
+
+
+# Percentile tables of every group, for lookups
+#
+# Group axes are (test, sex, age band) where sex also has a last row for everyone (reports without a male/female
+# gender) and the age band a last column for all ages. The table is stored sex and age band first, so the
+# tests of one report read from one contiguous block.
+class PercentileIndex:
+    def __init__(self, sketches):
+        self.tests = sketches.tests
+        self.index = sketches.index
+        self.low = sketches.low
+        self.scale = BINS / (sketches.high - sketches.low)
+
+        # Append everyone as a sex and all ages as a band
+        counts = sketches.counts.astype(np.float64)
+        counts = np.concatenate([counts, counts.sum(axis=1, keepdims=True)], axis=1)
+        counts = np.concatenate([counts, counts.sum(axis=2, keepdims=True)], axis=2)
+        size = counts.sum(axis=3)
+        below = np.cumsum(counts, axis=3) - counts
+        table = (below + counts / 2) / np.maximum(size, 1)[..., None] * 100
+
+        # Group each (test, sex, age band) is answered from: itself, the sex over all ages, or everyone
+        all_ages, everyone = size.shape[2] - 1, size.shape[1] - 1
+        sex_index, band_index = np.meshgrid(np.arange(size.shape[1]), np.arange(size.shape[2]), indexing='ij')
+        sex_index = np.broadcast_to(sex_index, size.shape).copy()
+        band_index = np.broadcast_to(band_index, size.shape).copy()
+        small = size < MIN_GROUP_SIZE
+        band_index[small] = all_ages
+        too_small = small & (np.take_along_axis(size, band_index, axis=2) < MIN_GROUP_SIZE)
+        sex_index[too_small] = everyone
+        test_index = np.arange(size.shape[0])[:, None, None]
+
+        self.table = np.ascontiguousarray(table[test_index, sex_index, band_index].transpose(1, 2, 0, 3))
+        self.size = size[test_index, sex_index, band_index].astype(np.int64).transpose(1, 2, 0)
+        sex_names = list(SEXES) + ['any sex']
+        band_names = age_band_names() + ['all ages']
+        self.group = np.array([[f'{sex_names[s]}, {band_names[b]}' for b in range(size.shape[2])]
+                               for s in range(size.shape[1])], dtype=object)[sex_index, band_index].transpose(1, 2, 0)
+
+        # The same as Python lists for report(): a dozen values are looked up faster without NumPy
+        self.rows = self.table.round(1).tolist()
+        self.bounds = list(zip(self.low.tolist(), self.scale.tolist()))
+        self.groups = [[list(zip(self.group[s, b].tolist(), self.size[s, b].tolist()))
+                        for b in range(size.shape[2])] for s in range(size.shape[1])]
+
+    @classmethod
+    def load(cls, path):
+        return cls(PopulationSketches.load(path))
+
+    def sex_index(self, gender):
+        return SEXES.index(gender) if gender in SEXES else len(SEXES)
+
+    def band_index(self, age):
+        return int(np.searchsorted(AGE_EDGES, age, side='right'))
+
+    # Percentiles (0-100) of the values of tests j (arrays) for one sex and age band
+    def percentiles(self, j, values, s, b):
+        bins = np.clip(np.floor((values - self.low[j]) * self.scale[j]), -1, BINS).astype(np.int64) + 1
+        return self.table[s, b, j, bins]
+
+    # {test: {'percentile', 'group', 'n'}} of every test of the index in test_results with a numeric value
+    def report(self, test_results, gender, age):
+        s, b = self.sex_index(gender), self.band_index(age)
+        rows, groups, bounds, index = self.rows[s][b], self.groups[s][b], self.bounds, self.index
+        percentiles = {}
+        for test, value in test_results.items():
+            j = index.get(test)
+            if j is None or isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+                continue
+            low, scale = bounds[j]
+            position = (value - low) * scale
+            k = 0 if position < 0 else BINS + 1 if position >= BINS else int(position) + 1
+            group, n = groups[j]
+            percentiles[test] = {'percentile': rows[j][k], 'group': group, 'n': n}
+        return percentiles
+
+
+# Bin of each value on the grid [low, high): 0 below it, 1..BINS on it, BINS + 1 above it
+def bin_of(values, low, high):
+    # The same arithmetic as PercentileIndex lookups, so values on a bin edge land in the same bin
+    position = (values - low) * (BINS / (high - low))
+    return np.clip(np.floor(position), -1, BINS).astype(np.int64) + 1
+
+
+# Exact mid-rank percentiles of every value in a group, for checking the sketches
+def exact_percentiles(values):
+    ordered = np.sort(values)
+    below = np.searchsorted(ordered, values, side='left')
+    not_above = np.searchsorted(ordered, values, side='right')
+    return (below + not_above) / 2 / len(values) * 100
+
+
+def build_index(paths, output, log=print):
+    # The grid comes from a sample of every chunk, so larger files are read twice but never held at once
+    samples = []
+    for path in paths:
+        for chunk in pd.read_csv(path, chunksize=CHUNK_ROWS):
+            samples.append(chunk.sample(min(len(chunk), GRID_SAMPLE_ROWS), random_state=0))
+    sketches = PopulationSketches.for_sample(pd.concat(samples, ignore_index=True))
+    for path in paths:
+        rows = sketches.add_csv(path)
+        log(f'{path}: {rows} reports')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    sketches.save(output)
+    log(f'Wrote {output} ({os.path.getsize(output) / 1024:.1f} KB, {len(sketches.tests)} tests)')
+
+
+def build(args):
+    build_index(args.csv, args.output)
+
+
+# Build the index from DEFAULT_SOURCES when it is missing; used at server start, where a failed build must not
+# stop the server (the app then serves reports without percentiles)
+def ensure_index(path=DEFAULT_INDEX, sources=DEFAULT_SOURCES):
+    if os.path.exists(path):
+        return
+    try:
+        build_index(sources, path, logger.info)
+    except Exception:
+        logger.exception('Could not build the population index %s', path)
+
+
+def add(args):
+    sketches = PopulationSketches.load(args.index)
+    for path in args.csv:
+        ignored = [test for test in test_columns(pd.read_csv(path, nrows=100)) if test not in sketches.index]
+        rows = sketches.add_csv(path)
+        print(f'{path}: {rows} reports' + (f", ignored tests not in the index: {', '.join(ignored)}" if ignored else ''))
+    sketches.save(args.index)
+    print(f'Updated {args.index}')
+
+
+def merge(args):
+    merged = PopulationSketches.load(args.indexes[0])
+    for path in args.indexes[1:]:
+        merged.merge(PopulationSketches.load(path))
+    merged.save(args.output)
+    print(f'Wrote {args.output} from {len(args.indexes)} indexes')
+
+
+def info(args):
+    sketches = PopulationSketches.load(args.index)
+    index = PercentileIndex(sketches)
+    print(f'{args.index}: {os.path.getsize(args.index) / 1024:.1f} KB, {len(sketches.tests)} tests, '
+          f'{len(SEXES)} sexes x {len(AGE_EDGES) + 1} age bands, {BINS} bins')
+    for source in sketches.sources:
+        print(f"  {source['file']}: {source['rows']} reports")
+    small = int((sketches.counts.sum(axis=3) < MIN_GROUP_SIZE).sum())
+    print(f'Groups below {MIN_GROUP_SIZE} values (answered from a wider group): {small} of '
+          f'{sketches.counts[..., 0].size}')
+    if not args.check:
+        return
+
+    # Sketch percentiles against the exact ones of the same reports, group by group
+    frame = pd.read_csv(args.check)
+    sex = frame['Sex'].astype(str).str.lower().to_numpy()
+    band = np.searchsorted(AGE_EDGES, frame['Age'].to_numpy(dtype=np.float64), side='right')
+    errors = []
+    for test in test_columns(frame):
+        j = index.index.get(test)
+        if j is None:
+            continue
+        for s, sex_name in enumerate(SEXES):
+            for b in range(len(AGE_EDGES) + 1):
+                values = frame[test].to_numpy(dtype=np.float64)[(sex == sex_name) & (band == b)]
+                values = values[~np.isnan(values)]
+                if len(values) < MIN_GROUP_SIZE:
+                    continue
+                estimate = index.percentiles(np.full(len(values), j), values, s, b)
+                errors.append(np.abs(estimate - exact_percentiles(values)))
+    if not errors:
+        print(f'No group of {args.check} has {MIN_GROUP_SIZE} values to compare with')
+        return
+    errors = np.concatenate(errors)
+    print(f'Percentile error against {args.check} ({len(errors)} values): mean {errors.mean():.2f}, '
+          f'p99 {np.percentile(errors, 99):.2f}, max {errors.max():.2f} percentile points')
+
+    # Lookup time of whole reports, the way the app calls it
+    reports = frame.sample(min(len(frame), 2000), random_state=0)
+    payloads = [({test: row[test] for test in index.tests if test in row and row[test] == row[test]},
+                 str(row['Sex']).lower(), row['Age']) for _, row in reports.iterrows()]
+    started = time.perf_counter()
+    for test_results, gender, age in payloads:
+        index.report(test_results, gender, age)
+    elapsed = (time.perf_counter() - started) / len(payloads)
+    print(f'Lookup of a report ({len(index.tests)} tests max): {elapsed * 1e6:.1f} µs')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and inspect the population percentile index')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('build', help='Build an index from report CSVs')
+    command.add_argument('csv', nargs='+')
+    command.add_argument('-o', '--output', default=DEFAULT_INDEX)
+    command.set_defaults(run=build)
+
+    command = commands.add_parser('add', help='Fold report CSVs into an existing index')
+    command.add_argument('csv', nargs='+')
+    command.add_argument('--index', default=DEFAULT_INDEX)
+    command.set_defaults(run=add)
+
+    command = commands.add_parser('merge', help='Add up indexes built on the same grid')
+    command.add_argument('indexes', nargs='+')
+    command.add_argument('-o', '--output', default=DEFAULT_INDEX)
+    command.set_defaults(run=merge)
+
+    command = commands.add_parser('info', help='Size and groups of an index, optionally its accuracy')
+    command.add_argument('--index', default=DEFAULT_INDEX)
+    command.add_argument('--check', help='Report CSV to compare the percentiles with the exact ones')
+    command.set_defaults(run=info)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# Opt-in CPU and allocation profiles of single requests, kept in a bounded directory on disk
+#
+# A request is profiled when it asks for it (X-Profile: 1, allowed by the caller of start()) or, on the sampled
+# endpoints, with probability sample_rate. While it runs, cProfile records the calls of the request's thread and
+# tracemalloc the allocations of the process, so with several threads per worker the allocations of the other
+# requests are included; only one request per process is profiled at a time. When profiling is off, deciding
+# costs a header lookup and, with a sample rate, one random number per request.
+#
+# Each capture is stored in the directory under an id like 20250601T120000-1234-7 (time, pid, sequence):
+#   <id>.prof           cProfile stats, for pstats or snakeviz
+#   <id>.cpu.folded     folded stacks in microseconds, for flamegraph.pl or speedscope
+#   <id>.alloc.folded   folded allocation stacks in bytes still allocated at the end of the request
+#   <id>.alloc.txt      the lines that allocated most
+#   <id>.json           request, duration, status, peak traced memory and the slowest functions; written last,
+#                       so only complete captures are listed
+# The directory is shared by all workers and keeps the newest `capacity` captures.
+#
+# cProfile keeps caller/callee pairs, not whole stacks. The CPU stacks are rebuilt from the roots down and the
+# time of a function is split over the paths reaching it in proportion to the time each caller spent in it,
+# the usual approximation for flamegraphs of deterministic profiles.
+
+import cProfile
+import glob
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+KINDS = {'prof': '.prof', 'cpu': '.cpu.folded', 'alloc': '.alloc.folded', 'alloc_top': '.alloc.txt'}
+CAPTURE_ID = re.compile(r'^\d{8}T\d{6}-\d+-\d+$')
+
+# Functions listed in the capture metadata and allocation lines in <id>.alloc.txt
+TOP_FUNCTIONS = 15
+TOP_ALLOCATIONS = 50
+
+# Depth limit of the rebuilt CPU stacks; recursion is cut at the first repeated function
+MAX_STACK_DEPTH = 64
+
+
+class Capture:
+    def __init__(self, capture_id, trigger, tracemalloc_frames):
+        self.id = capture_id
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.tracemalloc_frames = tracemalloc_frames
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        # Tracing started by someone else (PYTHONTRACEMALLOC) is left alone
+        self.tracing = bool(self.tracemalloc_frames) and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(self.tracemalloc_frames)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.duration = time.perf_counter() - self.started
+        self.snapshot, self.peak = None, None
+        if self.tracing:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+class RequestProfiler:
+    def __init__(self, directory, capacity=50, sample_rate=0.0, tracemalloc_frames=25):
+        self.directory = directory
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.tracemalloc_frames = tracemalloc_frames
+        self.lock = threading.Lock()
+        self.active = None
+        self.sequence = 0
+
+    # Decide whether to profile the request; returns a started Capture or None
+    def start(self, requested, sampled_endpoint):
+        if requested:
+            trigger = 'header'
+        elif self.sample_rate > 0 and sampled_endpoint and random.random() < self.sample_rate:
+            trigger = 'sample'
+        else:
+            return None
+        # tracemalloc is process-wide, so a second request arriving meanwhile is not profiled
+        with self.lock:
+            if self.active is not None:
+                return None
+            self.sequence += 1
+            capture_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self.sequence}"
+            self.active = Capture(capture_id, trigger, self.tracemalloc_frames)
+        self.active.start()
+        return self.active
+
+    # Stop the capture and write it to the directory; request is a dict of details for the metadata
+    def finish(self, capture, request):
+        try:
+            capture.stop()
+        finally:
+            with self.lock:
+                self.active = None
+        try:
+            self.save(capture, request)
+        except Exception:
+            logger.exception('Could not save profile %s', capture.id)
+
+    def save(self, capture, request):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, capture.id)
+        stats = pstats.Stats(capture.profile)
+
+        staging = f'{base}.prof.tmp'
+        stats.dump_stats(staging)
+        os.replace(staging, base + KINDS['prof'])
+        write_text(base + KINDS['cpu'], ''.join(f'{stack} {microseconds}\n'
+                                                 for stack, microseconds in folded_cpu_stacks(stats)))
+        if capture.snapshot is not None:
+            write_text(base + KINDS['alloc'], ''.join(f'{stack} {size}\n'
+                                                       for stack, size in folded_allocations(capture.snapshot)))
+            write_text(base + KINDS['alloc_top'], allocation_report(capture.snapshot, capture.peak))
+
+        metadata = {
+            'id': capture.id,
+            'trigger': capture.trigger,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'pid': os.getpid(),
+            'duration_ms': round(capture.duration * 1000, 3),
+            'peak_traced_bytes': capture.peak,
+            'files': {kind: capture.id + suffix for kind, suffix in KINDS.items()
+                      if os.path.exists(base + suffix)},
+            'top_functions': top_functions(stats),
+            **request
+        }
+        staging = f'{base}.json.tmp'
+        with open(staging, 'w') as f:
+            json.dump(metadata, f, indent=1)
+        os.replace(staging, base + '.json')
+        self.trim()
+
+    # Remove the oldest captures beyond capacity
+    def trim(self):
+        captures = sorted(glob.glob(os.path.join(self.directory, '*.json')), key=capture_order)
+        for path in captures[:max(len(captures) - self.capacity, 0)]:
+            capture_id = os.path.basename(path)[:-len('.json')]
+            for suffix in ['.json'] + list(KINDS.values()):
+                try:
+                    os.remove(os.path.join(self.directory, capture_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    # Metadata of the stored captures, newest first
+    def list(self):
+        captures = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json')), key=capture_order, reverse=True):
+            try:
+                with open(path) as f:
+                    captures.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return captures
+
+    # Path of one file of a capture, None if there is no such capture or file
+    def path(self, capture_id, kind):
+        if not CAPTURE_ID.match(capture_id) or kind not in KINDS:
+            return None
+        path = os.path.join(self.directory, capture_id + KINDS[kind])
+        return path if os.path.exists(path) else None
+
+
+# Newest last: by time, then pid and sequence numerically
+def capture_order(path):
+    stamp, pid, sequence = os.path.basename(path)[:-len('.json')].split('-')
+    return stamp, int(pid), int(sequence)
+
+
+def write_text(path, text):
+    staging = f'{path}.tmp'
+    with open(staging, 'w') as f:
+        f.write(text)
+    os.replace(staging, path)
+
+
+def function_name(function):
+    filename, line, name = function
+    if filename == '~':
+        # Built-in functions, e.g. <built-in method numpy.core._multiarray_umath.implement_array_function>
+        return name.strip('<>').replace(';', ',')
+    # The directory as well, so flask/app.py and this project's app.py stay apart
+    short = os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+    return f'{short}:{name}:{line}'.replace(';', ',')
+
+
+def top_functions(stats, count=TOP_FUNCTIONS):
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:count]
+    return [{'function': function_name(function), 'calls': nc, 'self_ms': round(tt * 1000, 3),
+             'cumulative_ms': round(ct * 1000, 3)} for function, (cc, nc, tt, ct, callers) in rows]
+
+
+# (folded stack, microseconds) pairs rebuilt from the caller/callee times of a cProfile run
+def folded_cpu_stacks(stats):
+    callees = {}
+    for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, (caller_cc, caller_nc, caller_tt, caller_ct) in callers.items():
+            callees.setdefault(caller, []).append((function, caller_ct))
+
+    folded = {}
+
+    def walk(function, stack, share):
+        tt = stats.stats[function][2]
+        stack = stack + [function_name(function)]
+        self_time = tt * share
+        if len(stack) < MAX_STACK_DEPTH:
+            for callee, edge_ct in callees.get(function, []):
+                if function_name(callee) in stack:
+                    continue
+                callee_ct = stats.stats[callee][3]
+                if callee_ct > 0:
+                    walk(callee, stack, share * edge_ct / callee_ct)
+        microseconds = round(self_time * 1e6)
+        if microseconds > 0:
+            key = ';'.join(stack)
+            folded[key] = folded.get(key, 0) + microseconds
+
+    roots = [function for function, (cc, nc, tt, ct, callers) in stats.stats.items() if not callers]
+    for root in roots:
+        walk(root, [], 1.0)
+    return sorted(folded.items())
+
+
+# (folded stack, bytes) of the memory allocated during the request and still held at its end
+def folded_allocations(snapshot):
+    folded = {}
+    for statistic in snapshot.statistics('traceback'):
+        stack = ';'.join(f'{os.path.basename(os.path.dirname(frame.filename))}/{os.path.basename(frame.filename)}'
+                         f':{frame.lineno}' for frame in statistic.traceback)
+        folded[stack] = folded.get(stack, 0) + statistic.size
+    return sorted(folded.items())
+
+
+def allocation_report(snapshot, peak, count=TOP_ALLOCATIONS):
+    statistics = snapshot.statistics('lineno')
+    lines = [f'Peak traced memory: {peak} bytes',
+             f'Still allocated at the end of the request: {sum(s.size for s in statistics)} bytes '
+             f'in {sum(s.count for s in statistics)} blocks', '']
+    for statistic in statistics[:count]:
+        frame = statistic.traceback[0]
+        lines.append(f'{statistic.size:>12} B {statistic.count:>8} blocks  {frame.filename}:{frame.lineno}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,153 @@
+import numpy as np
+
+
+# Sex rows of the compiled table; the last row is used when the gender is neither male nor female
+SEXES = ('male', 'female')
+UNSPECIFIED_SEX = len(SEXES)
+
+# Status codes returned by ReferenceTable.classify
+MISSING, NORMAL, LOW, HIGH = -1, 0, 1, 2
+STATUS_NAMES = {NORMAL: 'normal', LOW: 'low', HIGH: 'high'}
+
+
+# Resolve the {'min', 'max'} range of one sex from a BLOOD_TESTS 'ranges' (or age band) entry
+def resolve_range(ranges, sex):
+    if 'min' in ranges and 'max' in ranges:
+        return ranges
+    return ranges.get(sex)
+
+
+# BLOOD_TESTS compiled into dense min/max arrays indexed by (age band, sex, test)
+#
+# A test can declare age-banded ranges next to its default 'ranges':
+#     'age_ranges': [{'min_age': 50, 'male': {'min': 0, 'max': 20}, 'female': {'min': 0, 'max': 30}}]
+# Each band applies from its min_age upwards until the next band starts.
+# Status for one report or a whole matrix of reports is then a couple of vectorized comparisons.
+class ReferenceTable:
+    # suggestions(test, 'low' | 'high') gives the advice added to out-of-range entries (see knowledge_base.py)
+    def __init__(self, blood_tests, suggestions=None):
+        self.tests = list(blood_tests)
+        self.index = {test: j for j, test in enumerate(self.tests)}
+
+        # Boundaries of all age bands used by any test; band b covers ages in [edges[b-1], edges[b])
+        self.age_edges = np.array(sorted({band['min_age'] for info in blood_tests.values()
+                                          for band in info.get('age_ranges', [])}), dtype=float)
+        band_starts = [-np.inf] + list(self.age_edges)
+
+        shape = (len(band_starts), len(SEXES) + 1, len(self.tests))
+        self.low = np.full(shape, np.nan)
+        self.high = np.full(shape, np.nan)
+        self.range_text = np.full(shape, None, dtype=object)
+        self.age_adjusted = np.zeros(shape, dtype=bool)
+
+        for j, test in enumerate(self.tests):
+            info = blood_tests[test]
+            age_ranges = sorted(info.get('age_ranges', []), key=lambda band: band['min_age'])
+
+            for b, band_start in enumerate(band_starts):
+                ranges, adjusted = info['ranges'], False
+                for band in age_ranges:
+                    if band['min_age'] <= band_start:
+                        ranges, adjusted = band, True
+
+                for s, sex in enumerate(SEXES + (None,)):
+                    ref_range = resolve_range(ranges, sex)
+                    if not ref_range:
+                        continue
+                    self.low[b, s, j] = ref_range['min']
+                    self.high[b, s, j] = ref_range['max']
+                    self.range_text[b, s, j] = f"{ref_range['min']}-{ref_range['max']}"
+                    self.age_adjusted[b, s, j] = adjusted
+
+        # Analysis entry for every (age band, sex, test, status), so only the value is filled in per report
+        self.entries = [[[self._entries(test, blood_tests[test], self.range_text[b, s, j], suggestions)
+                          for j, test in enumerate(self.tests)]
+                         for s in range(shape[1])] for b in range(shape[0])]
+
+        # Names of the tests whose range is age-adjusted, per (age band, sex)
+        self.adjusted_tests = [[[self.tests[j] for j in np.flatnonzero(self.age_adjusted[b, s])]
+                                for s in range(shape[1])] for b in range(shape[0])]
+
+    @staticmethod
+    def _entries(test, test_info, range_text, suggestions):
+        entries = {}
+        for status, status_name in STATUS_NAMES.items():
+            details = test_info.get(status_name, {}) if status != NORMAL else {}
+            advice = list(suggestions(test, status_name)) if suggestions and status != NORMAL else []
+            entries[status] = {
+                'name': test_info['name'],
+                'value': None,
+                'status': status_name,
+                'units': test_info['units'],
+                'reference_range': range_text,
+                'condition': details.get('condition'),
+                'symptoms': details.get('symptoms'),
+                'suggestions': advice or None
+            }
+        return entries
+
+    def sex_index(self, gender):
+        return SEXES.index(gender) if gender in SEXES else UNSPECIFIED_SEX
+
+    def band_index(self, age):
+        return np.searchsorted(self.age_edges, age, side='right')
+
+    # Turn (test_results, gender, age) tuples into a value matrix plus sex and age band indices
+    # Raises ValueError for a value that is not a number or does not fit a float (e.g. a 400 digit JSON integer)
+    def encode(self, reports):
+        index = self.index
+        rows, cols, data = [], [], []
+
+        for i, (test_results, _, _) in enumerate(reports):
+            for test_key, value in test_results.items():
+                j = index.get(test_key)
+                if j is not None and value is not None:
+                    try:
+                        value = float(value)
+                    except (TypeError, ValueError, OverflowError):
+                        raise ValueError(f'Invalid value for {test_key}')
+                    rows.append(i)
+                    cols.append(j)
+                    data.append(value)
+
+        values = np.full((len(reports), len(self.tests)), np.nan)
+        values[rows, cols] = data
+
+        sex_idx = np.array([self.sex_index(gender) for _, gender, _ in reports], dtype=np.intp)
+        band_idx = self.band_index(np.array([age for _, _, age in reports], dtype=float))
+        return values, sex_idx, band_idx
+
+    # Status code for every (report, test): LOW, NORMAL, HIGH or MISSING when there is no value or no range
+    def classify(self, values, sex_idx, band_idx):
+        low = self.low[band_idx, sex_idx]
+        high = self.high[band_idx, sex_idx]
+
+        status = np.where(values < low, LOW, np.where(values > high, HIGH, NORMAL)).astype(np.int8)
+        status[np.isnan(values) | np.isnan(low)] = MISSING
+        return status
+
+    # Rule based analysis of a list of (test_results, gender, age) tuples, one analysis dict per report
+    def analyze(self, reports):
+        values, sex_idx, band_idx = self.encode(reports)
+        status = self.classify(values, sex_idx, band_idx).tolist()
+        index = self.index
+
+        analyses = []
+        for (test_results, _, _), row_status, b, s in zip(reports, status, band_idx.tolist(), sex_idx.tolist()):
+            analysis = {}
+            entries = self.entries[b][s]
+
+            for test_key, value in test_results.items():
+                j = index.get(test_key)
+                if j is None or row_status[j] == MISSING:
+                    continue
+                entry = entries[j][row_status[j]].copy()
+                entry['value'] = value
+                analysis[test_key] = entry
+            analyses.append(analysis)
+
+        return analyses
+
+    # Tests whose reference range is adjusted for this gender and age
+    def age_adjusted_tests(self, gender, age):
+        return self.adjusted_tests[self.band_index(age)][self.sex_index(gender)]
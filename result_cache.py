@@ -0,0 +1,174 @@
+# Cache of /api/analyze results keyed on the canonicalized report content
+#
+# The key is built from (gender, age, testResults) with the tests sorted by name, missing (None) values and
+# tests the pipeline ignores dropped, so retries and re-uploads of the same panel hit. Values are keyed exactly (as
+# floats, so 13 and 13.0 or -0.0 and 0.0 share a key): the cached report holds the first submitter's values and
+# statuses, so two panels may only share an entry when the rules and the model see the same numbers.
+# Every key is prefixed with a namespace, the fingerprint of the loaded model artifacts and rule tables, so
+# results computed by another model are never served; changing the namespace clears the local entries.
+#
+# Entries live in an in-process LRU with a TTL. Optionally they are also written to a SQLite file (put it on
+# /dev/shm for a memory-backed store) that all gunicorn workers on the box read from.
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint of a set of files from their names, sizes and modification times
+def file_fingerprint(paths, extra=''):
+    digest = hashlib.sha256(extra.encode('utf-8'))
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+# Key for one report; relevant_keys are the test names the pipeline actually reads
+def canonical_key(gender, age, test_results, relevant_keys):
+    # repr() of a float round-trips exactly; adding 0.0 turns -0.0 into 0.0
+    tests = sorted((key, float(value) + 0.0) for key, value in test_results.items()
+                   if key in relevant_keys and value is not None)
+    payload = json.dumps([gender, int(age), tests], separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# File-backed store shared by all processes on the machine
+class SharedStore:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS results ('
+                       'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    # One connection per thread and process; sqlite3 connections cannot be shared between threads,
+    # nor survive the fork from the gunicorn master into the workers
+    def _connection(self):
+        pid, db = getattr(self.local, 'connection', (None, None))
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self.local.connection = (os.getpid(), db)
+        return db
+
+    def get(self, key, now):
+        db = self._connection()
+        row = db.execute('SELECT value, expires FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < now:
+            return None
+        db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    # Returns the number of entries evicted to stay under max_entries
+    def put(self, key, value, expires, now):
+        db = self._connection()
+        db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, json.dumps(value), expires, now))
+        excess = db.execute('SELECT COUNT(*) FROM results').fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return 0
+        db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)', (excess,))
+        return excess
+
+    def clear(self):
+        self._connection().execute('DELETE FROM results')
+
+
+class ResultCache:
+    def __init__(self, max_entries=1024, ttl=600, shared_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.namespace = ''
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.shared = SharedStore(shared_path, max_entries * 16) if shared_path and max_entries > 0 else None
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    # Entries of another namespace (model version) are dropped locally and never read from the shared store
+    def set_namespace(self, namespace):
+        with self.lock:
+            if namespace != self.namespace:
+                self.namespace = namespace
+                self.entries.clear()
+
+    # With a namespace, only entries of that namespace are read; while it is not the current one (a request that
+    # started before a model reload) every lookup misses
+    def get(self, key, namespace=None):
+        if not self.enabled or (namespace is not None and namespace != self.namespace):
+            return None
+        key = f'{namespace or self.namespace}:{key}'
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self.entries[key]
+                self.stats['expirations'] += 1
+
+        value = self._shared_call('get', key, now)
+        with self.lock:
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['shared_hits'] += 1
+            self._store(key, value, now + self.ttl)
+        return value
+
+    # Results computed for a namespace that is no longer current are dropped
+    def put(self, key, value, namespace=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            if namespace is not None and namespace != self.namespace:
+                return
+            key = f'{self.namespace}:{key}'
+            self._store(key, value, now + self.ttl)
+        evicted = self._shared_call('put', key, value, now + self.ttl, now)
+        if evicted:
+            with self.lock:
+                self.stats['evictions'] += evicted
+
+    def _store(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    # The shared store is an optimization; if it is locked or broken the local cache keeps working
+    def _shared_call(self, method, *args):
+        if self.shared is None:
+            return None
+        try:
+            return getattr(self.shared, method)(*args)
+        except sqlite3.Error as e:
+            logger.warning('Result cache store error: %s', e)
+            return None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self._shared_call('clear')
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), max_entries=self.max_entries, ttl=self.ttl,
+                        namespace=self.namespace, shared_path=self.shared.path if self.shared else None)
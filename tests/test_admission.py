@@ -0,0 +1,77 @@
+# AdmissionController waiting and releasing with requests of several routes
+#
+# Run from the project root: python -m pytest tests
+
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from admission import AdmissionController, Rejected  # noqa: E402
+
+
+def wait_until(condition, timeout=2.0):
+    stop = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < stop
+        time.sleep(0.005)
+
+
+# A request waiting in a thread; admitted holds the seconds it waited, or the Rejected
+def start_waiter(controller, route, client, deadline):
+    result = {}
+
+    def run():
+        started = time.monotonic()
+        try:
+            result['ticket'] = controller.admit(route, client, deadline)
+            result['admitted'] = time.monotonic() - started
+        except Rejected as e:
+            result['rejected'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+# A route without a cost estimate admits one request at a time, the others max_in_flight. A freed slot that only
+# the second waiter can use must still reach it.
+def test_freed_slot_reaches_waiter_of_other_route():
+    controller = AdmissionController(max_in_flight=2, max_queue=4)
+    controller.cost['analyze_batch'] = 0.001
+    deadline = time.time() + 5
+    running = [controller.admit('analyze_batch', 'a', deadline) for _ in range(2)]
+
+    analyze, analyze_result = start_waiter(controller, 'analyze', 'b', deadline)
+    wait_until(lambda: controller.waiting == 1)
+    batch, batch_result = start_waiter(controller, 'analyze_batch', 'c', deadline)
+    wait_until(lambda: controller.waiting == 2)
+
+    controller.release(running.pop())
+    batch.join(1.0)
+    assert batch_result.get('admitted', 5) < 1.0
+    assert 'admitted' not in analyze_result
+
+    controller.release(running.pop())
+    controller.release(batch_result['ticket'])
+    analyze.join(1.0)
+    assert analyze_result.get('admitted', 5) < 1.0
+    controller.release(analyze_result['ticket'])
+    assert controller.in_flight == 0 and controller.waiting == 0
+
+
+def test_full_queue_rejects():
+    controller = AdmissionController(max_in_flight=1, max_queue=0)
+    deadline = time.time() + 5
+    ticket = controller.admit('analyze', 'a', deadline)
+    try:
+        controller.admit('analyze', 'b', deadline)
+    except Rejected as e:
+        assert e.reason == 'queue_full'
+    else:
+        raise AssertionError('second request was admitted')
+    controller.release(ticket)
+    controller.release(controller.admit('analyze', 'b', deadline))
@@ -0,0 +1,122 @@
+# FeatureAssembler against the pandas preprocessing it replaced in predict_abnormalities()
+#
+# Run from the project root: python -m pytest tests
+
+import os
+import sys
+import warnings
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from features import FeatureAssembler  # noqa: E402
+
+MODEL_DIR = os.path.join(ROOT, 'static', 'ml_model')
+DATA_FILES = ['synthetic_blood_reports.csv', 'DOC-20250409-WA0001.csv']
+
+
+@pytest.fixture(scope='module')
+def bundle():
+    imputer = joblib.load(os.path.join(MODEL_DIR, 'imputer.pkl'))
+    train_cols = joblib.load(os.path.join(MODEL_DIR, 'training_columns.pkl'))
+    return imputer, train_cols, FeatureAssembler.from_imputer(train_cols, imputer)
+
+
+# CSV reports as app.py builds them in build_ml_input(): Age, Sex, then the training columns present
+@pytest.fixture(scope='module')
+def records(bundle):
+    _, train_cols, _ = bundle
+    records = []
+    for path in DATA_FILES:
+        df = pd.read_csv(os.path.join(ROOT, path))
+        df['Sex'] = df['Sex'].str.lower()
+        for row in df.to_dict('records'):
+            record = {'Age': row['Age'], 'Sex': row['Sex']}
+            record.update((col, row[col]) for col in train_cols if col in row and col != 'Age')
+            records.append(record)
+    return records
+
+
+# The preprocessing of predict_abnormalities() before FeatureAssembler, for a DataFrame of reports
+def original_preprocess(patient_df, imputer, train_cols):
+    num_cols = patient_df.select_dtypes(include=np.number).columns
+    patient_df[num_cols] = imputer.transform(patient_df[num_cols])
+    patient_df = pd.get_dummies(patient_df, columns=['Sex'])
+
+    missing_cols = set(train_cols) - set(patient_df.columns)
+    for col in missing_cols:
+        patient_df[col] = 0
+    return patient_df[train_cols].to_numpy(dtype=float)
+
+
+# The same for reports lacking some of the imputer's columns, which the original code could not take: those columns
+# are added as missing values first, so the imputer fills them with its medians
+def pandas_preprocess(patients, imputer, train_cols):
+    patient_df = pd.DataFrame(patients)
+    num_cols = list(imputer.feature_names_in_)
+    for col in num_cols:
+        if col not in patient_df.columns:
+            patient_df[col] = np.nan
+    patient_df[num_cols] = imputer.transform(patient_df[num_cols].astype(float))
+    patient_df = pd.get_dummies(patient_df, columns=['Sex'])
+
+    missing_cols = set(train_cols) - set(patient_df.columns)
+    for col in missing_cols:
+        patient_df[col] = 0
+    return patient_df[train_cols].to_numpy(dtype=float)
+
+
+def test_full_panels_match_original_pipeline(bundle, records):
+    imputer, train_cols, assembler = bundle
+    expected = original_preprocess(pd.DataFrame(records), imputer, train_cols)
+    np.testing.assert_array_equal(assembler.assemble_batch(records), expected)
+
+
+# The original code ran on one single-row DataFrame per request
+def test_single_reports_match_original_pipeline(bundle, records):
+    imputer, train_cols, assembler = bundle
+    for record in records[::100]:
+        expected = original_preprocess(pd.DataFrame([record]), imputer, train_cols)[0]
+        np.testing.assert_array_equal(assembler.assemble(record), expected)
+
+
+def test_missing_and_unknown_columns(bundle, records):
+    imputer, train_cols, assembler = bundle
+    rng = np.random.default_rng(0)
+    samples = []
+    for record in records[:2000]:
+        partial = {key: value for key, value in record.items() if key == 'Sex' or rng.random() < 0.5}
+        # Columns the model was not trained on are ignored
+        partial.update({'HCT': 41.0, 'RDW-SD': 45.0, 'Unknown test': 1.0})
+        samples.append(partial)
+    samples += [
+        {'Age': 40, 'Sex': 'male'},
+        {'Age': 40, 'Sex': 'other', 'Hemoglobin': 13.0},
+        {'Age': 40, 'Sex': 'female', 'Hemoglobin': None, 'PLT': float('nan')},
+        {'Sex': 'female'}
+    ]
+    expected = pandas_preprocess(samples, imputer, train_cols)
+    np.testing.assert_array_equal(assembler.assemble_batch(samples), expected)
+    np.testing.assert_array_equal(np.array([assembler.assemble(sample) for sample in samples]), expected)
+
+    frame = pd.DataFrame(samples)
+    frame = frame.astype({col: float for col in frame.columns if col != 'Sex'})
+    np.testing.assert_array_equal(assembler.assemble_frame(frame), expected)
+
+
+def test_model_scores_identical(bundle, records):
+    imputer, train_cols, assembler = bundle
+    model_path = os.path.join(MODEL_DIR, 'blood_report_model.pkl')
+    if not os.path.exists(model_path):
+        pytest.skip('No sklearn model in static/ml_model')
+    model = joblib.load(model_path)
+    sample = records[:500]
+    reference = pd.DataFrame(original_preprocess(pd.DataFrame(sample), imputer, train_cols), columns=train_cols)
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    for a, b in zip(model.predict_proba(reference), model.predict_proba(assembler.assemble_batch(sample))):
+        np.testing.assert_array_equal(a[:, 1], b[:, 1])
@@ -0,0 +1,49 @@
+# check_golden() against models serving all or only some of the recorded labels
+#
+# Run from the project root: python -m pytest tests
+
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from model_registry import check_golden  # noqa: E402
+
+GOLDEN = {
+    'classes': ['Anemia', 'Leukemia', 'Thalassemia'],
+    'reports': [{'Age': 40, 'Sex': 'male'}, {'Age': 60, 'Sex': 'female'}],
+    'probabilities': [[0.95, 0.01, 0.30], [0.10, 0.00, 0.92]]
+}
+
+
+def serving(classes, probabilities):
+    return SimpleNamespace(classes=classes, predict=lambda X: np.asarray(probabilities, dtype=float),
+                           feature_assembler=SimpleNamespace(assemble_batch=lambda reports: reports))
+
+
+def test_same_labels():
+    changed, max_diff = check_golden(serving(GOLDEN['classes'], GOLDEN['probabilities']), GOLDEN)
+    assert changed == 0 and max_diff == 0
+
+
+# A compact forest exported with --prune drops labels that cannot exceed the threshold
+def test_pruned_labels_count_as_zero():
+    model = serving(['Anemia', 'Thalassemia'], [[0.95, 0.30], [0.10, 0.92]])
+    changed, max_diff = check_golden(model, GOLDEN)
+    assert changed == 0 and max_diff == pytest.approx(0.01)
+
+    model = serving(['Anemia', 'Thalassemia'], [[0.95, 0.30], [0.10, 0.50]])
+    changed, _ = check_golden(model, GOLDEN)
+    assert changed == pytest.approx(1 / 6)
+
+
+def test_unrecorded_labels_rejected():
+    with pytest.raises(ValueError):
+        check_golden(serving(['Anemia', 'Lymphoma'], [[0.95, 0.0], [0.10, 0.0]]), GOLDEN)
+    with pytest.raises(ValueError):
+        check_golden(serving(['Anemia', 'Thalassemia'], [[0.95, 0.30]]), GOLDEN)
@@ -0,0 +1,538 @@
+# Training pipeline for the blood report model, the scriptable version of train_ml_model.ipynb
+#
+# Usage:
+#   python train_model.py synthetic_blood_reports.csv                        # notebook model, report, publish
+#   python train_model.py big.parquet --chunksize 500000 --search grid --n-jobs -1
+#   python train_model.py data.csv --search random --n-iter 12 --search-rows 20000 --tolerance 0.001
+#   python train_model.py check-labels synthetic_blood_reports.csv           # vectorized vs notebook labels
+#
+# Steps:
+#   1. The input CSV (or Parquet, with pyarrow) is read in chunks. Every chunk is labelled with
+#      generate_labels(), a vectorized version of the notebook's row-wise generate_labels(), and kept only
+#      as NumPy arrays.
+#   2. Missing values are imputed with the median, Sex is one-hot encoded and 20% is held out, as in the notebook.
+#   3. Optionally, a cross-validated grid or random search over the RandomForest settings runs on all cores.
+#      The candidates are scored by Hamming loss and the fastest one to predict within --tolerance of the best
+#      one wins.
+#   4. The held-out report covers Hamming loss, subset accuracy and per-label precision/recall/F1, plus the
+#      serving cost: pickle and flattened forest size, and single-row and batch latency of both engines.
+#   5. The four pickles, the flattened forest, report.json, golden.json (held-out reports with the model's
+#      predictions) and drift_reference.json (value distributions of the data and condition rates on the held-out
+#      reports, for drift.py) are published as a new bundle with model_bundle.publish_bundle(). Running servers
+#      load it within MODEL_RELOAD_INTERVAL seconds once it is activated (see model_registry.py).
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import warnings
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.metrics import classification_report, f1_score, hamming_loss, make_scorer
+from sklearn.model_selection import GridSearchCV, KFold, RandomizedSearchCV, train_test_split
+from sklearn.multioutput import MultiOutputClassifier
+from sklearn.preprocessing import MultiLabelBinarizer
+
+from drift import reference_statistics
+from forest import export_forest, save_forest
+from model_bundle import DRIFT_REFERENCE_FILE, FOREST_FILE, GOLDEN_FILE, MODEL_DIR, publish_bundle
+
+# Reference ranges used to label the training data, with the conditions suggested by a low or high value
+parameter_ranges = {
+    'Hemoglobin': {
+        'normal': {'male': (13.5, 17.5), 'female': (12.0, 15.5)},
+        'low': ['Anemia', 'Blood loss', 'Chronic disease', 'Nutritional deficiency', 'Bone marrow disorder', 'Kidney disease'],
+        'high': ['Dehydration', 'Polycythemia vera', 'Lung disease', 'High altitude adaptation']
+    },
+    'RBC': {
+        'normal': {'male': (4.5, 5.9), 'female': (4.0, 5.2)},
+        'low': ['Anemia', 'Bone marrow failure', 'Nutritional deficiency', 'Chronic inflammation', 'Hemolysis'],
+        'high': ['Dehydration', 'Polycythemia vera', 'Hypoxia', 'Kidney tumor']
+    },
+    'HCT': {
+        'normal': {'male': (40, 50), 'female': (36, 46)},
+        'low': ['Anemia', 'Bleeding', 'Nutritional deficiency', 'Bone marrow disorder'],
+        'high': ['Dehydration', 'Polycythemia vera', 'Chronic lung disease']
+    },
+    'MCV': {
+        'normal': (80, 100),
+        'low': ['Iron deficiency anemia', 'Thalassemia', 'Chronic disease'],
+        'high': ['Vitamin B12 deficiency', 'Folate deficiency', 'Liver disease', 'Hypothyroidism']
+    },
+    'MCH': {
+        'normal': (27, 33),
+        'low': ['Iron deficiency anemia', 'Thalassemia'],
+        'high': ['Macrocytic anemia', 'Reticulocytosis']
+    },
+    'MCHC': {
+        'normal': (32, 36),
+        'low': ['Iron deficiency anemia', 'Thalassemia'],
+        'high': ['Hereditary spherocytosis', 'Hemoglobin C disease']
+    },
+    'RDW-CV': {
+        'normal': (11.5, 14.5),
+        'low': [],
+        'high': ['Iron deficiency anemia', 'Vitamin B12 deficiency', 'Hemoglobinopathy', 'Myelodysplasia']
+    },
+    'RDW-SD': {
+        'normal': (39, 46),
+        'low': [],
+        'high': ['Iron deficiency anemia', 'Vitamin B12 deficiency']  # Similar to RDW-CV
+    },
+    'WBC': {
+        'normal': (4.0, 11.0),
+        'low': ['Viral infection', 'Bone marrow disorder', 'Autoimmune disease', 'Severe infection'],
+        'high': ['Bacterial infection', 'Leukemia', 'Inflammation', 'Stress response']
+    },
+    'NEU%': {
+        'normal': (40, 70),
+        'low': ['Viral infection', 'Autoimmune disorder', 'Chemotherapy effect'],
+        'high': ['Bacterial infection', 'Acute inflammation', 'Steroid use']
+    },
+    'LYM%': {
+        'normal': (20, 40),
+        'low': ['HIV/AIDS', 'Immunosuppression', 'Radiation exposure'],
+        'high': ['Viral infection', 'Chronic infection', 'Lymphoma']
+    },
+    'MON%': {
+        'normal': (2, 10),
+        'low': [],
+        'high': ['Chronic infection', 'Autoimmune disease', 'Myeloproliferative disorder']
+    },
+    'EOS%': {
+        'normal': (0, 6),
+        'low': [],
+        'high': ['Allergic disorder', 'Parasitic infection', 'Autoimmune disease']
+    },
+    'BAS%': {
+        'normal': (0, 2),
+        'low': [],
+        'high': ['Allergic reaction', 'Chronic inflammation', 'Myeloproliferative disorder']
+    },
+    'LYM#': {
+        'normal': (1.0, 4.0),
+        'low': ['HIV/AIDS', 'Immunosuppression'],
+        'high': ['Viral infection', 'Lymphoma']
+    },
+    'GRA#': {
+        'normal': (1.8, 7.0),
+        'low': ['Chemotherapy effect', 'Bone marrow failure'],
+        'high': ['Bacterial infection', 'Inflammation']
+    },
+    'PLT': {
+        'normal': (150, 450),
+        'low': ['Viral infection', 'Autoimmune disorder', 'Bone marrow disorder'],
+        'high': ['Inflammation', 'Iron deficiency', 'Myeloproliferative disorder']
+    },
+    'ESR': {
+        'normal': {'male': (0, 15), 'female': (0, 20)},
+        'low': [],
+        'high': ['Inflammation', 'Infection', 'Autoimmune disease', 'Malignancy']
+    }
+}
+
+# Every label generate_labels() can produce, in MultiLabelBinarizer (sorted) order
+CONDITIONS = sorted({condition for ranges in parameter_ranges.values()
+                     for condition in ranges['low'] + ranges['high']} | {'Normal'})
+
+# The configuration trained by the notebook
+DEFAULT_PARAMS = {'n_estimators': 200, 'max_depth': 12, 'min_samples_split': 5}
+
+# Hyperparameters searched with --search, on the RandomForestClassifier inside the MultiOutputClassifier
+SEARCH_SPACE = {
+    'estimator__n_estimators': [50, 100, 200],
+    'estimator__max_depth': [8, 12, 16],
+    'estimator__min_samples_split': [2, 5, 10],
+    'estimator__max_features': ['sqrt', 0.5]
+}
+
+RANDOM_STATE = 42
+
+# Held-out reports stored in the bundle with their predictions, to validate the model before it is served
+GOLDEN_REPORTS = 200
+
+
+# The notebook's labelling of one row, kept as the reference for generate_labels()
+def generate_labels_row(row):
+    conditions = []
+    sex = row['Sex'].lower() if pd.notna(row['Sex']) else None
+
+    for param, ranges in parameter_ranges.items():
+        if param not in row or pd.isna(row[param]):
+            continue
+
+        value = row[param]
+
+        if isinstance(ranges['normal'], dict):
+            if sex in ranges['normal']:
+                normal_min, normal_max = ranges['normal'][sex]
+            else:
+                continue
+        else:
+            normal_min, normal_max = ranges['normal']
+
+        if value < normal_min and 'low' in ranges:
+            conditions.extend(ranges['low'])
+        elif value > normal_max and 'high' in ranges:
+            conditions.extend(ranges['high'])
+
+    return list(set(conditions)) if conditions else ['Normal']
+
+
+# Label matrix of a DataFrame, one boolean column per entry in CONDITIONS
+# Same labels as generate_labels_row(): a missing value or a sex without a range flags nothing, and a test
+# below its range adds its 'low' conditions, above it its 'high' ones; rows without any condition are Normal
+def generate_labels(df):
+    labels = np.zeros((len(df), len(CONDITIONS)), dtype=bool)
+    positions = {condition: i for i, condition in enumerate(CONDITIONS)}
+    sex = df['Sex'].str.lower().to_numpy() if 'Sex' in df.columns else np.full(len(df), None)
+
+    for param, ranges in parameter_ranges.items():
+        if param not in df.columns:
+            continue
+        values = df[param].to_numpy(dtype=float)
+
+        if isinstance(ranges['normal'], dict):
+            # NaN bounds for other sexes make both comparisons False
+            normal_min = np.full(len(df), np.nan)
+            normal_max = np.full(len(df), np.nan)
+            for sex_name, (low, high) in ranges['normal'].items():
+                rows = sex == sex_name
+                normal_min[rows] = low
+                normal_max[rows] = high
+        else:
+            normal_min, normal_max = ranges['normal']
+
+        is_low = values < normal_min
+        is_high = ~is_low & (values > normal_max)
+        for condition in ranges['low']:
+            labels[:, positions[condition]] |= is_low
+        for condition in ranges['high']:
+            labels[:, positions[condition]] |= is_high
+
+    labels[:, positions['Normal']] = ~labels.any(axis=1)
+    return labels
+
+
+def read_chunks(path, chunksize):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+class Dataset:
+    def __init__(self, numeric, num_cols, sex, labels, load_seconds, label_seconds, chunks):
+        self.numeric = numeric
+        self.num_cols = num_cols
+        self.sex = sex
+        self.labels = labels
+        self.load_seconds = load_seconds
+        self.label_seconds = label_seconds
+        self.chunks = chunks
+
+
+# Read the data chunk by chunk, keeping only the numeric features, Sex and the label matrix of each chunk
+def load_dataset(path, chunksize):
+    started = time.perf_counter()
+    numeric, sex, labels = [], [], []
+    num_cols = None
+    label_seconds = 0
+
+    for chunk in read_chunks(path, chunksize):
+        chunk = chunk.drop(columns=['Patient ID'], errors='ignore')
+        if num_cols is None:
+            num_cols = [col for col in chunk.columns if col != 'Sex']
+
+        label_started = time.perf_counter()
+        labels.append(generate_labels(chunk))
+        label_seconds += time.perf_counter() - label_started
+
+        numeric.append(chunk[num_cols].to_numpy(dtype=float))
+        sex.append(chunk['Sex'].to_numpy(dtype=object))
+
+    if num_cols is None:
+        raise SystemExit(f'{path} has no rows')
+
+    return Dataset(np.concatenate(numeric), num_cols, np.concatenate(sex), np.concatenate(labels),
+                   time.perf_counter() - started, label_seconds, len(labels))
+
+
+# Impute, one-hot encode Sex and binarize the labels like the notebook; returns the fitted preprocessing objects
+def prepare(dataset):
+    imputer = SimpleImputer(strategy='median')
+    imputer.fit(pd.DataFrame(dataset.numeric, columns=dataset.num_cols))
+    numeric = imputer.transform(dataset.numeric)
+
+    # pd.get_dummies(X, columns=['Sex']): one column per observed value, sorted, missing values in none
+    sexes = sorted({value for value in dataset.sex if isinstance(value, str)})
+    one_hot = np.column_stack([dataset.sex == value for value in sexes]).astype(float)
+    X = np.hstack([numeric, one_hot])
+    train_cols = dataset.num_cols + [f'Sex_{value}' for value in sexes]
+
+    # MultiLabelBinarizer only knows the conditions that occur
+    present = dataset.labels.any(axis=0)
+    mlb = MultiLabelBinarizer(classes=[condition for condition, seen in zip(CONDITIONS, present) if seen])
+    mlb.fit([])
+    y = dataset.labels[:, present].astype(np.uint8)
+
+    return X, y, imputer, train_cols, mlb
+
+
+def build_model(params, n_jobs):
+    return MultiOutputClassifier(
+        RandomForestClassifier(class_weight='balanced', random_state=RANDOM_STATE, **params),
+        n_jobs=n_jobs
+    )
+
+
+# Cross-validated search; returns the chosen RandomForest parameters and a summary of every candidate
+def search(X, y, args):
+    rng = np.random.default_rng(RANDOM_STATE)
+    if args.search_rows and len(X) > args.search_rows:
+        rows = rng.choice(len(X), args.search_rows, replace=False)
+        X, y = X[rows], y[rows]
+
+    # The candidates run in parallel, each model single-threaded so the cores are not oversubscribed
+    estimator = build_model(DEFAULT_PARAMS, n_jobs=1)
+    scoring = {'hamming': make_scorer(hamming_loss, greater_is_better=False), 'f1_micro': 'f1_micro'}
+    cv = KFold(n_splits=args.cv, shuffle=True, random_state=RANDOM_STATE)
+    if args.search == 'grid':
+        searcher = GridSearchCV(estimator, SEARCH_SPACE, scoring=scoring, refit=False, cv=cv, n_jobs=args.n_jobs,
+                                verbose=args.verbose)
+    else:
+        searcher = RandomizedSearchCV(estimator, SEARCH_SPACE, n_iter=args.n_iter, scoring=scoring, refit=False,
+                                      cv=cv, n_jobs=args.n_jobs, random_state=RANDOM_STATE, verbose=args.verbose)
+    searcher.fit(X, y)
+
+    results = searcher.cv_results_
+    candidates = []
+    for i, params in enumerate(results['params']):
+        candidates.append({
+            'params': {key.replace('estimator__', ''): value for key, value in params.items()},
+            'hamming_loss': -float(results['mean_test_hamming'][i]),
+            'hamming_loss_std': float(results['std_test_hamming'][i]),
+            'f1_micro': float(results['mean_test_f1_micro'][i]),
+            'fit_seconds': float(results['mean_fit_time'][i]),
+            'score_seconds': float(results['mean_score_time'][i])
+        })
+
+    # Among the candidates within tolerance of the lowest loss, the cheapest to serve
+    best_loss = min(candidate['hamming_loss'] for candidate in candidates)
+    eligible = [candidate for candidate in candidates if candidate['hamming_loss'] <= best_loss + args.tolerance]
+    chosen = min(eligible, key=lambda candidate: (candidate['score_seconds'], candidate['hamming_loss']))
+    for candidate in candidates:
+        candidate['chosen'] = candidate is chosen
+    return dict(DEFAULT_PARAMS, **chosen['params']), candidates, len(X)
+
+
+def accuracy_report(model, X_test, y_test, classes):
+    y_pred = model.predict(X_test)
+    per_label = classification_report(y_test, y_pred, target_names=classes, zero_division=0, output_dict=True)
+    return {
+        'hamming_loss': float(hamming_loss(y_test, y_pred)),
+        'subset_accuracy': float(model.score(X_test, y_test)),
+        'f1_micro': float(f1_score(y_test, y_pred, average='micro', zero_division=0)),
+        'f1_macro': float(f1_score(y_test, y_pred, average='macro', zero_division=0)),
+        'per_label': {label: {key: float(value) for key, value in per_label[label].items()} for label in classes}
+    }
+
+
+def median_seconds(fn, X, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(X)
+        times.append(time.perf_counter() - started)
+    return float(np.median(times))
+
+
+def serving_report(model, forest, X_test, batch_rows, repeat):
+    def sklearn_proba(rows):
+        return model.predict_proba(rows)
+
+    batch = X_test[:batch_rows]
+    report = {
+        'trees': int(len(forest.roots)),
+        'nodes': int(len(forest.feature)),
+        'pickle_bytes': len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)),
+        'forest_bytes': int(sum(array.nbytes for array in forest.arrays.values())),
+        'batch_rows': len(batch)
+    }
+    for name, fn in (('sklearn', sklearn_proba), ('flat', forest.predict_proba)):
+        report[f'{name}_single_row_ms'] = median_seconds(fn, X_test[:1], repeat) * 1000
+        batch_seconds = median_seconds(fn, batch, max(1, repeat // 5))
+        report[f'{name}_batch_ms'] = batch_seconds * 1000
+        report[f'{name}_batch_rows_per_second'] = len(batch) / batch_seconds
+    return report
+
+
+# The first held-out rows as /api/analyze model inputs, with the probabilities the model gives them
+def golden_reports(forest, X_test, train_cols, rows=GOLDEN_REPORTS):
+    X = X_test[:rows]
+    reports = []
+    for row in X:
+        report = {}
+        for col, value in zip(train_cols, row):
+            if col.startswith('Sex_'):
+                if value == 1:
+                    report['Sex'] = col[len('Sex_'):]
+            else:
+                report[col] = float(value)
+        reports.append(report)
+    return {'classes': [str(label) for label in forest.classes], 'reports': reports,
+            'probabilities': np.round(forest.predict_proba(X), 6).tolist()}
+
+
+def print_report(report):
+    data, accuracy, serving = report['data'], report['accuracy'], report['serving']
+    print(f"Rows: {data['rows']} in {data['chunks']} chunk(s), loaded in {data['load_seconds']:.2f}s "
+          f"(labels {data['label_seconds']:.2f}s)")
+
+    if report['search']:
+        print(f"\nSearch over {report['search_rows']} rows ({len(report['search'])} candidates):")
+        print(f"{'hamming':>9}{'f1 micro':>10}{'fit s':>8}{'score s':>9}  params")
+        for candidate in sorted(report['search'], key=lambda c: c['hamming_loss']):
+            mark = '*' if candidate['chosen'] else ' '
+            print(f"{candidate['hamming_loss']:>9.5f}{candidate['f1_micro']:>10.4f}{candidate['fit_seconds']:>8.1f}"
+                  f"{candidate['score_seconds']:>9.2f} {mark}{candidate['params']}")
+
+    print(f"\nModel: {report['params']}, trained in {report['fit_seconds']:.1f}s")
+    print(f"Held-out: Hamming loss {accuracy['hamming_loss']:.5f}, subset accuracy {accuracy['subset_accuracy']:.4f}, "
+          f"F1 micro {accuracy['f1_micro']:.4f}, F1 macro {accuracy['f1_macro']:.4f}")
+    print(f"{'label':<32}{'precision':>10}{'recall':>8}{'f1':>8}{'support':>9}")
+    for label, scores in accuracy['per_label'].items():
+        print(f"{label:<32}{scores['precision']:>10.3f}{scores['recall']:>8.3f}{scores['f1-score']:>8.3f}"
+              f"{int(scores['support']):>9}")
+
+    print(f"\nServing: {serving['trees']} trees, {serving['nodes']} nodes, pickle {serving['pickle_bytes'] / 1e6:.1f} MB, "
+          f"flat forest {serving['forest_bytes'] / 1e6:.1f} MB")
+    for name in ('sklearn', 'flat'):
+        print(f"  {name:<8} single row {serving[f'{name}_single_row_ms']:.2f} ms, {serving['batch_rows']} rows "
+              f"{serving[f'{name}_batch_ms']:.1f} ms ({serving[f'{name}_batch_rows_per_second']:.0f} rows/s)")
+
+
+def train_command(args):
+    dataset = load_dataset(args.data, args.chunksize)
+    X, y, imputer, train_cols, mlb = prepare(dataset)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=args.test_size, random_state=RANDOM_STATE)
+
+    params, candidates, search_rows = dict(DEFAULT_PARAMS), [], 0
+    if args.search != 'none':
+        params, candidates, search_rows = search(X_train, y_train, args)
+
+    started = time.perf_counter()
+    model = build_model(params, n_jobs=args.n_jobs).fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - started
+
+    forest = export_forest(model, train_cols, dict(zip(imputer.feature_names_in_, imputer.statistics_)), mlb.classes_)
+    classes = [str(label) for label in mlb.classes_]
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'data': {'path': os.path.abspath(args.data), 'rows': len(X), 'chunks': dataset.chunks,
+                 'load_seconds': dataset.load_seconds, 'label_seconds': dataset.label_seconds,
+                 'train_rows': len(X_train), 'test_rows': len(X_test)},
+        'params': params,
+        'fit_seconds': fit_seconds,
+        'search': candidates,
+        'search_rows': search_rows,
+        'accuracy': accuracy_report(model, X_test, y_test, classes),
+        'serving': serving_report(model, forest, X_test, args.latency_batch, args.latency_repeat)
+    }
+    print_report(report)
+
+    if args.dry_run:
+        return
+
+    def dump(value):
+        return lambda path: joblib.dump(value, path)
+
+    def write_json(data):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=1)
+        return write
+
+    version = args.version or time.strftime('%Y%m%d-%H%M%S')
+    bundle_dir = publish_bundle({
+        'blood_report_model.pkl': dump(model),
+        'label_binarizer.pkl': dump(mlb),
+        'imputer.pkl': dump(imputer),
+        'training_columns.pkl': dump(train_cols),
+        FOREST_FILE: lambda path: save_forest(forest, path),
+        'report.json': write_json(report),
+        GOLDEN_FILE: write_json(golden_reports(forest, X_test, train_cols)),
+        DRIFT_REFERENCE_FILE: write_json(reference_statistics(dataset.numeric, dataset.num_cols, dataset.sex,
+                                                              forest.predict_proba(X_test), classes))
+    }, version, model_dir=args.model_dir, activate=not args.no_activate)
+    print(f"\nPublished {bundle_dir}" + ('' if args.no_activate else ' (active)'))
+
+
+# Compare generate_labels() with the notebook's row-wise labelling on a dataset
+def check_labels_command(args):
+    df = pd.read_csv(args.data).drop(columns=['Patient ID'], errors='ignore')
+
+    started = time.perf_counter()
+    rowwise = df.apply(generate_labels_row, axis=1)
+    rowwise_seconds = time.perf_counter() - started
+    expected = MultiLabelBinarizer(classes=CONDITIONS).fit_transform(rowwise).astype(bool)
+
+    started = time.perf_counter()
+    actual = generate_labels(df)
+    vectorized_seconds = time.perf_counter() - started
+
+    mismatched = np.flatnonzero((actual != expected).any(axis=1))
+    print(f"{len(df) - len(mismatched)}/{len(df)} rows labelled identically")
+    print(f"row-wise {rowwise_seconds:.3f}s, vectorized {vectorized_seconds:.3f}s "
+          f"({rowwise_seconds / vectorized_seconds:.0f}x)")
+    if len(mismatched):
+        raise SystemExit(f"First mismatch: {df.iloc[mismatched[0]].to_dict()}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'check-labels':
+        parser = argparse.ArgumentParser(prog='train_model.py check-labels',
+                                         description='Check the vectorized labels against the notebook')
+        parser.add_argument('data')
+        check_labels_command(parser.parse_args(argv[1:]))
+        return
+
+    parser = argparse.ArgumentParser(description='Train, evaluate and publish the blood report model')
+    parser.add_argument('data', help='Training data, CSV or Parquet')
+    parser.add_argument('--chunksize', type=int, default=100000, help='Rows read at a time')
+    parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--search', choices=['none', 'grid', 'random'], default='none',
+                        help='Hyperparameter search; none trains the notebook configuration')
+    parser.add_argument('--n-iter', type=int, default=10, help='Candidates tried by --search random')
+    parser.add_argument('--cv', type=int, default=3, help='Cross-validation folds')
+    parser.add_argument('--search-rows', type=int, default=20000,
+                        help='Training rows sampled for the search (0 for all); the final model uses all of them')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='Hamming loss margin within which the fastest candidate is preferred')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='Cores used for the search and the final fit')
+    parser.add_argument('--latency-batch', type=int, default=1000, help='Rows in the batch latency measurement')
+    parser.add_argument('--latency-repeat', type=int, default=20)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--version', help='Bundle name, the current time by default')
+    parser.add_argument('--no-activate', action='store_true', help='Publish the bundle without switching to it')
+    parser.add_argument('--dry-run', action='store_true', help='Train and report without publishing')
+    parser.add_argument('--verbose', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # The forest is fitted on a NumPy matrix; pandas inputs in later predictions only trigger this warning
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    train_command(args)
+
+
+if __name__ == '__main__':
+    main()